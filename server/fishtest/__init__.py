@@ -1,6 +1,7 @@
 import hashlib
 import os
 import subprocess
+import time
 from pathlib import Path
 
 from fishtest.rundb import RunDb
@@ -10,7 +11,7 @@ from pyramid.config import Configurator
 from pyramid.events import BeforeRender, NewRequest
 from pyramid.session import SignedCookieSessionFactory
 
-from fishtest import helpers
+from fishtest import helpers, metrics
 
 
 def main(global_config, **settings):
@@ -53,18 +54,35 @@ def main(global_config, **settings):
         "html/SPRTcalculator.html": static_file_hash("html/SPRTcalculator.html"),
     }
 
-    rundb = RunDb()
+    # Several instances may serve the same db. The primary one, which
+    # serves the workers, listens on primary_port (all of them by default).
+    port = global_config.get("http_port")
+    primary_port = settings.get("fishtest.primary_port", port)
+    rundb = RunDb(
+        is_primary_instance=port == primary_port,
+        server_threads=int(settings.get("fishtest.server_threads", 4)),
+    )
 
     def add_rundb(event):
         event.request.rundb = rundb
         event.request.userdb = rundb.userdb
         event.request.actiondb = rundb.actiondb
 
+    def time_request(event):
+        t0 = time.perf_counter()
+
+        def record(request):
+            route = request.matched_route.name if request.matched_route else ""
+            metrics.request_duration.labels(route).observe(time.perf_counter() - t0)
+
+        event.request.add_finished_callback(record)
+
     def add_renderer_globals(event):
         event["h"] = helpers
         event["cache_busters"] = cache_busters
 
     config.add_subscriber(add_rundb, NewRequest)
+    config.add_subscriber(time_request, NewRequest)
     config.add_subscriber(add_renderer_globals, BeforeRender)
 
     # Authentication
@@ -117,19 +135,23 @@ def main(global_config, **settings):
     # API
     config.add_route("api_request_task", "/api/request_task")
     config.add_route("api_update_task", "/api/update_task")
+    config.add_route("api_update_tasks", "/api/update_tasks")
     config.add_route("api_failed_task", "/api/failed_task")
     config.add_route("api_stop_run", "/api/stop_run")
     config.add_route("api_request_version", "/api/request_version")
     config.add_route("api_beat", "/api/beat")
     config.add_route("api_request_spsa", "/api/request_spsa")
     config.add_route("api_active_runs", "/api/active_runs")
+    config.add_route("api_machines", "/api/machines")
     config.add_route("api_get_run", "/api/get_run/{id}")
     config.add_route("api_get_task", "/api/get_task/{id}/{task_id}")
     config.add_route("api_upload_pgn", "/api/upload_pgn")
     config.add_route("api_download_pgn", "/api/pgn/{id}")
     config.add_route("api_download_pgn_100", "/api/pgn_100/{skip}")
+    config.add_route("api_download_run_pgns", "/api/run_pgns/{id}")
     config.add_route("api_download_nn", "/api/nn/{id}")
     config.add_route("api_get_elo", "/api/get_elo/{id}")
+    config.add_route("api_metrics", "/api/metrics")
 
     config.scan()
     return config.make_wsgi_app()
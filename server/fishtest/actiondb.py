@@ -53,12 +53,23 @@ class ActionDb:
     def dead_task(self, username, run):
         self._new_action(username, "dead_task", run)
 
+    def dead_tasks(self, dead_tasks):
+        # dead_tasks is a list of (username, run) pairs.
+        if dead_tasks:
+            self.actions.insert_many(
+                [
+                    self._action(username, "dead_task", run)
+                    for username, run in dead_tasks
+                ]
+            )
+
+    def _action(self, username, action, data):
+        return {
+            "username": username,
+            "action": action,
+            "data": data,
+            "time": datetime.utcnow(),
+        }
+
     def _new_action(self, username, action, data):
-        self.actions.insert_one(
-            {
-                "username": username,
-                "action": action,
-                "data": data,
-                "time": datetime.utcnow(),
-            }
-        )
+        self.actions.insert_one(self._action(username, action, data))
@@ -2,8 +2,7 @@ import base64
 import copy
 from datetime import datetime
 
-import requests
-from fishtest.stats.stat_util import SPRT_elo
+from fishtest import metrics
 from fishtest.util import optional_key, union, validate, worker_name
 from fishtest.views import del_tasks
 from pyramid.httpexceptions import (
@@ -27,64 +26,96 @@ db directly. However this information may be slightly outdated, depending
 on how frequently the main instance flushes its run cache.
 """
 
-WORKER_VERSION = 160
-
-flag_cache = {}
+WORKER_VERSION = 161
+
+
+worker_info_schema = {
+    "uname": str,
+    "architecture": [str, str],
+    "concurrency": int,
+    "max_memory": int,
+    "min_threads": int,
+    "username": str,
+    "version": int,
+    "python_version": [int, int, int],
+    "gcc_version": [int, int, int],
+    "compiler": union("g++", "clang++"),
+    "unique_key": str,
+    "rate": {"limit": int, "remaining": int},
+    "ARCH": str,
+    "nps": float,
+}
+
+spsa_schema = {
+    "wins": int,
+    "losses": int,
+    "draws": int,
+    "num_games": int,
+}
+
+stats_schema = {
+    "wins": int,
+    "losses": int,
+    "draws": int,
+    "crashes": int,
+    "time_losses": int,
+    "pentanomial": [int, int, int, int, int],
+}
 
 
 def validate_request(request):
     schema = {
         "password": str,
+        optional_key("token"): str,
         optional_key("run_id"): str,
         optional_key("task_id"): int,
         optional_key("pgn"): str,
         optional_key("message"): str,
-        "worker_info": {
-            "uname": str,
-            "architecture": [str, str],
-            "concurrency": int,
-            "max_memory": int,
-            "min_threads": int,
-            "username": str,
-            "version": int,
-            "python_version": [int, int, int],
-            "gcc_version": [int, int, int],
-            "compiler": union("g++", "clang++"),
-            "unique_key": str,
-            "rate": {"limit": int, "remaining": int},
-            "ARCH": str,
-            "nps": float,
-        },
-        optional_key("spsa"): {
-            "wins": int,
-            "losses": int,
-            "draws": int,
-            "num_games": int,
-        },
-        optional_key("stats"): {
-            "wins": int,
-            "losses": int,
-            "draws": int,
-            "crashes": int,
-            "time_losses": int,
-            "pentanomial": [int, int, int, int, int],
-        },
+        "worker_info": worker_info_schema,
+        optional_key("spsa"): spsa_schema,
+        optional_key("stats"): stats_schema,
     }
     return validate(schema, request, "request")
 
 
+def validate_update_tasks(request):
+    schema = {
+        "password": str,
+        optional_key("token"): str,
+        "worker_info": worker_info_schema,
+        "updates": list,
+        optional_key("next_run"): bool,
+        optional_key("next_task"): bool,
+    }
+    error = validate(schema, request, "request")
+    if error != "":
+        return error
+    update_schema = {
+        "run_id": str,
+        "task_id": int,
+        "stats": stats_schema,
+        optional_key("spsa"): spsa_schema,
+    }
+    for i, update in enumerate(request["updates"]):
+        error = validate(update_schema, update, "request['updates'][{}]".format(i))
+        if error != "":
+            return error
+    return ""
+
+
 def strip_run(run):
-    run = copy.deepcopy(run)
-    if "tasks" in run:
-        run["tasks"] = []
+    # Don't copy the tasks before throwing them away.
+    stripped = {k: v for k, v in run.items() if k not in ("tasks", "bad_tasks")}
+    stripped = copy.deepcopy(stripped)
+    stripped["tasks"] = []
     if "bad_tasks" in run:
-        run["bad_tasks"] = []
-    if "spsa" in run["args"] and "param_history" in run["args"]["spsa"]:
-        run["args"]["spsa"]["param_history"] = []
-    run["_id"] = str(run["_id"])
-    run["start_time"] = str(run["start_time"])
-    run["last_updated"] = str(run["last_updated"])
-    return run
+        stripped["bad_tasks"] = []
+    if "spsa" in stripped["args"] and "param_history" in stripped["args"]["spsa"]:
+        stripped["args"]["spsa"]["param_history"] = []
+    stripped["_id"] = str(stripped["_id"])
+    stripped["start_time"] = str(stripped["start_time"])
+    stripped["last_updated"] = str(stripped["last_updated"])
+    return stripped
 
 
 @exception_view_config(HTTPBadRequest)
@@ -114,7 +145,7 @@ class ApiView(object):
             print(error, flush=True)
             raise exception(self.add_time({"error": error}))
 
-    def validate_username_password(self, api):
+    def validate_username_password(self, api, allow_token=True):
         self.__t0 = datetime.utcnow()
         self.__api = api
         # is the request valid json?
@@ -124,12 +155,27 @@ class ApiView(object):
             self.handle_error("request is not json encoded")
 
         # Is the request syntactically correct?
-        schema = {"password": str, "worker_info": {"username": str}}
+        schema = {
+            "password": str,
+            optional_key("token"): str,
+            "worker_info": {"username": str},
+        }
         self.handle_error(validate(schema, self.request_body, "request"))
 
+        # A valid session token makes checking the password unnecessary.
+        username = self.request_body["worker_info"]["username"]
+        if (
+            allow_token
+            and "token" in self.request_body
+            and self.request.userdb.authenticate_token(
+                username, self.request_body["token"]
+            )
+        ):
+            return
+
         # is the supplied password correct?
         token = self.request.userdb.authenticate(
-            self.request_body["worker_info"]["username"],
+            username,
             self.request_body["password"],
         )
         if "error" in token:
@@ -247,43 +293,42 @@ class ApiView(object):
         return self.request_body.get("spsa", {})
 
     def get_flag(self):
-        ip = self.request.remote_addr
-        if ip in flag_cache:
-            return flag_cache.get(ip, None)  # Handle race condition on "del"
-        # concurrent invocations get None, race condition is not an issue
-        flag_cache[ip] = None
-        result = self.request.userdb.flag_cache.find_one({"ip": ip})
-        if result:
-            flag_cache[ip] = result["country_code"]
-            return result["country_code"]
-        try:
-            # Get country flag from worker IP address
-            FLAG_HOST = "https://freegeoip.app/json/"
-            r = requests.get(FLAG_HOST + self.request.remote_addr, timeout=1.0)
-            if r.status_code == 200:
-                country_code = r.json()["country_code"]
-                self.request.userdb.flag_cache.insert_one(
-                    {
-                        "ip": ip,
-                        "country_code": country_code,
-                        "geoip_checked_at": datetime.utcnow(),
-                    }
-                )
-                flag_cache[ip] = country_code
-                return country_code
-            raise ConnectionError("flag server failed")
-        except:
-            del flag_cache[ip]
-            print("Failed GeoIP check for {}".format(ip))
-            return None
+        # Returns None until the flag has been resolved in the background.
+        return self.request.userdb.flagdb.get_flag(self.request.remote_addr)
 
     @view_config(route_name="api_active_runs")
     def active_runs(self):
         active = {}
-        for run in self.request.rundb.get_unfinished_runs():
+        summary_keys = self.request.rundb.summary_keys
+        for summary in self.request.rundb.get_run_summaries():
+            # Served with the same keys as the runs themselves.
+            run = {k: v for k, v in summary.items() if k not in summary_keys}
             active[str(run["_id"])] = strip_run(run)
         return active
 
+    @view_config(route_name="api_machines")
+    def machines(self):
+        # A compact view of the live machines. Served from memory on the
+        # primary instance.
+        rundb = self.request.rundb
+        machines = rundb.get_machines()
+        return {
+            **rundb.machines_totals(machines),
+            "machines": [
+                {
+                    "username": m["username"],
+                    "country_code": m.get("country_code", "?"),
+                    "concurrency": m["concurrency"],
+                    "nps": m["nps"],
+                    "version": m["version"],
+                    "run": str(m["run"]["_id"]),
+                    "task_id": m["task_id"],
+                    "last_updated": str(m["last_updated"]),
+                }
+                for m in machines
+            ],
+        }
+
     @view_config(route_name="api_get_run")
     def get_run(self):
         run = self.request.rundb.get_run(self.request.matchdict["id"])
@@ -331,20 +376,22 @@ class ApiView(object):
         if "sprt" not in run["args"]:
             return {}
         sprt = run["args"].get("sprt").copy()
-        elo_model = sprt.get("elo_model", "BayesElo")
-        alpha = sprt["alpha"]
-        beta = sprt["beta"]
-        elo0 = sprt["elo0"]
-        elo1 = sprt["elo1"]
-        sprt["elo_model"] = elo_model
-        a = SPRT_elo(
-            results, alpha=alpha, beta=beta, elo0=elo0, elo1=elo1, elo_model=elo_model
-        )
+        sprt["elo_model"] = sprt.get("elo_model", "BayesElo")
+        a = self.request.rundb.get_elo(results, sprt)
         run = strip_run(run)
         run["elo"] = a
         run["args"]["sprt"] = sprt
         return run
 
+    @view_config(route_name="api_metrics")
+    def get_metrics(self):
+        # In the Prometheus text exposition format.
+        return Response(
+            metrics.registry.render(),
+            content_type="text/plain; version=0.0.4",
+            charset="utf-8",
+        )
+
     @view_config(route_name="api_request_task")
     def request_task(self):
         self.validate_request("/api/request_task")
@@ -352,7 +399,9 @@ class ApiView(object):
         result = self.request.rundb.request_task(worker_info)
         if "task_waiting" in result:
             return self.add_time(result)
+        return self.add_time(self.strip_task(result, worker_info))
 
+    def strip_task(self, result, worker_info):
         # Strip the run of unneccesary information
         run = result["run"]
         min_run = {"_id": str(run["_id"]), "args": run["args"], "tasks": []}
@@ -371,7 +420,7 @@ class ApiView(object):
                 min_run["tasks"].append(min_task)
 
         result["run"] = min_run
-        return self.add_time(result)
+        return result
 
     @view_config(route_name="api_update_task")
     def update_task(self):
@@ -383,7 +432,86 @@ class ApiView(object):
             stats=self.stats(),
             spsa=self.spsa(),
         )
-        return self.add_time(result)
+        return self.add_time(self.add_backpressure(result))
+
+    @view_config(route_name="api_update_tasks")
+    def update_tasks(self):
+        # Several updates in a single request. The updates are applied
+        # grouped by run, see RunDb.update_tasks().
+        self.validate_username_password("/api/update_tasks")
+        self.handle_error(validate_update_tasks(self.request_body))
+        worker_info = self.worker_info()
+        unique_key = worker_info["unique_key"]
+        updates = self.request_body["updates"]
+        results = len(updates) * [None]
+        runs = {}
+        for i, update in enumerate(updates):
+            runs.setdefault(update["run_id"], []).append(i)
+        for run_id, indices in runs.items():
+            run = self.request.rundb.get_run(run_id)
+            valid = []
+            for i in indices:
+                task_id = updates[i]["task_id"]
+                error = ""
+                if run is None:
+                    error = "Invalid run_id: {}".format(run_id)
+                elif task_id < 0 or task_id >= len(run["tasks"]):
+                    error = "Invalid task_id {} for run_id {}".format(task_id, run_id)
+                elif unique_key != run["tasks"][task_id]["worker_info"]["unique_key"]:
+                    error = "Invalid unique key {} for task_id {} for run_id {}".format(
+                        unique_key, task_id, run_id
+                    )
+                if error != "":
+                    error = "/api/update_tasks: {}".format(error)
+                    print(error, flush=True)
+                    results[i] = {"task_alive": False, "error": error}
+                else:
+                    valid.append(i)
+            if valid:
+                results_ = self.request.rundb.update_tasks(
+                    worker_info,
+                    run_id,
+                    [
+                        (
+                            updates[i]["task_id"],
+                            updates[i]["stats"],
+                            updates[i].get("spsa", {}),
+                        )
+                        for i in valid
+                    ],
+                )
+                for i, result in zip(valid, results_):
+                    results[i] = result
+        response = {"results": results}
+        # A worker about to finish its task can ask for the run of its
+        # next task, to download what it needs in advance, and with its
+        # final update for the next task itself. Workers that should be
+        # updated go through /api/request_version first.
+        version = int(str(worker_info["version"]).split(":")[0])
+        if version >= WORKER_VERSION:
+            if self.request_body.get("next_task", False):
+                if not any(result["task_alive"] for result in results):
+                    result = self.request.rundb.request_next_task(worker_info)
+                    if "task_id" in result:
+                        response["next_task"] = self.strip_task(result, worker_info)
+            elif self.request_body.get("next_run", False):
+                run = self.request.rundb.peek_task(worker_info)
+                if run is not None:
+                    response["next_run"] = {
+                        "_id": str(run["_id"]),
+                        "args": {
+                            k: run["args"][k]
+                            for k in ("resolved_new", "resolved_base", "tests_repo")
+                            if k in run["args"]
+                        },
+                    }
+        return self.add_time(self.add_backpressure(response))
+
+    def add_backpressure(self, result):
+        # Ask the worker to send fewer updates if the server is busy.
+        if self.request.rundb.update_backpressure():
+            result["coalesce"] = True
+        return result
 
     @view_config(route_name="api_failed_task")
     def failed_task(self):
@@ -402,14 +530,26 @@ class ApiView(object):
         )
         return self.add_time(result)
 
-    @view_config(route_name="api_download_pgn", renderer="string")
-    def download_pgn(self):
-        pgn = self.request.rundb.get_pgn(self.request.matchdict["id"])
+    def pgn_response(self, pgn):
+        # Streams the decompressed PGN.
         if pgn is None:
             raise exception_response(404)
+        content_type = "text/plain"
         if ".pgn" in self.request.matchdict["id"]:
-            self.request.response.content_type = "application/x-chess-pgn"
-        return pgn
+            content_type = "application/x-chess-pgn"
+        return Response(app_iter=pgn, content_type=content_type, charset="utf-8")
+
+    @view_config(route_name="api_download_pgn")
+    def download_pgn(self):
+        return self.pgn_response(
+            self.request.rundb.iter_pgn(self.request.matchdict["id"])
+        )
+
+    @view_config(route_name="api_download_run_pgns")
+    def download_run_pgns(self):
+        return self.pgn_response(
+            self.request.rundb.iter_run_pgns(self.request.matchdict["id"])
+        )
 
     @view_config(route_name="api_download_pgn_100")
     def download_pgn_100(self):
@@ -455,8 +595,7 @@ class ApiView(object):
                 run["failed"] = True
                 self.request.rundb.stop_run(self.run_id())
             else:
-                task = self.task()
-                task["active"] = False
+                self.request.rundb.set_inactive_task(self.task_id(), run)
                 self.request.rundb.buffer(run, True)
 
         self.handle_error(error, exception=HTTPUnauthorized)
@@ -466,16 +605,21 @@ class ApiView(object):
     def request_version(self):
         # By being mor lax here we can be more strict
         # elsewhere since the worker will upgrade.
-        self.validate_username_password("/api/request_version")
-        return self.add_time({"version": WORKER_VERSION})
+        # New tokens are only issued after checking the password.
+        self.validate_username_password("/api/request_version", allow_token=False)
+        userdb = self.request.userdb
+        return self.add_time(
+            {
+                "version": WORKER_VERSION,
+                "token": userdb.create_token(self.get_username()),
+                "token_lifetime": userdb.token_lifetime,
+            }
+        )
 
     @view_config(route_name="api_beat")
     def beat(self):
         self.validate_request("/api/beat")
-        run = self.run()
-        task = self.task()
-        task["last_updated"] = datetime.utcnow()
-        self.request.rundb.buffer(run, False)
+        self.request.rundb.beat(self.run(), self.task_id())
         return self.add_time({})
 
     @view_config(route_name="api_request_spsa")
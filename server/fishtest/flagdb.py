@@ -0,0 +1,141 @@
+import bisect
+import csv
+import ipaddress
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+import requests
+
+FLAG_HOST = "https://freegeoip.app/json/"
+
+
+class FlagDb:
+    """Resolves the country code of the IP addresses of the workers.
+
+    get_flag() never blocks: an unknown address is queued for a
+    background thread and get_flag() returns None (a placeholder) until
+    it has been resolved. The thread looks the address up in the
+    flag_cache collection, then in a local IP to country table if one is
+    configured, and finally asks a GeoIP web service. The resolved codes
+    are kept in a bounded LRU cache and are refreshed after ttl seconds.
+
+    The local table is a csv file given by FISHTEST_GEOIP_TABLE with rows
+    "first_ip,last_ip,country_code", e.g. the free db-ip.com "IP to
+    Country Lite" database.
+    """
+
+    def __init__(self, db, table_path=None, maxsize=10000, ttl=7 * 24 * 3600):
+        self.db = db
+        self.flag_cache = self.db["flag_cache"]
+        self.table_path = table_path or os.getenv("FISHTEST_GEOIP_TABLE")
+        self.table = None
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.cache = OrderedDict()
+        self.pending = set()
+        self.queue = queue.Queue()
+        self.thread = None
+
+    def get_flag(self, ip):
+        with self.lock:
+            entry = self.cache.get(ip)
+            if entry is not None:
+                self.cache.move_to_end(ip)
+                country_code, expires = entry
+                if expires > time.time():
+                    return country_code
+            if ip not in self.pending:
+                self.pending.add(ip)
+                self.queue.put(ip)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.resolver, daemon=True)
+                self.thread.start()
+        # An expired code is still good enough until it is refreshed.
+        return entry[0] if entry is not None else None
+
+    def set_flag(self, ip, country_code):
+        with self.lock:
+            self.cache[ip] = (country_code, time.time() + self.ttl)
+            self.cache.move_to_end(ip)
+            while len(self.cache) > self.maxsize:
+                self.cache.popitem(last=False)
+
+    def resolver(self):
+        while True:
+            ip = self.queue.get()
+            try:
+                country_code = self.resolve(ip)
+                if country_code:
+                    self.set_flag(ip, country_code)
+            except Exception as e:
+                print("Failed GeoIP check for {}: {}".format(ip, str(e)), flush=True)
+            finally:
+                with self.lock:
+                    self.pending.discard(ip)
+
+    def resolve(self, ip):
+        result = self.flag_cache.find_one({"ip": ip})
+        if result:
+            checked_at = result.get("geoip_checked_at")
+            if (
+                checked_at is None
+                or (datetime.utcnow() - checked_at).total_seconds() < self.ttl
+            ):
+                return result["country_code"]
+        try:
+            country_code = self.lookup_table(ip)
+            if country_code is None:
+                r = requests.get(FLAG_HOST + ip, timeout=1.0)
+                r.raise_for_status()
+                country_code = r.json()["country_code"]
+        except Exception:
+            if result:
+                # Keep using the old code.
+                return result["country_code"]
+            raise
+        if country_code:
+            self.flag_cache.update_one(
+                {"ip": ip},
+                {
+                    "$set": {
+                        "country_code": country_code,
+                        "geoip_checked_at": datetime.utcnow(),
+                    }
+                },
+                upsert=True,
+            )
+        return country_code
+
+    def load_table(self):
+        # Returns per IP version the sorted first addresses of the ranges
+        # and the ranges themselves.
+        table = {4: ([], []), 6: ([], [])}
+        ranges = []
+        with open(self.table_path, newline="") as f:
+            for row in csv.reader(f):
+                if len(row) < 3:
+                    continue
+                first = ipaddress.ip_address(row[0])
+                last = ipaddress.ip_address(row[1])
+                ranges.append((first.version, int(first), int(last), row[2]))
+        for version, first, last, country_code in sorted(ranges):
+            table[version][0].append(first)
+            table[version][1].append((last, country_code))
+        return table
+
+    def lookup_table(self, ip):
+        if not self.table_path:
+            return None
+        if self.table is None:
+            self.table = self.load_table()
+        address = ipaddress.ip_address(ip)
+        firsts, ranges = self.table[address.version]
+        idx = bisect.bisect_right(firsts, int(address)) - 1
+        if idx >= 0 and int(address) <= ranges[idx][0]:
+            return ranges[idx][1]
+        return None
@@ -0,0 +1,106 @@
+"""Cached access to the GitHub metadata used when submitting tests.
+
+Commits and files addressed by a sha never change, so they are cached
+for good (up to cache_size entries). Lookups by branch name and the
+other listings expire after a short TTL. Only successful responses are
+cached.
+
+The base urls can be changed with FISHTEST_GITHUB_API and
+FISHTEST_GITHUB_RAW, e.g. to use a local stub server in tests.
+"""
+
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+GITHUB_API = os.getenv("FISHTEST_GITHUB_API") or "https://api.github.com"
+GITHUB_RAW = os.getenv("FISHTEST_GITHUB_RAW") or "https://raw.githubusercontent.com"
+OFFICIAL_REPO = "https://github.com/official-stockfish/Stockfish"
+
+HTTP_TIMEOUT = 15.0
+ref_ttl = 60
+books_ttl = 600
+cache_size = 1000
+
+cache = OrderedDict()
+cache_lock = threading.Lock()
+sha_re = re.compile(r"^[0-9a-f]{40}$")
+
+# For running independent lookups concurrently.
+executor = ThreadPoolExecutor(max_workers=8)
+
+
+def submit(fn, *args):
+    return executor.submit(fn, *args)
+
+
+def clear_cache():
+    with cache_lock:
+        cache.clear()
+
+
+def fetch(url, ttl=None, headers=None, raw=False):
+    """Gets url, decoded as json unless raw. The response is cached
+    for ttl seconds, or for good if ttl is None."""
+    key = (url, tuple(sorted((headers or {}).items())), raw)
+    now = time.time()
+    with cache_lock:
+        entry = cache.get(key)
+        if entry is not None and (entry[1] is None or entry[1] > now):
+            cache.move_to_end(key)
+            return entry[0]
+    r = requests.get(url, headers=headers, timeout=HTTP_TIMEOUT)
+    value = r.content.decode("utf-8") if raw else r.json()
+    if r.status_code == 200:
+        with cache_lock:
+            cache[key] = (value, None if ttl is None else now + ttl)
+            cache.move_to_end(key)
+            while len(cache) > cache_size:
+                cache.popitem(last=False)
+    return value
+
+
+def api_url(repo_url):
+    return repo_url.replace("https://github.com", GITHUB_API + "/repos")
+
+
+def raw_url(repo_url):
+    return repo_url.replace("https://github.com", GITHUB_RAW)
+
+
+def ttl(ref):
+    return None if sha_re.match(ref) else ref_ttl
+
+
+def get_commit(repo_url, ref):
+    return fetch(api_url(repo_url) + "/commits/" + ref, ttl(ref))
+
+
+def get_commits(repo_url):
+    # The latest commits of the default branch.
+    return fetch(api_url(repo_url) + "/commits", ref_ttl)
+
+
+def get_file(repo_url, sha, path):
+    return fetch(raw_url(repo_url) + "/" + sha + "/" + path, ttl(sha), raw=True)
+
+
+def get_books():
+    return fetch(
+        api_url("https://github.com/official-stockfish/books") + "/contents", books_ttl
+    )
+
+
+def get_master_diff(sha):
+    # The diff between official master and sha, empty if they are equal.
+    return fetch(
+        api_url(OFFICIAL_REPO) + "/compare/master..." + sha,
+        ref_ttl,
+        headers={"Accept": "application/vnd.github.v3.diff"},
+        raw=True,
+    )
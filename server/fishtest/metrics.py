@@ -0,0 +1,306 @@
+"""A small in-process metrics registry, exposed in the Prometheus text
+format by /api/metrics.
+
+Counters and histograms are updated on the hot path, so they are kept
+cheap: a child per label value, a short critical section per update and
+fixed histogram buckets. Values that are already known elsewhere (cache
+sizes, the flush statistics...) are not copied but read by a callback
+when the metrics are rendered.
+"""
+
+import bisect
+import math
+import threading
+import time
+
+from pymongo import monitoring
+
+# Seconds, from 50us to 10s.
+default_buckets = (
+    0.00005,
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{{{}}}".format(
+        ",".join(
+            '{}="{}"'.format(
+                name,
+                str(value)
+                .replace("\\", "\\\\")
+                .replace('"', '\\"')
+                .replace("\n", "\\n"),
+            )
+            for name, value in pairs
+        )
+    )
+
+
+class CounterChild:
+    __slots__ = ("lock", "value")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, value=1):
+        with self.lock:
+            self.value += value
+
+    def samples(self, name):
+        return [(name, (), self.value)]
+
+
+class HistogramChild:
+    __slots__ = ("lock", "buckets", "counts", "sum")
+
+    def __init__(self, buckets):
+        self.lock = threading.Lock()
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def samples(self, name):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), counts):
+            cumulative += count
+            samples.append(
+                (name + "_bucket", (("le", format_value(bound)),), cumulative)
+            )
+        samples.append((name + "_sum", (), total))
+        samples.append((name + "_count", (), cumulative))
+        return samples
+
+
+class Metric:
+    """A metric family. Without fn, the values are recorded through the
+    children returned by labels(). With fn, they are read at render time:
+    fn() returns a number, or a dict mapping tuples of label values to
+    numbers."""
+
+    def __init__(self, kind, name, help, labelnames=(), fn=None, buckets=None):
+        self.kind = kind
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.fn = fn
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.children = {}
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.get(values)
+                if child is None:
+                    if self.kind == "histogram":
+                        child = HistogramChild(self.buckets)
+                    else:
+                        child = CounterChild()
+                    self.children[values] = child
+        return child
+
+    # Shortcuts for metrics without labels.
+    def inc(self, value=1):
+        self.labels().inc(value)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def render(self):
+        lines = [
+            "# HELP {} {}".format(self.name, self.help),
+            "# TYPE {} {}".format(self.name, self.kind),
+        ]
+        if self.fn is not None:
+            try:
+                values = self.fn()
+            except Exception as e:
+                print("Metric {} failed: {}".format(self.name, str(e)), flush=True)
+                return []
+            if not isinstance(values, dict):
+                values = {(): values}
+            for label_values, value in sorted(values.items()):
+                lines.append(
+                    "{}{} {}".format(
+                        self.name,
+                        format_labels(self.labelnames, label_values),
+                        format_value(value),
+                    )
+                )
+            return lines
+        with self.lock:
+            children = sorted(self.children.items())
+        for label_values, child in children:
+            for name, extra, value in child.samples(self.name):
+                lines.append(
+                    "{}{} {}".format(
+                        name,
+                        format_labels(self.labelnames, label_values, extra),
+                        format_value(value),
+                    )
+                )
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def register(self, kind, name, help, labelnames=(), fn=None, buckets=None):
+        # Registering a name again returns the existing metric, but a new
+        # callback replaces the old one (e.g. for a new RunDb).
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = Metric(kind, name, help, labelnames, fn, buckets)
+                self.metrics[name] = metric
+            elif fn is not None:
+                metric.fn = fn
+            return metric
+
+    def counter(self, name, help, labelnames=(), fn=None):
+        return self.register("counter", name, help, labelnames, fn)
+
+    def gauge(self, name, help, fn, labelnames=()):
+        return self.register("gauge", name, help, labelnames, fn)
+
+    def histogram(self, name, help, labelnames=(), buckets=default_buckets):
+        return self.register("histogram", name, help, labelnames, buckets=buckets)
+
+    def render(self):
+        with self.lock:
+            metrics = sorted(self.metrics.items())
+        lines = []
+        for _, metric in metrics:
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+request_duration = registry.histogram(
+    "fishtest_http_request_duration_seconds",
+    "Time to handle a request, by route.",
+    ["route"],
+)
+lock_wait = registry.histogram(
+    "fishtest_lock_wait_seconds", "Time spent waiting to acquire a lock.", ["lock"]
+)
+lock_hold = registry.histogram(
+    "fishtest_lock_hold_seconds", "Time a lock was held.", ["lock"]
+)
+mongo_duration = registry.histogram(
+    "fishtest_mongo_command_duration_seconds",
+    "Duration of the MongoDB commands, by command and collection.",
+    ["command", "collection"],
+)
+mongo_failures = registry.counter(
+    "fishtest_mongo_command_failures_total",
+    "Number of failed MongoDB commands.",
+    ["command", "collection"],
+)
+
+
+class TimedLock:
+    """A drop-in replacement for threading.Lock() which records how long
+    it is waited for and held, under the label name."""
+
+    __slots__ = ("lock", "wait", "hold", "acquired")
+
+    def __init__(self, name, lock=None):
+        self.lock = lock or threading.Lock()
+        self.wait = lock_wait.labels(name)
+        self.hold = lock_hold.labels(name)
+        self.acquired = 0.0
+
+    def acquire(self, blocking=True, timeout=-1):
+        t0 = time.perf_counter()
+        ret = self.lock.acquire(blocking, timeout)
+        if ret:
+            # Only the owner writes self.acquired.
+            self.acquired = time.perf_counter()
+            self.wait.observe(self.acquired - t0)
+        return ret
+
+    def release(self):
+        held = time.perf_counter() - self.acquired
+        self.lock.release()
+        self.hold.observe(held)
+
+    def locked(self):
+        return self.lock.locked()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class CommandTimer(monitoring.CommandListener):
+    """Records the duration of the MongoDB commands. Pass it in the
+    event_listeners of the MongoClient."""
+
+    def __init__(self):
+        # The collection is only known from the started event.
+        self.collections = {}
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        self.collections[event.request_id] = (
+            collection if isinstance(collection, str) else ""
+        )
+
+    def succeeded(self, event):
+        collection = self.collections.pop(event.request_id, "")
+        mongo_duration.labels(event.command_name, collection).observe(
+            event.duration_micros / 1e6
+        )
+
+    def failed(self, event):
+        collection = self.collections.pop(event.request_id, "")
+        mongo_duration.labels(event.command_name, collection).observe(
+            event.duration_micros / 1e6
+        )
+        mongo_failures.labels(event.command_name, collection).inc()
@@ -1,4 +1,5 @@
 import copy
+import heapq
 import math
 import os
 import random
@@ -8,11 +9,15 @@ import sys
 import threading
 import time
 import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 
 import fishtest.stats.stat_util
+from bson import BSON
 from bson.binary import Binary
 from bson.objectid import ObjectId
+from fishtest import metrics
 from fishtest.actiondb import ActionDb
 from fishtest.userdb import UserDb
 from fishtest.util import (
@@ -21,14 +26,24 @@ from fishtest.util import (
     format_bounds,
     format_results,
     get_bad_workers,
-    get_chi2,
+    get_chi2_counts,
+    get_chi2_from_counts,
     post_in_fishcooking_results,
     remaining_hours,
+    update_chi2_counts,
     update_residuals,
     worker_name,
 )
 from fishtest.views import del_tasks
-from pymongo import DESCENDING, MongoClient
+from pymongo import (
+    ASCENDING,
+    DESCENDING,
+    DeleteMany,
+    MongoClient,
+    ReplaceOne,
+    UpdateOne,
+)
+from pymongo.errors import BulkWriteError
 
 DEBUG = False
 
@@ -36,23 +51,90 @@ boot_time = datetime.utcnow()
 
 last_rundb = None
 
+run_cache_hits = metrics.registry.counter(
+    "fishtest_run_cache_hits_total", "Number of runs found in the run cache."
+)
+run_cache_misses = metrics.registry.counter(
+    "fishtest_run_cache_misses_total", "Number of runs loaded from the db."
+)
+request_task_busy = metrics.registry.counter(
+    "fishtest_request_task_busy_total",
+    "Number of task requests rejected because the scheduler was too busy.",
+)
+
 
 class RunDb:
-    def __init__(self, db_name="fishtest_new"):
+    def __init__(
+        self, db_name="fishtest_new", is_primary_instance=True, server_threads=4
+    ):
         # MongoDB server is assumed to be on the same machine, if not user should
         # use ssh with port forwarding to access the remote host.
-        self.conn = MongoClient(os.getenv("FISHTEST_HOST") or "localhost")
+        self.conn = MongoClient(
+            os.getenv("FISHTEST_HOST") or "localhost",
+            event_listeners=[metrics.CommandTimer()],
+        )
         self.db = self.conn[db_name]
         self.userdb = UserDb(self.db)
         self.actiondb = ActionDb(self.db)
         self.pgndb = self.db["pgns"]
         self.nndb = self.db["nns"]
         self.runs = self.db["runs"]
-        self.deltas = self.db["deltas"]
+        self.tasks = self.db["tasks"]
         self.task_runs = []
 
+        # Only the primary instance serves the workers, so only its run
+        # cache and in-memory indexes are up to date, see api.py. The other
+        # instances read from the db.
+        self.is_primary_instance = is_primary_instance
+
+        # Admission control of request_task(). At most half of the threads
+        # of the server handle task requests, the others stay available for
+        # the updates and beats of the workers.
+        self.task_limit_max = max(1, server_threads // 2)
+
+        # Scheduler index, see rebuild_scheduler_index().
+        self.scheduler_lock = metrics.TimedLock("scheduler_lock")
+        self.connections_counter = {}
+        self.task_counters = {}
+
+        # Liveness index, see task_liveness().
+        self.liveness_lock = metrics.TimedLock("liveness_lock")
+        self.liveness = {}
+        self.deadlines = []
+        self.task_timeout = timedelta(minutes=3)
+        self.beats = {}
+        self.beats_time = time.time()
+        self.beats_period = 60
+
+        # Summaries of the unfinished runs, see get_run_summaries().
+        self.summaries_lock = threading.Lock()
+        self.summaries_build_lock = threading.Lock()
+        self.summaries = {}
+        self.summaries_dirty = set()
+        self.summaries_time = 0
+        self.summaries_rebuild_period = 600
+
+        # Per-user counters not yet written to the db, see count_user().
+        self.user_stats_lock = threading.Lock()
+        self.user_stats = {}
+        self.user_stats_time = time.time()
+        self.user_stats_period = 60
+
+        # Per-worker chi2 tables of the runs, see get_chi2(). The
+        # chi2_lock only protects the dict, each run has its own lock.
+        self.chi2_lock = threading.Lock()
+        self.chi2_counts = {}
+
+        # Cached counts of the finished runs, see get_finished_runs().
+        self.finished_counts_lock = threading.Lock()
+        self.finished_counts = OrderedDict()
+        self.finished_counts_maxsize = 1000
+        self.finished_counts_period = 3600
+
         self.task_duration = 900  # 15 minutes
 
+        self.register_metrics()
+
         global last_rundb
         last_rundb = self
 
@@ -184,22 +266,9 @@ class RunDb:
         if rescheduled_from:
             new_run["rescheduled_from"] = rescheduled_from
 
-        return self.runs.insert_one(new_run).inserted_id
-
-    def get_machines(self):
-        machines = []
-        active_runs = self.runs.find(
-            {"finished": False, "tasks": {"$elemMatch": {"active": True}}},
-            sort=[("last_updated", DESCENDING)],
-        )
-        for run in active_runs:
-            for task in run["tasks"]:
-                if task["active"]:
-                    machine = copy.copy(task["worker_info"])
-                    machine["last_updated"] = task.get("last_updated", None)
-                    machine["run"] = run
-                    machines.append(machine)
-        return machines
+        run_id = self.runs.insert_one(self.run_doc(new_run)).inserted_id
+        self.mark_summary_dirty(run_id)
+        return run_id
 
     def get_pgn(self, pgn_id):
         pgn_id = pgn_id.split(".")[0]  # strip .pgn
@@ -208,6 +277,67 @@ class RunDb:
             return zlib.decompress(pgn["pgn_zip"]).decode()
         return None
 
+    pgn_chunk_size = 65536
+
+    def iter_pgn_zip(self, pgn_zip):
+        # Decompresses a PGN incrementally, yielding at most pgn_chunk_size
+        # bytes at a time, so that the text is never fully held in memory.
+        decompressor = zlib.decompressobj()
+        data = pgn_zip
+        while data:
+            chunk = decompressor.decompress(data, self.pgn_chunk_size)
+            if chunk:
+                yield chunk
+            data = decompressor.unconsumed_tail
+        chunk = decompressor.flush()
+        if chunk:
+            yield chunk
+
+    def iter_pgn(self, pgn_id):
+        # Like get_pgn() but returns an iterator over the decompressed bytes.
+        pgn_id = pgn_id.split(".")[0]  # strip .pgn
+        pgn = self.pgndb.find_one({"run_id": pgn_id})
+        if pgn:
+            return self.iter_pgn_zip(pgn["pgn_zip"])
+        return None
+
+    def pgn_query(self, run_ids):
+        # The PGNs of a task are stored as "<run_id>-<task_id>", so the
+        # PGNs of whole runs are selected with anchored prefix patterns,
+        # which are served by the run_id index.
+        return {
+            "run_id": {
+                "$in": [
+                    re.compile("^" + re.escape(str(r_id)) + "-") for r_id in run_ids
+                ]
+            }
+        }
+
+    def iter_run_pgns(self, run_id):
+        # Returns an iterator over the decompressed PGNs of all the tasks
+        # of a run, in the order of the tasks, or None if there are none.
+        # The PGN documents are fetched one at a time.
+        run_id = run_id.split(".")[0]  # strip .pgn
+        pgns = list(self.pgndb.find(self.pgn_query([run_id]), {"run_id": 1}))
+        if not pgns:
+            return None
+        pgns.sort(key=lambda p: (int(p["run_id"].split("-")[1]), p["_id"]))
+
+        def iter_pgns():
+            for p in pgns:
+                pgn = self.pgndb.find_one({"_id": p["_id"]})
+                if pgn:
+                    yield from self.iter_pgn_zip(pgn["pgn_zip"])
+
+        return iter_pgns()
+
+    def purge_pgns(self, run_ids):
+        # Deletes the PGNs of the given runs with a single delete_many.
+        # Returns the number of deleted PGNs.
+        if not run_ids:
+            return 0
+        return self.pgndb.delete_many(self.pgn_query(run_ids)).deleted_count
+
     def get_pgn_100(self, skip):
         return [
             p["run_id"]
@@ -240,11 +370,32 @@ class RunDb:
         ]
 
     # Cache runs
-    run_cache = {}
-    run_cache_lock = threading.Lock()
-    run_cache_write_lock = threading.Lock()
+    # The cache is sharded by run id. The shard locks only protect the
+    # dictionaries and are never held during db operations. The write
+    # locks serialize the db writes of the runs in a shard, together with
+    # the reads of the values that they send, so that a newer version of a
+    # run is never overwritten by an older one.
+    run_cache_shards = 16
+    run_cache = [{} for i in range(run_cache_shards)]
+    run_cache_locks = [
+        metrics.TimedLock("run_cache_lock") for i in range(run_cache_shards)
+    ]
+    run_cache_write_locks = [threading.Lock() for i in range(run_cache_shards)]
+
+    # Statistics of the flusher: the number of flushes, of written runs
+    # (and how many were written in full) and of bytes sent. "lag" is the
+    # age in seconds of the oldest change written by the last flush.
+    flush_stats = {
+        "flushes": 0,
+        "runs": 0,
+        "replaced": 0,
+        "bytes": 0,
+        "lag": 0.0,
+        "max_lag": 0.0,
+    }
 
     timer = None
+    timer_lock = threading.Lock()
 
     # handle termination
     def exit_run(signum, frame):
@@ -256,60 +407,385 @@ class RunDb:
     signal.signal(signal.SIGINT, exit_run)
     signal.signal(signal.SIGTERM, exit_run)
 
+    def run_cache_shard(self, r_id):
+        # Returns the cache, the lock and the write lock of the shard
+        # containing the run with id r_id.
+        i = zlib.crc32(r_id.encode()) % self.run_cache_shards
+        return (
+            self.run_cache[i],
+            self.run_cache_locks[i],
+            self.run_cache_write_locks[i],
+        )
+
     def get_run(self, r_id):
-        with self.run_cache_lock:
-            r_id = str(r_id)
-            if r_id in self.run_cache:
-                self.run_cache[r_id]["rtime"] = time.time()
-                return self.run_cache[r_id]["run"]
-            try:
-                run = self.runs.find_one({"_id": ObjectId(r_id)})
-                if DEBUG:
-                    print("Load", r_id, flush=True)
-                if run:
-                    self.run_cache[r_id] = {
-                        "rtime": time.time(),
-                        "ftime": time.time(),
-                        "run": run,
-                        "dirty": False,
-                    }
-                return run
-            except:
-                return None
+        r_id = str(r_id)
+        cache, lock, _ = self.run_cache_shard(r_id)
+        with lock:
+            if r_id in cache:
+                cache[r_id]["rtime"] = time.time()
+                run_cache_hits.inc()
+                return cache[r_id]["run"]
+        run_cache_misses.inc()
+        try:
+            run = self.runs.find_one({"_id": ObjectId(r_id)})
+            if DEBUG:
+                print("Load", r_id, flush=True)
+        except:
+            return None
+        if not run:
+            return run
+        # A run that still embeds its tasks is migrated by writing it.
+        migrate = self.separate_tasks and not self.load_tasks(run)
+        with lock:
+            # Another thread may have loaded the run in the meantime.
+            # Make sure everybody uses the same object.
+            if r_id in cache:
+                cache[r_id]["rtime"] = time.time()
+                return cache[r_id]["run"]
+            cache[r_id] = {
+                "rtime": time.time(),
+                "ftime": time.time(),
+                "run": run,
+                "status": self.finished_status(run),
+                "dirty": False,
+                "fields": set(),
+                "version": 0,
+            }
+            if migrate:
+                self.mark_dirty(cache[r_id])
+            return run
+
+    # With FISHTEST_SEPARATE_TASKS set, the tasks and bad_tasks of a run
+    # are stored in the "tasks" collection, one document per task, instead
+    # of in the run document. This keeps the run documents small and far
+    # from the 16MB limit, and a partial write of a task only touches the
+    # document of that task. Runs that embed their tasks are migrated when
+    # they are loaded, or in bulk by utils/migrate_tasks.py.
+    #
+    # This is only a storage split. In memory a run still has all its
+    # tasks: load_tasks() reads every task, finished or not, of every run
+    # that gets cached, since the task ids are the positions in the lists.
+    # The memory use and the cost of loading a run are unchanged.
+    #
+    # The writes to the two collections are not atomic. The tasks are
+    # always written before the run, so after a failure the tasks may be
+    # newer than the run, e.g. a task without its results in the run
+    # totals, which the next flush of the run repairs. The run never
+    # refers to tasks that are missing.
+    separate_tasks = os.getenv("FISHTEST_SEPARATE_TASKS") is not None
+
+    def run_doc(self, run):
+        # The run as stored in the runs collection.
+        if not self.separate_tasks:
+            return run
+        return {k: v for k, v in run.items() if k not in ("tasks", "bad_tasks")}
+
+    def task_doc_id(self, r_id, task_id, bad=False):
+        return "{}/{}{}".format(r_id, "bad/" if bad else "", task_id)
+
+    def task_doc(self, r_id, task_id, task, bad=False):
+        return {
+            "_id": self.task_doc_id(r_id, task_id, bad),
+            "run_id": r_id,
+            "task_id": task_id,
+            "bad": bad,
+            "task": task,
+        }
+
+    def load_tasks(self, run):
+        # Fills in all the tasks of a run read from the runs collection.
+        # Returns False if the run embeds its tasks.
+        if "tasks" in run:
+            return False
+        r_id = str(run["_id"])
+        run["tasks"] = []
+        for doc in self.tasks.find(
+            {"run_id": r_id}, sort=[("bad", ASCENDING), ("task_id", ASCENDING)]
+        ):
+            if doc["bad"]:
+                run.setdefault("bad_tasks", []).append(doc["task"])
+            else:
+                run["tasks"].append(doc["task"])
+        return True
+
+    def all_task_ops(self, r_id, run):
+        # Write operations for the tasks collection that store all tasks
+        # of a run.
+        ops = []
+        for key, bad in (("tasks", False), ("bad_tasks", True)):
+            tasks = run.get(key, [])
+            for task_id, task in enumerate(tasks):
+                ops.append(
+                    ReplaceOne(
+                        {"_id": self.task_doc_id(r_id, task_id, bad)},
+                        self.task_doc(r_id, task_id, task, bad),
+                        upsert=True,
+                    )
+                )
+            # Tasks may have been removed, e.g. by purge_run().
+            ops.append(
+                DeleteMany(
+                    {"run_id": r_id, "bad": bad, "task_id": {"$gte": len(tasks)}}
+                )
+            )
+        return ops
+
+    def is_task_field(self, field):
+        return field.split(".")[0] in ("tasks", "bad_tasks")
+
+    def flush_task_ops(self, r_id, entry):
+        # Write operations for the tasks collection corresponding to
+        # entry["fields"], see flush_op().
+        if not self.separate_tasks:
+            return []
+        run = entry["run"]
+        fields = entry["fields"]
+        if fields is None:
+            return self.all_task_ops(r_id, run)
+        replace = {}
+        update = {}
+        try:
+            # Sorting puts a task before its sub paths.
+            for field in sorted(f for f in fields if self.is_task_field(f)):
+                key, task_id, *path = field.split(".")
+                task_id = int(task_id)
+                bad = key == "bad_tasks"
+                doc_id = self.task_doc_id(r_id, task_id, bad)
+                if not path:
+                    replace[doc_id] = self.task_doc(
+                        r_id, task_id, run[key][task_id], bad
+                    )
+                elif doc_id not in replace:
+                    update.setdefault(doc_id, {})[".".join(["task"] + path)] = (
+                        self.get_field(run, field)
+                    )
+        except (KeyError, IndexError, ValueError, TypeError):
+            # E.g. "tasks" as a whole.
+            return self.all_task_ops(r_id, run)
+        return [
+            ReplaceOne({"_id": doc_id}, doc, upsert=True)
+            for doc_id, doc in replace.items()
+        ] + [
+            UpdateOne({"_id": doc_id}, {"$set": fields})
+            for doc_id, fields in update.items()
+        ]
 
     def start_timer(self):
         self.timer = threading.Timer(1.0, self.flush_buffers)
         self.timer.start()
 
-    def buffer(self, run, flush):
-        with self.run_cache_lock:
+    def mark_dirty(self, entry, fields=None):
+        # "fields" is a set of paths (in dot notation) of the parts of
+        # the run that have changed since the last write. None means that
+        # the entire document has to be written.
+        # "ftime" is the time of the oldest unwritten change.
+        # "version" is used by the flusher to detect changes made while
+        # it was writing.
+        if not entry["dirty"]:
+            entry["dirty"] = True
+            entry["ftime"] = time.time()
+            entry["fields"] = set()
+        if fields is None or entry["fields"] is None:
+            entry["fields"] = None
+        else:
+            entry["fields"].update(fields)
+        entry["version"] += 1
+
+    def buffer(self, run, flush, fields=None):
+        # If "fields" is given, it should list the paths of the parts
+        # of the run that have been modified, e.g. ["tasks.3", "results"].
+        # The flusher will then only write those.
+        with self.timer_lock:
             if self.timer is None:
                 self.start_timer()
-            r_id = str(run["_id"])
-            if flush:
-                self.run_cache[r_id] = {
+        r_id = str(run["_id"])
+        self.mark_summary_dirty(r_id)
+        status = self.finished_status(run)
+        cache, lock, write_lock = self.run_cache_shard(r_id)
+        if flush:
+            with lock:
+                old_status = cache.get(r_id, {}).get("status")
+                cache[r_id] = {
                     "dirty": False,
                     "rtime": time.time(),
                     "ftime": time.time(),
                     "run": run,
+                    "status": status,
+                    "fields": set(),
+                    "version": 0,
                 }
-                with self.run_cache_write_lock:
-                    self.runs.replace_one({"_id": ObjectId(r_id)}, run)
+            with write_lock:
+                # The tasks are written first, see flush_shard().
+                if self.separate_tasks:
+                    self.tasks.bulk_write(self.all_task_ops(r_id, run), ordered=False)
+                self.runs.replace_one({"_id": ObjectId(r_id)}, self.run_doc(run))
+        else:
+            with lock:
+                entry = cache.get(r_id, None)
+                old_status = None if entry is None else entry.get("status")
+                if entry is None or entry["run"] is not run:
+                    # We do not know what is in the db.
+                    entry = {
+                        "dirty": False,
+                        "ftime": time.time(),
+                        "run": run,
+                        "fields": set(),
+                        "version": 0,
+                    }
+                    fields = None
+                entry["rtime"] = time.time()
+                entry["status"] = status
+                self.mark_dirty(entry, fields)
+                cache[r_id] = entry
+        if old_status is not None and old_status != status:
+            self.update_finished_counts(old_status, status)
+
+    def get_field(self, run, field):
+        value = run
+        for key in field.split("."):
+            if isinstance(value, list):
+                value = value[int(key)]
             else:
-                if r_id in self.run_cache:
-                    ftime = self.run_cache[r_id]["ftime"]
-                else:
-                    ftime = time.time()
-                self.run_cache[r_id] = {
-                    "dirty": True,
-                    "rtime": time.time(),
-                    "ftime": ftime,
-                    "run": run,
-                }
+                value = value[key]
+        return value
+
+    def flush_op(self, r_id, entry):
+        # Returns a write operation for bulk_write() and the document
+        # that it sends. With separate tasks the operation is None if
+        # only tasks have changed, see flush_task_ops().
+        run = entry["run"]
+        fields = entry["fields"]
+        if fields is not None and self.separate_tasks:
+            fields = [f for f in fields if not self.is_task_field(f)]
+            if not fields:
+                return None, None
+        if fields is not None:
+            update = {}
+            try:
+                # Sorting puts a path before its sub paths.
+                for field in sorted(fields):
+                    if not any(field.startswith(f + ".") for f in update):
+                        update[field] = self.get_field(run, field)
+            except (KeyError, IndexError, ValueError, TypeError):
+                fields = None
+            if fields is not None:
+                update = {"$set": update}
+                return UpdateOne({"_id": ObjectId(r_id)}, update), update
+        run = self.run_doc(run)
+        return ReplaceOne({"_id": ObjectId(r_id)}, run), run
+
+    def update_flush_stats(self, ops, now):
+        # ops is a list of (entry, version, operation, document).
+        if not ops:
+            return
+        stats = self.flush_stats
+        lag = max(now - entry["ftime"] for entry, _, _, _ in ops)
+        stats["flushes"] += 1
+        stats["runs"] += len(ops)
+        stats["replaced"] += sum(isinstance(op, ReplaceOne) for _, _, op, _ in ops)
+        stats["bytes"] += sum(
+            len(BSON.encode(doc)) for _, _, _, doc in ops if doc is not None
+        )
+        stats["lag"] = lag
+        stats["max_lag"] = max(stats["max_lag"], lag)
+
+    def flush_backlog(self):
+        # Returns the number of dirty runs and the age in seconds of the
+        # oldest change not yet written.
+        now = time.time()
+        dirty = 0
+        age = 0.0
+        for cache, lock in zip(self.run_cache, self.run_cache_locks):
+            with lock:
+                for entry in cache.values():
+                    if entry["dirty"]:
+                        dirty += 1
+                        age = max(age, now - entry["ftime"])
+        return dirty, age
+
+    def register_metrics(self):
+        # The values kept by RunDb anyway are read when /api/metrics is
+        # requested, see fishtest/metrics.py.
+        registry = metrics.registry
+        registry.gauge(
+            "fishtest_run_cache_runs",
+            "Number of runs in the run cache.",
+            lambda: sum(len(cache) for cache in self.run_cache),
+        )
+        registry.gauge(
+            "fishtest_flush_backlog_runs",
+            "Number of runs with changes not yet written to the db.",
+            lambda: self.flush_backlog()[0],
+        )
+        registry.gauge(
+            "fishtest_flush_backlog_age_seconds",
+            "Age of the oldest change not yet written to the db.",
+            lambda: self.flush_backlog()[1],
+        )
+        for name, key, help in (
+            ("flushes", "flushes", "Number of flushes writing at least one run."),
+            ("flush_runs", "runs", "Number of run writes."),
+            ("flush_replaced", "replaced", "Number of full run writes."),
+            ("flush_bytes", "bytes", "Number of bytes of the written documents."),
+        ):
+            registry.counter(
+                "fishtest_{}_total".format(name),
+                help,
+                fn=lambda key=key: self.flush_stats[key],
+            )
+        registry.gauge(
+            "fishtest_flush_lag_seconds",
+            "Age of the oldest change written by the last flush.",
+            lambda: self.flush_stats["lag"],
+        )
+        registry.gauge(
+            "fishtest_flush_max_lag_seconds",
+            "Largest value of fishtest_flush_lag_seconds.",
+            lambda: self.flush_stats["max_lag"],
+        )
+        registry.gauge(
+            "fishtest_request_task_limit",
+            "Number of task requests admitted concurrently.",
+            self.task_limit,
+        )
+        registry.gauge(
+            "fishtest_request_task_active",
+            "Number of task requests being handled.",
+            lambda: self.task_active,
+        )
+        registry.gauge(
+            "fishtest_request_task_latency_ewma_seconds",
+            "Moving average of the time to handle a task request.",
+            lambda: self.task_latency_ewma,
+        )
+        registry.gauge(
+            "fishtest_user_stats_pending_users",
+            "Number of users with counters not yet written to the db.",
+            lambda: len(self.user_stats),
+        )
+        registry.gauge(
+            "fishtest_update_time_ewma_seconds",
+            "Moving average of the time to handle a task update.",
+            lambda: self.update_time_ewma,
+        )
+        stat_util = fishtest.stats.stat_util
+        for key in ("hits", "misses"):
+            registry.counter(
+                "fishtest_sprt_elo_cache_{}_total".format(key),
+                "Number of SPRT elo computations {} in the cache.".format(
+                    "found" if key == "hits" else "not found"
+                ),
+                fn=lambda key=key: stat_util.SPRT_elo_cache_stats[key],
+            )
+        registry.gauge(
+            "fishtest_sprt_elo_cache_entries",
+            "Number of entries in the SPRT elo cache.",
+            lambda: len(stat_util.SPRT_elo_cache),
+        )
 
     def stop(self):
         self.flush_all()
-        with self.run_cache_lock:
+        with self.timer_lock:
             self.timer = None
         time.sleep(1.1)
 
@@ -317,110 +793,561 @@ class RunDb:
         print("flush", flush=True)
         # Note that we do not grab locks because this method is
         # called from a signal handler and grabbing locks might deadlock
-        for r_id in list(self.run_cache):
-            entry = self.run_cache.get(r_id, None)
-            if entry is not None and entry["dirty"]:
-                self.runs.replace_one({"_id": ObjectId(r_id)}, entry["run"])
-                print(".", end="", flush=True)
+        ops = []
+        task_ops = []
+        for cache in self.run_cache:
+            for r_id in list(cache):
+                entry = cache.get(r_id, None)
+                if entry is not None and entry["dirty"]:
+                    ops.append(self.flush_op(r_id, entry)[0])
+                    task_ops += self.flush_task_ops(r_id, entry)
+                    entry["dirty"] = False
+                    entry["fields"] = set()
+                    print(".", end="", flush=True)
+        ops = [op for op in ops if op is not None]
+        if task_ops:
+            self.tasks.bulk_write(task_ops, ordered=False)
+        if ops:
+            self.runs.bulk_write(ops, ordered=False)
+        self.flush_beats()
+        self.flush_user_stats()
         print("done", flush=True)
 
+    def flush_shard(self, cache, lock, write_lock, now):
+        # Write the dirty runs of a shard using a single bulk_write.
+        # Returns the written entries.
+        ops = []
+        task_ops = []
+        # The operations are built under the write lock. Otherwise a run
+        # written in full by buffer(run, True) in the meantime would be
+        # overwritten by the older values that they copy.
+        with write_lock:
+            with lock:
+                for r_id in list(cache):
+                    entry = cache[r_id]
+                    if entry["dirty"]:
+                        ops.append(
+                            (entry, entry["version"]) + self.flush_op(r_id, entry)
+                        )
+                        task_ops += self.flush_task_ops(r_id, entry)
+                    elif entry["rtime"] < now - 300:
+                        del cache[r_id]
+                        with self.chi2_lock:
+                            self.chi2_counts.pop(r_id, None)
+            if not ops:
+                return ops
+            try:
+                # The tasks are written before the runs. A run that still
+                # embeds its tasks is replaced by a document without them,
+                # so they must not be lost if the second write fails.
+                if task_ops:
+                    self.tasks.bulk_write(task_ops, ordered=False)
+                run_ops = [op for _, _, op, _ in ops if op is not None]
+                if run_ops:
+                    self.runs.bulk_write(run_ops, ordered=False)
+            except Exception:
+                # Write the full documents on the next attempt.
+                with lock:
+                    for entry, _, _, _ in ops:
+                        entry["fields"] = None
+                raise
+        with lock:
+            for entry, version, _, _ in ops:
+                if entry["version"] == version:
+                    entry["dirty"] = False
+                    entry["fields"] = set()
+                else:
+                    # Modified during the write. The fields collected
+                    # so far are simply written again.
+                    entry["ftime"] = now
+        return ops
+
     def flush_buffers(self):
+        # Write all dirty runs to the db and mark the tasks without
+        # recent updates as inactive. No lock is held during db operations.
         if self.timer is None:
             return
         try:
-            self.run_cache_lock.acquire()
             now = time.time()
-            old = now + 1
-            oldest = None
-            for r_id in list(self.run_cache):
-                if not self.run_cache[r_id]["dirty"]:
-                    if not self.run_cache[r_id]["run"].get("finished", False) and (
-                        "scavenge" not in self.run_cache[r_id]
-                        or self.run_cache[r_id]["scavenge"] < now - 60
-                    ):
-                        self.run_cache[r_id]["scavenge"] = now
-                        if self.scavenge(self.run_cache[r_id]["run"]):
-                            with self.run_cache_write_lock:
-                                self.runs.replace_one(
-                                    {"_id": ObjectId(r_id)}, self.run_cache[r_id]["run"]
-                                )
-                    if self.run_cache[r_id]["rtime"] < now - 300:
-                        del self.run_cache[r_id]
-                elif self.run_cache[r_id]["ftime"] < old:
-                    old = self.run_cache[r_id]["ftime"]
-                    oldest = r_id
-            # print(oldest)
-            if oldest is not None:
-                self.scavenge(self.run_cache[oldest]["run"])
-                self.run_cache[oldest]["scavenge"] = now
-                self.run_cache[oldest]["dirty"] = False
-                self.run_cache[oldest]["ftime"] = time.time()
-                # print("SYNC")
-                with self.run_cache_write_lock:
-                    self.runs.replace_one(
-                        {"_id": ObjectId(oldest)}, self.run_cache[oldest]["run"]
-                    )
-        except:
-            print("Flush exception", flush=True)
+            finished = []
+            for cache, lock in zip(self.run_cache, self.run_cache_locks):
+                with lock:
+                    for r_id, entry in cache.items():
+                        if entry["run"].get("finished", False):
+                            finished.append(r_id)
+            with self.liveness_lock:
+                for r_id in finished:
+                    self.liveness.pop(r_id, None)
+            self.scavenge()
+            ops = []
+            for shard in zip(
+                self.run_cache, self.run_cache_locks, self.run_cache_write_locks
+            ):
+                ops += self.flush_shard(*shard, now)
+            self.update_flush_stats(ops, time.time())
+            if now > self.beats_time + self.beats_period:
+                self.beats_time = now
+                self.flush_beats()
+            if now > self.user_stats_time + self.user_stats_period:
+                self.user_stats_time = now
+                self.flush_user_stats()
+        except Exception as e:
+            print("Flush exception: {}".format(str(e)), flush=True)
         finally:
             # Restart timer:
-            self.run_cache_lock.release()
-            self.start_timer()
+            with self.timer_lock:
+                if self.timer is not None:
+                    self.start_timer()
+
+    def task_liveness(self, run):
+        # Returns the liveness index of a run: a dict mapping the task_id
+        # of each active task to a machine, i.e. a copy of the worker_info
+        # with the time we last heard from the worker ("last_updated")
+        # and a summary of the run. Together these form the registry of
+        # live machines, see get_machines().
+        # It is built from run["tasks"] on first use and kept up to date
+        # by request_task(), update_task(), beat() and set_inactive_task().
+        # Should be called with self.liveness_lock held.
+        r_id = str(run["_id"])
+        liveness = self.liveness.get(r_id)
+        if liveness is None:
+            liveness = {}
+            self.liveness[r_id] = liveness
+            for task_id, task in enumerate(run["tasks"]):
+                if task["active"]:
+                    self.register_machine(run, task_id)
+        return liveness
 
-    def scavenge(self, run):
-        if datetime.utcnow() < boot_time + timedelta(seconds=150):
-            return False
-        # print("scavenge ", run["_id"])
-        dead_task = False
-        old = datetime.utcnow() - timedelta(minutes=3)
-        task_id = -1
-        run_id = str(run["_id"])
-        for task in run["tasks"]:
-            task_id += 1
-            if task["active"] and task["last_updated"] < old:
-                task["active"] = False
-                dead_task = True
-                print(
-                    "dead task: run: https://tests.stockfishchess.org/tests/view/{} task_id: {} worker: {}".format(
-                        run["_id"], task_id, worker_name(task["worker_info"])
-                    ),
-                    flush=True,
+    def register_machine(self, run, task_id):
+        # Should be called with self.liveness_lock held.
+        task = run["tasks"][task_id]
+        machine = copy.copy(task["worker_info"])
+        machine["run"] = {
+            "_id": run["_id"],
+            "args": {
+                "new_tag": run["args"]["new_tag"],
+                "tc": run["args"]["tc"],
+                "threads": run["args"].get("threads", 1),
+            },
+        }
+        machine["task_id"] = task_id
+        r_id = str(run["_id"])
+        self.liveness[r_id][task_id] = machine
+        self.set_liveness(r_id, task_id, task.get("last_updated", datetime.min))
+
+    def set_liveness(self, r_id, task_id, update_time):
+        # Should be called with self.liveness_lock held. Each call pushes
+        # a deadline on a heap. Entries which have been superseded by a
+        # later update are discarded when they come up in scavenge().
+        self.liveness[r_id][task_id]["last_updated"] = update_time
+        heapq.heappush(self.deadlines, (update_time + self.task_timeout, r_id, task_id))
+
+    def touch_task(self, run, task_id):
+        # Registers a new task, or new worker_info for an existing one.
+        with self.liveness_lock:
+            self.task_liveness(run)
+            self.register_machine(run, task_id)
+
+    def beat(self, run, task_id):
+        # A heartbeat does not dirty the run. It is recorded in the
+        # liveness index and the beats are written to the db in bulk
+        # by flush_beats().
+        task = run["tasks"][task_id]
+        update_time = datetime.utcnow()
+        task["last_updated"] = update_time
+        with self.liveness_lock:
+            if task["active"]:
+                if task_id in self.task_liveness(run):
+                    self.set_liveness(str(run["_id"]), task_id, update_time)
+                else:
+                    self.register_machine(run, task_id)
+            self.beats[(str(run["_id"]), task_id)] = update_time
+
+    def get_machines(self):
+        # A snapshot of the live machines from the liveness index.
+        if not self.is_primary_instance:
+            # The liveness index is only fed on the primary instance.
+            return self.scan_machines()
+        with self.liveness_lock:
+            machines = [
+                copy.copy(machine)
+                for liveness in self.liveness.values()
+                for machine in liveness.values()
+            ]
+        machines.sort(key=lambda m: m["last_updated"], reverse=True)
+        return machines
+
+    def scan_machines(self):
+        # Like get_machines() but reads the runs from the db. For use
+        # outside the primary instance, where the liveness index is empty.
+        if self.separate_tasks:
+            return self.scan_machines_tasks()
+        machines = []
+        active_runs = self.runs.find(
+            {"finished": False, "tasks": {"$elemMatch": {"active": True}}},
+            {
+                "args.new_tag": 1,
+                "args.tc": 1,
+                "args.threads": 1,
+                "tasks.active": 1,
+                "tasks.worker_info": 1,
+                "tasks.last_updated": 1,
+            },
+            sort=[("last_updated", DESCENDING)],
+        )
+        for run in active_runs:
+            for task_id, task in enumerate(run["tasks"]):
+                if task["active"]:
+                    machine = copy.copy(task["worker_info"])
+                    machine["last_updated"] = task.get("last_updated", None)
+                    machine["run"] = run
+                    machine["task_id"] = task_id
+                    machines.append(machine)
+        return machines
+
+    def scan_machines_tasks(self):
+        # scan_machines() for separate tasks.
+        tasks = list(
+            self.tasks.find(
+                {"bad": False, "task.active": True},
+                {
+                    "run_id": 1,
+                    "task_id": 1,
+                    "task.worker_info": 1,
+                    "task.last_updated": 1,
+                },
+            )
+        )
+        runs = {
+            str(run["_id"]): run
+            for run in self.runs.find(
+                {
+                    "_id": {"$in": list({ObjectId(t["run_id"]) for t in tasks})},
+                    "finished": False,
+                },
+                {"args.new_tag": 1, "args.tc": 1, "args.threads": 1},
+            )
+        }
+        machines = []
+        for doc in tasks:
+            if doc["run_id"] in runs:
+                machine = copy.copy(doc["task"]["worker_info"])
+                machine["last_updated"] = doc["task"].get("last_updated", None)
+                machine["run"] = runs[doc["run_id"]]
+                machine["task_id"] = doc["task_id"]
+                machines.append(machine)
+        return machines
+
+    def machines_totals(self, machines):
+        cores = 0
+        nps = 0
+        games_per_minute = 0.0
+        for machine in machines:
+            concurrency = int(machine["concurrency"])
+            cores += concurrency
+            nps += concurrency * machine["nps"]
+            if machine["nps"] != 0:
+                args = machine["run"]["args"]
+                games_per_minute += (
+                    (machine["nps"] / 1280000.0)
+                    * (60.0 / estimate_game_duration(args["tc"]))
+                    * (concurrency // args.get("threads", 1))
+                )
+        return {
+            "machines": len(machines),
+            "cores": cores,
+            "nps": nps,
+            "games_per_minute": games_per_minute,
+        }
+
+    def flush_beats(self):
+        # Write the heartbeats received since the last call using a
+        # single bulk_write with one partial update per run.
+        # The beats are not written under the shard write locks, so $max
+        # makes sure that an older beat never overwrites a newer
+        # last_updated written by the flusher. The filter makes sure that
+        # the tasks are already in the db, otherwise $set would pad the
+        # tasks array with nulls.
+        with self.liveness_lock:
+            beats, self.beats = self.beats, {}
+        if not beats:
+            return
+        try:
+            if self.separate_tasks:
+                ops = [
+                    UpdateOne(
+                        {"_id": self.task_doc_id(r_id, task_id)},
+                        {"$max": {"task.last_updated": update_time}},
+                    )
+                    for (r_id, task_id), update_time in beats.items()
+                ]
+                self.tasks.bulk_write(ops, ordered=False)
+                return
+            updates = {}
+            last_task_ids = {}
+            for (r_id, task_id), update_time in beats.items():
+                updates.setdefault(r_id, {})[
+                    "tasks.{}.last_updated".format(task_id)
+                ] = update_time
+                last_task_ids[r_id] = max(task_id, last_task_ids.get(r_id, task_id))
+            ops = [
+                UpdateOne(
+                    {
+                        "_id": ObjectId(r_id),
+                        "tasks.{}".format(last_task_ids[r_id]): {"$exists": True},
+                    },
+                    {"$max": update},
                 )
-                run = del_tasks(run)
-                run["dead_task"] = "task_id: {}, worker: {}".format(
-                    task_id, worker_name(task["worker_info"])
+                for r_id, update in updates.items()
+            ]
+            self.runs.bulk_write(ops, ordered=False)
+        except Exception:
+            # Try again with the next flush.
+            with self.liveness_lock:
+                for key, update_time in beats.items():
+                    self.beats[key] = max(update_time, self.beats.get(key, update_time))
+            raise
+
+    def count_user(self, username, update_time, cpu_hours=0.0, games=0, tests=0):
+        # Adds to the counters of a user. Besides the totals, the counters
+        # are kept in daily buckets ("days.YYYY-MM-DD") from which the
+        # rolling 30 day window of the top month is computed, see
+        # utils/delta_update_users.py. They are written to the user_stats
+        # collection by flush_user_stats().
+        day = "days." + update_time.strftime("%Y-%m-%d")
+        with self.user_stats_lock:
+            counters = self.user_stats.setdefault(
+                username, {"inc": {}, "last_updated": update_time}
+            )
+            inc = counters["inc"]
+            for key, value in (
+                ("cpu_hours", cpu_hours),
+                ("games", games),
+                ("tests", tests),
+            ):
+                if value:
+                    inc[key] = inc.get(key, 0) + value
+                    inc[day + "." + key] = inc.get(day + "." + key, 0) + value
+            if games > 0:
+                counters["last_updated"] = max(counters["last_updated"], update_time)
+
+    def flush_user_stats(self):
+        # Writes the counters accumulated since the last call using a
+        # single bulk_write with one upsert per user.
+        with self.user_stats_lock:
+            user_stats, self.user_stats = self.user_stats, {}
+        usernames = list(user_stats)
+        ops = []
+        for username in usernames:
+            counters = user_stats[username]
+            update = {"$inc": counters["inc"]}
+            if counters["inc"].get("games", 0) > 0:
+                update["$max"] = {"last_updated": counters["last_updated"]}
+            ops.append(UpdateOne({"_id": username}, update, upsert=True))
+        if not ops:
+            return
+        try:
+            self.userdb.user_stats.bulk_write(ops, ordered=False)
+        except BulkWriteError as e:
+            # The other updates have been applied.
+            failed = [usernames[error["index"]] for error in e.details["writeErrors"]]
+            self.restore_user_stats({u: user_stats[u] for u in failed})
+            raise
+        except Exception:
+            # Count them again on the next attempt. Updates that were
+            # applied anyway are counted twice, this is corrected by
+            # utils/delta_update_users.py --rescan.
+            self.restore_user_stats(user_stats)
+            raise
+
+    def restore_user_stats(self, user_stats):
+        # Merges counters that could not be written back into the
+        # pending ones, see flush_user_stats().
+        with self.user_stats_lock:
+            for username, counters in user_stats.items():
+                pending = self.user_stats.setdefault(
+                    username, {"inc": {}, "last_updated": counters["last_updated"]}
                 )
-                self.actiondb.dead_task(task["worker_info"]["username"], run)
-        return dead_task
+                for key, value in counters["inc"].items():
+                    pending["inc"][key] = pending["inc"].get(key, 0) + value
+                pending["last_updated"] = max(
+                    pending["last_updated"], counters["last_updated"]
+                )
+
+    def expired_tasks(self, now):
+        # Pops the expired deadlines. Returns a dict mapping run ids to
+        # the task_ids of the active tasks that have timed out.
+        expired = {}
+        with self.liveness_lock:
+            while self.deadlines and self.deadlines[0][0] < now:
+                deadline, r_id, task_id = heapq.heappop(self.deadlines)
+                machine = self.liveness.get(r_id, {}).get(task_id)
+                if (
+                    machine is not None
+                    and machine["last_updated"] + self.task_timeout == deadline
+                ):
+                    expired.setdefault(r_id, []).append(task_id)
+        return expired
+
+    def scavenge(self):
+        # Marks the tasks without recent updates as inactive. The work
+        # done is proportional to the number of expired deadlines. The
+        # dead tasks are recorded in the action log with one insert.
+        now = datetime.utcnow()
+        if now < boot_time + timedelta(seconds=150):
+            return
+        dead_tasks = []
+        for r_id, task_ids in self.expired_tasks(now).items():
+            run = self.get_run(r_id)
+            if run is None:
+                continue
+            fields = ["cores"]
+            # Use the same lock as update_task().
+            with self.active_run_lock(r_id):
+                for task_id in sorted(task_ids):
+                    with self.liveness_lock:
+                        # The task may have been updated in the meantime.
+                        machine = self.liveness.get(r_id, {}).get(task_id)
+                        if (
+                            machine is None
+                            or machine["last_updated"] >= now - self.task_timeout
+                        ):
+                            continue
+                    task = run["tasks"][task_id]
+                    self.set_inactive_task(task_id, run)
+                    fields.append("tasks.{}".format(task_id))
+                    print(
+                        "dead task: run: https://tests.stockfishchess.org/tests/view/{} task_id: {} worker: {}".format(
+                            r_id, task_id, worker_name(task["worker_info"])
+                        ),
+                        flush=True,
+                    )
+                    run_ = del_tasks(run)
+                    run_["dead_task"] = "task_id: {}, worker: {}".format(
+                        task_id, worker_name(task["worker_info"])
+                    )
+                    dead_tasks.append((task["worker_info"]["username"], run_))
+            if len(fields) > 1:
+                self.buffer(run, False, fields)
+        self.actiondb.dead_tasks(dead_tasks)
+
+    # Leaves out the parts of a run that are not needed by the lists of runs.
+    summary_projection = {"tasks": 0, "bad_tasks": 0, "args.spsa.param_history": 0}
+
+    # The keys that run_summary() adds to a run.
+    summary_keys = ("results_info", "remaining_hours", "workers", "state")
 
     def get_unfinished_runs_id(self):
-        with self.run_cache_write_lock:
-            unfinished_runs = self.runs.find(
-                {"finished": False}, {"_id": 1}, sort=[("last_updated", DESCENDING)]
-            )
-            return unfinished_runs
+        unfinished_runs = self.runs.find(
+            {"finished": False}, {"_id": 1}, sort=[("last_updated", DESCENDING)]
+        )
+        return unfinished_runs
 
     def get_unfinished_runs(self, username=None):
-        with self.run_cache_write_lock:
-            unfinished_runs = self.runs.find(
-                {"finished": False}, sort=[("last_updated", DESCENDING)]
-            )
-            if username:
-                unfinished_runs = [
-                    r for r in unfinished_runs if r["args"].get("username") == username
-                ]
-            return unfinished_runs
+        unfinished_runs = self.runs.find(
+            {"finished": False}, sort=[("last_updated", DESCENDING)]
+        )
+        if username:
+            unfinished_runs = [
+                r for r in unfinished_runs if r["args"].get("username") == username
+            ]
+        if self.separate_tasks:
+            unfinished_runs = list(unfinished_runs)
+            for run in unfinished_runs:
+                self.load_tasks(run)
+        return unfinished_runs
+
+    def run_summary(self, run, workers=None):
+        # A snapshot of an unfinished run without the parts that are only
+        # needed to view the run itself: the tasks and the spsa history.
+        # These are shown by the run tables and /api/active_runs.
+        # By default the number of workers comes from the liveness index.
+        # Otherwise the run was read from the db without its tasks.
+        if workers is None:
+            with self.liveness_lock:
+                workers = len(self.task_liveness(run))
+            results = self.get_results(run, False)
+        else:
+            results = run["results"]
+        summary = {
+            k: v for k, v in run.items() if k not in ("tasks", "bad_tasks", "args")
+        }
+        summary["args"] = {k: v for k, v in run["args"].items() if k != "spsa"}
+        if "spsa" in run["args"]:
+            summary["args"]["spsa"] = {
+                k: v for k, v in run["args"]["spsa"].items() if k != "param_history"
+            }
+        summary["results"] = results
+        # The summaries are shared and outlive this call, while the cached
+        # run keeps changing, so they must not share anything with it.
+        summary = copy.deepcopy(summary)
+        if "bad_tasks" in run:
+            # Keeps the shape of the run for strip_run().
+            summary["bad_tasks"] = []
+        summary["results_info"] = format_results(results, run)
+        summary["remaining_hours"] = remaining_hours(run)
+        summary["workers"] = workers
+        summary["state"] = "active" if workers > 0 else "pending"
+        return summary
+
+    def scan_run_summaries(self):
+        # get_run_summaries() outside the primary instance, whose run cache
+        # does not see the changes of the runs. The summaries are built
+        # from the db, without the tasks.
+        workers = {}
+        for machine in self.scan_machines():
+            r_id = str(machine["run"]["_id"])
+            workers[r_id] = workers.get(r_id, 0) + 1
+        summaries = []
+        for run in self.runs.find(
+            {"finished": False, "deleted": {"$ne": True}},
+            self.summary_projection,
+            sort=[("last_updated", DESCENDING)],
+        ):
+            # Left out by the projection.
+            run["bad_tasks"] = []
+            summaries.append(self.run_summary(run, workers.get(str(run["_id"]), 0)))
+        return summaries
+
+    def mark_summary_dirty(self, r_id):
+        with self.summaries_lock:
+            self.summaries_dirty.add(str(r_id))
+
+    def get_run_summaries(self):
+        # Returns the summaries of the unfinished runs. Only the summaries
+        # of the runs that went through buffer() since the last call are
+        # rebuilt. As a safety net everything is reloaded from the db every
+        # self.summaries_rebuild_period seconds.
+        if not self.is_primary_instance:
+            return self.scan_run_summaries()
+        with self.summaries_build_lock:
+            now = time.time()
+            with self.summaries_lock:
+                dirty, self.summaries_dirty = self.summaries_dirty, set()
+            if now > self.summaries_time + self.summaries_rebuild_period:
+                self.summaries_time = now
+                self.summaries = {}
+                dirty = [r["_id"] for r in self.get_unfinished_runs_id()]
+            for r_id in dirty:
+                r_id = str(r_id)
+                run = self.get_run(r_id)
+                if run is None or run["finished"] or run.get("deleted", False):
+                    self.summaries.pop(r_id, None)
+                else:
+                    self.summaries[r_id] = self.run_summary(run)
+            return list(self.summaries.values())
 
     def aggregate_unfinished_runs(self, username=None):
-        unfinished_runs = self.get_unfinished_runs(username)
         runs = {"pending": [], "active": []}
-        for run in unfinished_runs:
-            state = (
-                "active" if any(task["active"] for task in run["tasks"]) else "pending"
-            )
-            if state == "pending":
+        for summary in self.get_run_summaries():
+            if username and summary["args"].get("username") != username:
+                continue
+            # The summaries are shared, so copy before making changes.
+            run = dict(summary)
+            run["results_info"] = copy.deepcopy(summary["results_info"])
+            if run["state"] == "pending":
                 run["cores"] = 0
-            runs[state].append(run)
+            runs[run["state"]].append(run)
         runs["pending"].sort(
             key=lambda run: (
                 run["args"]["priority"],
@@ -440,19 +1367,13 @@ class RunDb:
         )
 
         # Calculate but don't save results_info on runs using info on current machines
-        cores = 0
-        nps = 0
-        for m in self.get_machines():
-            concurrency = int(m["concurrency"])
-            cores += concurrency
-            nps += concurrency * m["nps"]
+        totals = self.machines_totals(self.get_machines())
+        cores, nps = totals["cores"], totals["nps"]
         pending_hours = 0
         for run in runs["pending"] + runs["active"]:
             if cores > 0:
-                eta = remaining_hours(run) / cores
+                eta = run["remaining_hours"] / cores
                 pending_hours += eta
-            results = self.get_results(run, False)
-            run["results_info"] = format_results(results, run)
             if "Pending..." in run["results_info"]["info"]:
                 if cores > 0:
                     run["results_info"]["info"][0] += " ({:.1f} hrs)".format(eta)
@@ -464,6 +1385,61 @@ class RunDb:
                     )
         return (runs, pending_hours, cores, nps)
 
+    def finished_status(self, run):
+        # The properties of a run that decide in which lists of finished
+        # runs it appears.
+        return (
+            run.get("finished", False),
+            run["args"].get("username"),
+            run.get("is_green", False),
+            run.get("is_yellow", False),
+            run.get("tc_base", 0) >= 40,
+        )
+
+    def finished_status_matches(self, key, status):
+        username, success_only, yellow_only, ltc_only = key
+        finished, run_username, is_green, is_yellow, is_ltc = status
+        return (
+            finished
+            and (not username or username == run_username)
+            and (not success_only or is_green)
+            and (not yellow_only or is_yellow)
+            and (not ltc_only or is_ltc)
+        )
+
+    def update_finished_counts(self, old_status, new_status):
+        # Called by buffer() when a run changes status, e.g. in stop_run(),
+        # purge_run() (which may revive a run) and /tests/delete.
+        with self.finished_counts_lock:
+            for key, count in self.finished_counts.items():
+                count["count"] += self.finished_status_matches(
+                    key, new_status
+                ) - self.finished_status_matches(key, old_status)
+
+    def get_finished_runs_count(self, key, q):
+        # Only the primary instance sees the runs that change status, so
+        # the other instances can't keep their counts up to date.
+        if not self.is_primary_instance:
+            return self.runs.count_documents(q)
+        with self.finished_counts_lock:
+            count = self.finished_counts.get(key)
+            if (
+                count is not None
+                and count["time"] > time.time() - self.finished_counts_period
+            ):
+                self.finished_counts.move_to_end(key)
+                return count["count"]
+        # Runs that change status during the count_documents() may be
+        # counted twice or not at all, so the counts are refreshed once
+        # in a while.
+        count = {"count": self.runs.count_documents(q), "time": time.time()}
+        with self.finished_counts_lock:
+            self.finished_counts[key] = count
+            self.finished_counts.move_to_end(key)
+            while len(self.finished_counts) > self.finished_counts_maxsize:
+                self.finished_counts.popitem(last=False)
+        return count["count"]
+
     def get_finished_runs(
         self,
         skip=0,
@@ -472,7 +1448,11 @@ class RunDb:
         success_only=False,
         yellow_only=False,
         ltc_only=False,
+        after=None,
     ):
+        # "after" is a (last_updated, _id) pair. If given, only the runs
+        # that come after it in the sort order are returned, which unlike
+        # "skip" does not require walking the index from the start.
         q = {"finished": True}
         if username:
             q["args.username"] = username
@@ -483,20 +1463,35 @@ class RunDb:
         if yellow_only:
             q["is_yellow"] = True
 
+        key = (username, bool(success_only), bool(yellow_only), bool(ltc_only))
+        count = self.get_finished_runs_count(key, q)
+
+        if after is not None:
+            last_updated, _id = after
+            q["$or"] = [
+                {"last_updated": {"$lt": last_updated}},
+                {"last_updated": last_updated, "_id": {"$lt": _id}},
+            ]
+            skip = 0
+
+        # The lists only need a summary of each run.
         c = self.runs.find(
-            q, skip=skip, limit=limit, sort=[("last_updated", DESCENDING)]
+            q,
+            self.summary_projection,
+            skip=skip,
+            limit=limit,
+            sort=[("last_updated", DESCENDING), ("_id", DESCENDING)],
         )
 
-        count = self.runs.count_documents(q)
-
         # Don't show runs that were deleted
         runs_list = [run for run in c if not run.get("deleted")]
         return [runs_list, count]
 
-    def get_results(self, run, save_run=True):
-        if not run["results_stale"]:
-            return run["results"]
-
+    def compute_results(self, run):
+        # Full recomputation of the aggregated results from run["tasks"].
+        # run["results"] is normally kept up to date incrementally by
+        # update_results(), so this is only used for repairs and
+        # consistency checks.
         results = {"wins": 0, "losses": 0, "draws": 0, "crashes": 0, "time_losses": 0}
 
         has_pentanomial = True
@@ -518,6 +1513,14 @@ class RunDb:
         if has_pentanomial:
             results["pentanomial"] = pentanomial
 
+        return results
+
+    def get_results(self, run, save_run=True):
+        if not run["results_stale"]:
+            return run["results"]
+
+        results = self.compute_results(run)
+
         run["results_stale"] = False
         run["results"] = results
         if save_run:
@@ -525,6 +1528,42 @@ class RunDb:
 
         return results
 
+    def update_results(self, run, old_stats=None, new_stats=None):
+        # Replace the contribution old_stats of a task to run["results"]
+        # by new_stats. Either may be None (new task, removed task).
+        results = run["results"]
+        for stats, sign in ((old_stats, -1), (new_stats, 1)):
+            if stats is None:
+                continue
+            for key in ("wins", "losses", "draws", "crashes", "time_losses"):
+                results[key] = results.get(key, 0) + sign * stats.get(key, 0)
+            if "pentanomial" in results:
+                if "pentanomial" in stats:
+                    results["pentanomial"] = [
+                        results["pentanomial"][i] + sign * stats["pentanomial"][i]
+                        for i in range(0, 5)
+                    ]
+                else:
+                    del results["pentanomial"]
+            elif sign == -1 and "pentanomial" not in stats:
+                # The run may have a pentanomial again but we cannot
+                # tell without looking at all the tasks.
+                run["results_stale"] = True
+
+    def check_results(self, run):
+        # Consistency check (and repair) of the running totals.
+        results = self.compute_results(run)
+        if not run["results_stale"] and results != run["results"]:
+            print(
+                "Results of run {} are inconsistent. Running totals {}. Recomputed {}.".format(
+                    run["_id"], run["results"], results
+                ),
+                flush=True,
+            )
+        run["results_stale"] = False
+        run["results"] = results
+        return results
+
     def calc_itp(self, run):
         itp = run["args"]["throughput"]
         if itp < 1:
@@ -542,16 +1581,95 @@ class RunDb:
             itp *= (5 + llr) / 5
         run["args"]["itp"] = itp
 
-    def sum_cores(self, run):
-        cores = 0
-        for task in run["tasks"]:
-            if task["active"]:
-                cores += int(task["worker_info"]["concurrency"])
-        run["cores"] = cores
+    def committed_games(self, task):
+        # An active task has reserved all of its games, an inactive task
+        # only the games it has actually played.
+        if task["active"]:
+            return task["num_games"]
+        stats = task.get("stats", {})
+        return stats.get("wins", 0) + stats.get("losses", 0) + stats.get("draws", 0)
+
+    def rebuild_scheduler_index(self):
+        # The scheduler index consists of
+        # - run["cores"]: the cores of the active tasks of a run;
+        # - self.task_counters: per run the number of committed games and
+        #   the opening offset for the next task;
+        # - self.connections_counter: the number of active tasks per ip address.
+        # It is rebuilt together with self.task_runs and kept up to date
+        # incrementally in between, so that request_task() does not have
+        # to walk run["tasks"].
+        connections_counter = {}
+        task_counters = {}
+        for run in self.task_runs:
+            cores = 0
+            committed_games = 0
+            opening_offset = 0
+            for task in run["tasks"]:
+                if task["active"]:
+                    cores += int(task["worker_info"]["concurrency"])
+                    remote_addr = task["worker_info"].get("remote_addr")
+                    if remote_addr is not None:
+                        connections_counter[remote_addr] = (
+                            connections_counter.get(remote_addr, 0) + 1
+                        )
+                committed_games += self.committed_games(task)
+                opening_offset += task["num_games"]
+            run["cores"] = cores
+            task_counters[str(run["_id"])] = {
+                "committed_games": committed_games,
+                "opening_offset": opening_offset,
+            }
+        with self.scheduler_lock:
+            self.connections_counter = connections_counter
+            self.task_counters = task_counters
+        # Make sure that scavenge() knows about all active tasks.
+        with self.liveness_lock:
+            for run in self.task_runs:
+                if not run["finished"]:
+                    self.task_liveness(run)
+
+    def set_inactive_task(self, task_id, run):
+        # Use this instead of setting task["active"] = False directly
+        # so that the scheduler index stays up to date.
+        task = run["tasks"][task_id]
+        with self.liveness_lock:
+            self.liveness.get(str(run["_id"]), {}).pop(task_id, None)
+        if not task["active"]:
+            return
+        committed_games = self.committed_games(task)
+        task["active"] = False
+        with self.scheduler_lock:
+            run["cores"] = max(
+                0, run.get("cores", 0) - int(task["worker_info"]["concurrency"])
+            )
+            remote_addr = task["worker_info"].get("remote_addr")
+            if remote_addr in self.connections_counter:
+                self.connections_counter[remote_addr] -= 1
+                if self.connections_counter[remote_addr] <= 0:
+                    del self.connections_counter[remote_addr]
+            counters = self.task_counters.get(str(run["_id"]))
+            if counters is not None:
+                counters["committed_games"] += (
+                    self.committed_games(task) - committed_games
+                )
 
-    # Limit concurrent request_task
-    task_lock = threading.Lock()
-    task_semaphore = threading.Semaphore(4)
+    # Admission control of request_task(). The requests are serialized
+    # by task_lock, so admitting many of them only makes them wait longer
+    # while they hold a thread of the server. The number of admitted
+    # requests is adapted to the measured latency of a request, waiting
+    # for task_lock included, so that an admitted request takes about
+    # task_max_wait seconds at most, and is bounded by task_limit_max, see
+    # __init__(). The other requests are rejected at once with a
+    # retry_after that spreads the next attempts of the workers at the
+    # rate at which they can be served.
+    task_lock = metrics.TimedLock("task_lock")
+    task_admission_lock = threading.Lock()
+    task_active = 0
+    task_latency_ewma = 0.05  # seconds
+    task_max_wait = 2.0  # seconds
+    task_limit_max = 2
+    task_retry_time = 0.0
+    task_retry_max = 300.0  # seconds
 
     task_time = 0
     task_runs = None
@@ -574,21 +1692,80 @@ class RunDb:
             games = max(2, 2 * int(games / 2 + 1 / 2))
         return games
 
+    def task_limit(self):
+        # The number of admitted requests served within task_max_wait.
+        limit = int(self.task_max_wait / max(self.task_latency_ewma, 1e-3))
+        return max(1, min(self.task_limit_max, limit))
+
+    def admit_task_request(self):
+        # Returns True if the request may proceed, in which case
+        # release_task_request() must be called when it is done. Never
+        # blocks.
+        with self.task_admission_lock:
+            if self.task_active >= self.task_limit():
+                return False
+            self.task_active += 1
+            return True
+
+    def release_task_request(self, latency=None):
+        with self.task_admission_lock:
+            self.task_active -= 1
+            if latency is not None:
+                self.task_latency_ewma = 0.9 * self.task_latency_ewma + 0.1 * latency
+
+    def task_retry_after(self):
+        # Gives the rejected request the first free retry slot, the slots
+        # being spaced by the latency of a request.
+        with self.task_admission_lock:
+            now = time.time()
+            self.task_retry_time = min(
+                max(self.task_retry_time, now) + self.task_latency_ewma,
+                now + self.task_retry_max,
+            )
+            return round(max(1.0, self.task_retry_time - now), 1)
+
     def request_task(self, worker_info):
-        if self.task_semaphore.acquire(False):
-            try:
-                with self.task_lock:
-                    return self.sync_request_task(worker_info)
-            finally:
-                self.task_semaphore.release()
-        else:
+        if not self.admit_task_request():
             print("request_task too busy", flush=True)
-            return {"task_waiting": False}
-
-    def sync_request_task(self, worker_info):
+            request_task_busy.inc()
+            return {"task_waiting": False, "retry_after": self.task_retry_after()}
+        t0 = time.time()
+        try:
+            with self.task_lock:
+                return self.sync_request_task(worker_info)
+        finally:
+            self.release_task_request(time.time() - t0)
 
+    def request_next_task(self, worker_info):
+        # request_task() for a worker that has just sent the final update
+        # of its task. If the response is lost, the worker sends the same
+        # update again and gets the task it was given the first time,
+        # instead of a second one that nobody would play.
         unique_key = worker_info["unique_key"]
+        last_task = self.worker_runs.get(unique_key, {}).get("last_task")
+        if last_task is not None:
+            r_id, task_id = last_task
+            run = self.get_run(r_id)
+            if run is not None and not run["finished"]:
+                task = run["tasks"][task_id]
+                if task["active"] and task["worker_info"]["unique_key"] == unique_key:
+                    return {"run": run, "task_id": task_id}
+        return self.request_task(worker_info)
+
+    def peek_task(self, worker_info):
+        # Returns the run from which request_task() would currently give
+        # a task to the worker, or None, without creating the task. The
+        # workers use it to prepare their next task while they are still
+        # playing the games of the current one. This is only a hint, so
+        # it uses the order of the runs from the last request_task(),
+        # without taking a slot or the task lock.
+        try:
+            return self.select_run(worker_info)
+        except KeyError:
+            # The scheduler index is being rebuilt for new runs.
+            return None
 
+    def refresh_task_runs(self):
         # We get the list of unfinished runs.
         # To limit db access the list is cached for
         # 60 seconds.
@@ -604,20 +1781,26 @@ class RunDb:
 
         if runs_finished or time.time() > self.task_time + 60:
             print("Request_task: refresh queue", flush=True)
-            self.task_runs = []
+            task_runs = []
             for r in self.get_unfinished_runs_id():
                 run = self.get_run(r["_id"])
-                self.sum_cores(run)
                 self.calc_itp(run)
-                self.task_runs.append(run)
+                task_runs.append(run)
+            self.task_runs = task_runs
+            self.rebuild_scheduler_index()
             self.task_time = time.time()
 
+    def sort_task_runs(self, unique_key):
         # We sort the list of unfinished runs according to priority.
         # Note that because of the caching, the properties of the
         # runs may have changed, so resorting is necessary.
         # Changes can be created by the code below or else in update_task().
         # Note that update_task() uses the same objects as here
         # (they are not copies).
+        # The sort key only uses run level data so this is cheap
+        # compared to anything that walks the tasks.
+        # A new list is made so that peek_task() can read self.task_runs
+        # without the task lock.
 
         last_run_id = self.worker_runs.get(unique_key, {}).get("last_run", None)
 
@@ -631,20 +1814,19 @@ class RunDb:
                 run["_id"],
             )
 
-        self.task_runs.sort(key=priority)
+        self.task_runs = sorted(self.task_runs, key=priority)
 
-        # We go through the list of unfinished runs to see if the worker
-        # has reached the number of allowed connections from the same ip
-        # address.
+    def sync_request_task(self, worker_info):
 
-        connections = 0
-        for run in self.task_runs:
-            for task in run["tasks"]:
-                if (
-                    task["active"]
-                    and task["worker_info"]["remote_addr"] == worker_info["remote_addr"]
-                ):
-                    connections = connections + 1
+        unique_key = worker_info["unique_key"]
+
+        self.refresh_task_runs()
+        self.sort_task_runs(unique_key)
+
+        # We check if the worker has reached the number of allowed
+        # connections from the same ip address.
+
+        connections = self.connections_counter.get(worker_info["remote_addr"], 0)
 
         if connections >= self.userdb.get_machine_limit(worker_info["username"]):
             error = "Request_task: Machine limit reached for user {}".format(
@@ -653,6 +1835,80 @@ class RunDb:
             print(error, flush=True)
             return {"task_waiting": False, "error": error}
 
+        run = self.select_run(worker_info)
+
+        # If there is no suitable run, tell the worker.
+        if run is None:
+            return {"task_waiting": False}
+
+        # Now we create a new task for this run.
+        counters = self.task_counters[str(run["_id"])]
+        remaining = run["args"]["num_games"] - counters["committed_games"]
+        opening_offset = counters["opening_offset"]
+
+        task_size = min(self.worker_cap(run, worker_info), remaining)
+        task = {
+            "num_games": task_size,
+            "active": True,
+            "worker_info": worker_info,
+            "last_updated": datetime.utcnow(),
+            "start": opening_offset,
+            "stats": {
+                "wins": 0,
+                "losses": 0,
+                "draws": 0,
+                "crashes": 0,
+                "time_losses": 0,
+                "pentanomial": 5 * [0],
+            },
+        }
+        run["tasks"].append(task)
+
+        task_id = len(run["tasks"]) - 1
+        self.touch_task(run, task_id)
+
+        with self.scheduler_lock:
+            run["cores"] += task["worker_info"]["concurrency"]
+            counters["committed_games"] += task_size
+            counters["opening_offset"] += task_size
+            remote_addr = worker_info["remote_addr"]
+            self.connections_counter[remote_addr] = (
+                self.connections_counter.get(remote_addr, 0) + 1
+            )
+        self.buffer(run, False, ["tasks.{}".format(task_id), "cores"])
+
+        # Cache some data. Currently we record the id's
+        # the worker has seen, as well as the last id that was seen.
+        # Note that "worker_runs" is empty after a server restart.
+
+        if unique_key not in self.worker_runs:
+            self.worker_runs[unique_key] = {}
+
+        if run["_id"] not in self.worker_runs[unique_key]:
+            self.worker_runs[unique_key][run["_id"]] = True
+
+        self.worker_runs[unique_key]["last_run"] = run["_id"]
+        self.worker_runs[unique_key]["last_task"] = (str(run["_id"]), task_id)
+
+        if DEBUG:
+            print(
+                "Allocate run: https://tests.stockfishchess.org/tests/view/{} task_id: {} to {}/{} Stats: {}".format(
+                    run["_id"],
+                    task_id,
+                    worker_info["username"],
+                    unique_key,
+                    run["tasks"][task_id]["stats"],
+                ),
+                flush=True,
+            )
+        return {"run": run, "task_id": task_id}
+
+    def select_run(self, worker_info):
+        # Returns the first run of the sorted task_runs that is suitable
+        # for the worker, or None.
+
+        unique_key = worker_info["unique_key"]
+
         # Collect some data about the worker that will be used below.
 
         # Memory
@@ -670,8 +1926,6 @@ class RunDb:
         # Now go through the sorted list of unfinished runs.
         # We will add a task to the first run that is suitable.
 
-        run_found = False
-
         for run in self.task_runs:
             if run["finished"]:
                 continue
@@ -687,18 +1941,8 @@ class RunDb:
 
             # Check if there aren't already enough workers
             # working on this run.
-            committed_games = 0
-            for task in run["tasks"]:
-                if not task["active"]:
-                    if "stats" in task:
-                        stats = task["stats"]
-                        committed_games += (
-                            stats["wins"] + stats["losses"] + stats["draws"]
-                        )
-                else:
-                    committed_games += task["num_games"]
-
-            remaining = run["args"]["num_games"] - committed_games
+            counters = self.task_counters[str(run["_id"])]
+            remaining = run["args"]["num_games"] - counters["committed_games"]
             if remaining <= 0:
                 continue
 
@@ -753,79 +1997,14 @@ class RunDb:
             else:
                 limit_cores = 1000000  # infinity
 
-            cores = 0
-            core_limit_reached = False
-            for task in run["tasks"]:
-                if task["active"]:
-                    cores += task["worker_info"]["concurrency"]
-                    if cores > limit_cores:
-                        core_limit_reached = True
-                        break
-
-            if core_limit_reached:
+            if run["cores"] > limit_cores:
                 continue
 
             # If we make it here, it means we have found a run
             # suitable for a new task.
-            run_found = True
-            break
-
-        # If there is no suitable run, tell the worker.
-        if not run_found:
-            return {"task_waiting": False}
-
-        # Now we create a new task for this run.
-        opening_offset = 0
-        for task in run["tasks"]:
-            opening_offset += task["num_games"]
-
-        task_size = min(self.worker_cap(run, worker_info), remaining)
-        task = {
-            "num_games": task_size,
-            "active": True,
-            "worker_info": worker_info,
-            "last_updated": datetime.utcnow(),
-            "start": opening_offset,
-            "stats": {
-                "wins": 0,
-                "losses": 0,
-                "draws": 0,
-                "crashes": 0,
-                "time_losses": 0,
-                "pentanomial": 5 * [0],
-            },
-        }
-        run["tasks"].append(task)
+            return run
 
-        task_id = len(run["tasks"]) - 1
-
-        run["cores"] += task["worker_info"]["concurrency"]
-        self.buffer(run, False)
-
-        # Cache some data. Currently we record the id's
-        # the worker has seen, as well as the last id that was seen.
-        # Note that "worker_runs" is empty after a server restart.
-
-        if unique_key not in self.worker_runs:
-            self.worker_runs[unique_key] = {}
-
-        if run["_id"] not in self.worker_runs[unique_key]:
-            self.worker_runs[unique_key][run["_id"]] = True
-
-        self.worker_runs[unique_key]["last_run"] = run["_id"]
-
-        if DEBUG:
-            print(
-                "Allocate run: https://tests.stockfishchess.org/tests/view/{} task_id: {} to {}/{} Stats: {}".format(
-                    run["_id"],
-                    task_id,
-                    worker_info["username"],
-                    unique_key,
-                    run["tasks"][task_id]["stats"],
-                ),
-                flush=True,
-            )
-        return {"run": run, "task_id": task_id}
+        return None
 
     # Create a lock for each active run
     run_lock = threading.Lock()
@@ -845,14 +2024,86 @@ class RunDb:
                 active_lock = self.active_runs[id]["lock"]
                 self.active_runs[id]["time"] = time.time()
             else:
-                active_lock = threading.Lock()
+                active_lock = metrics.TimedLock("active_run_lock")
                 self.active_runs[id] = {"time": time.time(), "lock": active_lock}
             return active_lock
 
+    def get_elo(self, results, sprt):
+        # SPRT analytics of a run, see stat_util.SPRT_elo().
+        return fishtest.stats.stat_util.SPRT_elo(
+            results,
+            alpha=sprt["alpha"],
+            beta=sprt["beta"],
+            elo0=sprt["elo0"],
+            elo1=sprt["elo1"],
+            elo_model=sprt.get("elo_model", "BayesElo"),
+        )
+
+    # Optionally precompute (i.e. put in the cache) the SPRT analytics
+    # of the runs updated by update_task(), in a background thread.
+    # Updates of a run that arrive while it is waiting are merged.
+    elo_precompute = os.getenv("FISHTEST_PRECOMPUTE_ELO") is not None
+    elo_executor = None
+    elo_pending = {}
+    elo_lock = threading.Lock()
+
+    def schedule_elo(self, run):
+        run_id = str(run["_id"])
+        with self.elo_lock:
+            pending = run_id in self.elo_pending
+            self.elo_pending[run_id] = (
+                copy.deepcopy(run["results"]),
+                copy.copy(run["args"]["sprt"]),
+            )
+            if self.elo_executor is None:
+                self.elo_executor = ThreadPoolExecutor(max_workers=1)
+        if not pending:
+            self.elo_executor.submit(self.precompute_elo, run_id)
+
+    def precompute_elo(self, run_id):
+        with self.elo_lock:
+            results, sprt = self.elo_pending.pop(run_id)
+        try:
+            self.get_elo(results, sprt)
+        except Exception as e:
+            print(
+                "Precompute_elo: exception for run {}: {}".format(run_id, str(e)),
+                flush=True,
+            )
+
+    # Back-pressure for task updates. If the time needed to handle an
+    # update (including waiting for the run lock) becomes too large on
+    # average, the workers are asked to coalesce their updates.
+    update_time_ewma = 0.0
+    update_backpressure_time = 0.1  # seconds
+
+    def record_update_time(self, t0, count=1):
+        t = (time.time() - t0) / count
+        self.update_time_ewma = 0.9 * self.update_time_ewma + 0.1 * t
+
+    def update_backpressure(self):
+        return self.update_time_ewma > self.update_backpressure_time
+
     def update_task(self, worker_info, run_id, task_id, stats, spsa):
+        t0 = time.time()
+        lock = self.active_run_lock(str(run_id))
+        with lock:
+            ret = self.sync_update_task(worker_info, run_id, task_id, stats, spsa)
+        self.record_update_time(t0)
+        return ret
+
+    def update_tasks(self, worker_info, run_id, updates):
+        # Applies a list of updates (task_id, stats, spsa) for the same
+        # run with a single acquisition of the run lock.
+        t0 = time.time()
         lock = self.active_run_lock(str(run_id))
         with lock:
-            return self.sync_update_task(worker_info, run_id, task_id, stats, spsa)
+            ret = [
+                self.sync_update_task(worker_info, run_id, task_id, stats, spsa)
+                for task_id, stats, spsa in updates
+            ]
+        self.record_update_time(t0, count=len(updates))
+        return ret
 
     def sync_update_task(self, worker_info, run_id, task_id, stats, spsa):
         run = self.get_run(run_id)
@@ -878,7 +2129,6 @@ class RunDb:
         if not task["active"]:
             info = "Update_task: task {}/{} is not active".format(run_id, task_id)
             print(info, flush=True)
-            task["active"] = False
             return {"task_alive": False, "info": info}
 
         # Guard against incorrect results
@@ -908,44 +2158,59 @@ class RunDb:
 
         if error != "":
             print(error, flush=True)
-            task["active"] = False
+            self.set_inactive_task(task_id, run)
             return {"task_alive": False, "error": error}
 
         # The update seems fine. Update run["tasks"][task_id] (=task).
 
-        task["stats"] = stats
+        old_stats = task.get("stats")
+        self.update_task_stats(run, task, stats)
         task["last_updated"] = update_time
         task["worker_info"] = worker_info  # updates rate, ARCH, nps
+        self.touch_task(run, task_id)
+
+        new_games = num_games - old_num_games
+        self.count_user(
+            worker_info["username"],
+            update_time,
+            cpu_hours=new_games
+            * int(run["args"].get("threads", 1))
+            * estimate_game_duration(run["args"]["tc"])
+            / (60 * 60),
+            games=new_games,
+        )
 
-        task_finished = False
         if num_games >= task["num_games"]:
             # This task is now finished
-            task_finished = True
-            task["active"] = False
+            self.set_inactive_task(task_id, run)
 
         # Now update the current run.
 
         run["last_updated"] = update_time
 
-        if task_finished:
-            # run["cores"] is also updated in request_task().
-            # We use the same lock.
-            with self.task_lock:
-                run["cores"] -= task["worker_info"]["concurrency"]
-                assert run["cores"] >= 0
-
-        run["results_stale"] = True  # force recalculation of results
-        updated_results = self.get_results(
-            run, False
-        )  # computed from run["tasks"] which
-        # has just been updated. Sets run["results_stale"]=False.
+        self.update_results(run, old_stats, stats)
+        updated_results = self.get_results(run, False)
 
         if "sprt" in run["args"]:
             sprt = run["args"]["sprt"]
             fishtest.stats.stat_util.update_SPRT(updated_results, sprt)
 
+        # The parts of the run that are modified by this update.
+        fields = ["tasks.{}".format(task_id), "results", "last_updated", "cores"]
+        if "sprt" in run["args"]:
+            fields.append("args.sprt")
+
         if "spsa" in run["args"] and spsa_games == spsa["num_games"]:
+            param_history = run["args"]["spsa"].get("param_history", [])
+            history_length = len(param_history)
             self.update_spsa(task["worker_info"]["unique_key"], run, spsa)
+            fields += ["args.spsa.iter", "args.spsa.params", "args.spsa.clipping"]
+            # Avoid rewriting the (potentially large) param_history.
+            param_history = run["args"]["spsa"]["param_history"]
+            if history_length == 0:
+                fields.append("args.spsa.param_history")
+            elif len(param_history) > history_length:
+                fields.append("args.spsa.param_history.{}".format(history_length))
 
         # Check if the run is finished.
 
@@ -962,7 +2227,9 @@ class RunDb:
             self.stop_run(run_id)
             ret = {"task_alive": False}
         else:
-            self.buffer(run, False)
+            self.buffer(run, False, fields)
+            if self.elo_precompute and "sprt" in run["args"]:
+                self.schedule_elo(run)
             ret = {"task_alive": task["active"]}
 
         return ret
@@ -980,8 +2247,8 @@ class RunDb:
             print(info, flush=True)
             return {"task_alive": False, "info": info}
         # Mark the task as inactive.
-        task["active"] = False
-        self.buffer(run, False)
+        self.set_inactive_task(task_id, run)
+        self.buffer(run, False, ["tasks.{}".format(task_id), "cores"])
         print(
             "Failed_task: failure for: https://tests.stockfishchess.org/tests/view/{}, "
             "task_id: {}, worker: {}, reason: '{}'".format(
@@ -1005,10 +2272,11 @@ class RunDb:
         """
         self.clear_params(run_id)  # spsa stuff
         run = self.get_run(run_id)
-        for task in run["tasks"]:
-            task["active"] = False
-        run["results_stale"] = True
-        results = self.get_results(run, True)
+        if not run.get("finished", False) and "username" in run["args"]:
+            self.count_user(run["args"]["username"], datetime.utcnow(), tests=1)
+        for task_id in range(len(run["tasks"])):
+            self.set_inactive_task(task_id, run)
+        results = self.check_results(run)
         run["results_info"] = format_results(results, run)
         # De-couple the styling of the run from its finished status
         if run["results_info"]["style"] == "#44EB44":
@@ -1045,6 +2313,83 @@ class RunDb:
         self.task_time = 0
         return True
 
+    def chi2_entry(self, r_id):
+        # The chi2 table of a run together with the lock that protects it.
+        with self.chi2_lock:
+            entry = self.chi2_counts.get(r_id)
+            if entry is None:
+                entry = {"lock": threading.Lock(), "counts": None}
+                self.chi2_counts[r_id] = entry
+            return entry
+
+    def cached_chi2_counts(self, run):
+        entry = self.chi2_counts.get(str(run["_id"]))
+        return None if entry is None else entry["counts"]
+
+    def get_chi2(self, run):
+        # Returns get_chi2(run["tasks"]). The per-worker table is built
+        # on first use and then kept up to date by update_task_stats(),
+        # and the result is cached until the table changes.
+        entry = self.chi2_entry(str(run["_id"]))
+        with entry["lock"]:
+            counts = entry["counts"]
+            if counts is None:
+                counts = get_chi2_counts(run["tasks"])
+                counts["chi2"] = None
+                entry["counts"] = counts
+            if counts["chi2"] is None:
+                counts["chi2"] = get_chi2_from_counts(
+                    counts["keys"], counts["observed"]
+                )
+            return counts["chi2"]
+
+    def update_task_stats(self, run, task, stats):
+        # Sets the stats of a task and updates the chi2 table of the run.
+        # This is done under the lock of the run so that a concurrent
+        # get_chi2() sees either the old stats and the old table or both
+        # new ones.
+        entry = self.chi2_entry(str(run["_id"]))
+        with entry["lock"]:
+            old_stats = task.get("stats", {})
+            task["stats"] = stats
+            counts = entry["counts"]
+            if counts is None:
+                return
+            if counts["has_pentanomial"] is None:
+                # The format of the table is not known yet.
+                entry["counts"] = None
+                return
+            update_chi2_counts(
+                counts, task["worker_info"]["unique_key"], old_stats, stats
+            )
+            counts["chi2"] = None
+
+    def clear_chi2(self, run):
+        # Should be called when tasks are removed from run["tasks"].
+        entry = self.chi2_entry(str(run["_id"]))
+        with entry["lock"]:
+            entry["counts"] = None
+
+    def uncount_bad_task(self, run, task):
+        # Takes the games of a task moved to run["bad_tasks"] back from
+        # the counters of its user, in the same way as
+        # utils/delta_update_users.py --rescan ignores the bad tasks.
+        stats = task.get("stats", {})
+        num_games = (
+            stats.get("wins", 0) + stats.get("losses", 0) + stats.get("draws", 0)
+        )
+        if num_games == 0 or "worker_info" not in task:
+            return
+        self.count_user(
+            task["worker_info"]["username"],
+            task.get("last_updated", run["last_updated"]),
+            cpu_hours=-num_games
+            * int(run["args"].get("threads", 1))
+            * estimate_game_duration(run["args"]["tc"])
+            / (60 * 60),
+            games=-num_games,
+        )
+
     def purge_run(self, run, p=0.001, res=7.0, iters=1):
         # Only purge finished runs
         assert run["finished"]
@@ -1072,8 +2417,12 @@ class RunDb:
                 task["bad"] = True
                 run["bad_tasks"].append(task)
                 run["tasks"].remove(task)
+                self.update_results(run, old_stats=task.get("stats"))
+                self.uncount_bad_task(run, task)
 
-        chi2 = get_chi2(run["tasks"])
+        if message == "":
+            self.clear_chi2(run)
+        chi2 = self.get_chi2(run)
         # Make sure the residuals are up to date.
         # Once a task is moved to run["bad_tasks"] its
         # residual will no longer change.
@@ -1081,6 +2430,7 @@ class RunDb:
         bad_workers = get_bad_workers(
             run["tasks"],
             cached_chi2=chi2,
+            cached_counts=self.cached_chi2_counts(run),
             p=p,
             res=res,
             iters=iters - 1 if message == "" else iters,
@@ -1092,8 +2442,10 @@ class RunDb:
                 task["bad"] = True
                 run["bad_tasks"].append(task)
                 run["tasks"].remove(task)
+                self.update_results(run, old_stats=task.get("stats"))
+                self.uncount_bad_task(run, task)
         if message == "":
-            run["results_stale"] = True
+            self.clear_chi2(run)
             results = self.get_results(run)
             revived = True
             if "sprt" in run["args"] and "state" in run["args"]["sprt"]:
@@ -1104,6 +2456,11 @@ class RunDb:
             run["results_info"] = format_results(results, run)
             if revived:
                 run["finished"] = False
+                # The test is counted again when it stops, see stop_run().
+                if "username" in run["args"]:
+                    self.count_user(
+                        run["args"]["username"], datetime.utcnow(), tests=-1
+                    )
                 run["is_green"] = False
                 run["is_yellow"] = False
             else:
@@ -3,6 +3,7 @@ from __future__ import division
 import copy
 import math
 
+import numpy as np
 import scipy.optimize
 
 """
@@ -20,13 +21,16 @@ the game pairs LL,LD+DL,LW+DD+WL,DW+WD,WW.
 
 nelo_divided_by_nt = 800 / math.log(10)  # 347.43558552260146
 
+# Iterations of Newton's method before falling back to secular_brentq().
+secular_max_iter = 100
 
-def secular(pdf):
+
+def secular_brentq(pdf):
     """
-    Solves the secular equation sum_i pi*ai/(1+x*ai)=0.
+    Solves the secular equation sum_i pi*ai/(1+x*ai)=0 with Brent's
+    method.
     """
     epsilon = 1e-9
-    v, w = pdf[0][0], pdf[-1][0]
     values = [ai for ai, pi in pdf]
     v = min(values)
     w = max(values)
@@ -44,6 +48,46 @@ def secular(pdf):
     return x
 
 
+def secular(pdf):
+    """
+    Solves the secular equation sum_i pi*ai/(1+x*ai)=0.
+
+    The left hand side is strictly decreasing on the interval
+    (-1/max(ai),-1/min(ai)) so we may use Newton's method, safeguarded
+    by bisection. If it does not converge we fall back to
+    secular_brentq().
+    """
+    values = [ai for ai, pi in pdf]
+    v = min(values)
+    w = max(values)
+    assert v * w < 0
+    l = -1 / w
+    u = -1 / v
+    x = 0.0
+    for i in range(secular_max_iter):
+        f, df = 0.0, 0.0
+        for ai, pi in pdf:
+            t = ai / (1 + x * ai)
+            f += pi * t
+            df -= pi * t * t
+        if f > 0:
+            l = x
+        elif f < 0:
+            u = x
+        else:
+            break
+        x_ = x - f / df
+        if not l < x_ < u:
+            x_ = (l + u) / 2
+        dx = abs(x_ - x)
+        x = x_
+        if dx <= 1e-14 * (1 + abs(x)):
+            break
+    else:
+        return secular_brentq(pdf)
+    return x
+
+
 def uniform(pdf):
     n = len(pdf)
     return [(ai, 1 / n) for ai, pi in pdf]
@@ -277,3 +321,110 @@ def LLR_normalized(nelo0, nelo1, results):
     )
     N, pdf = results_to_pdf(results)
     return N * LLR(pdf, t0, t1, ref=1 / 2, statistic="t_value")
+
+
+"""
+Vectorized versions of LLR_logistic and LLR_normalized. The results
+of a batch of tests are given as an array of shape (B,3) or (B,5) and
+the bounds as scalars or arrays of shape (B,). They return an array of
+shape (B,) which agrees with the scalar functions above up to a
+relative error of 1e-9.
+"""
+
+
+def secular_batch(a, p):
+    """
+    Solves the secular equations sum_i p[k,i]*a[k,i]/(1+x[k]*a[k,i])=0
+    for all rows k at once, in the same way as secular().
+    """
+    v = a.min(axis=1)
+    w = a.max(axis=1)
+    assert np.all(v * w < 0)
+    lo = -1 / w
+    hi = -1 / v
+    x = np.zeros(len(a))
+    for i in range(secular_max_iter):
+        d = 1 + x[:, None] * a
+        f = (p * a / d).sum(axis=1)
+        df = -(p * a * a / (d * d)).sum(axis=1)
+        # Shrink the bracket.
+        lo = np.where(f > 0, x, lo)
+        hi = np.where(f < 0, x, hi)
+        x_ = x - f / df
+        outside = ~((x_ > lo) & (x_ < hi))
+        x_ = np.where(outside, (lo + hi) / 2, x_)
+        dx = np.abs(x_ - x)
+        x = x_
+        converged = dx <= 1e-14 * (1 + np.abs(x))
+        if np.all(converged):
+            break
+    else:
+        for k in np.flatnonzero(~converged):
+            x[k] = secular_brentq(list(zip(a[k], p[k])))
+    return x
+
+
+def results_to_pdf_batch(results):
+    results = np.array(results, dtype=float)
+    if results.ndim == 1:
+        results = results[None, :]
+    results[results == 0] = 1e-3  # see regularize()
+    N = results.sum(axis=1)
+    l = results.shape[1]
+    a = np.broadcast_to(np.arange(l) / (l - 1), results.shape)
+    return N, a, results / N[:, None]
+
+
+def MLE_expected_batch(a, p, s):
+    a1 = a - s[:, None]
+    x = secular_batch(a1, p)
+    return p / (1 + x[:, None] * a1)
+
+
+def MLE_t_value_batch(a, p, ref, s):
+    """
+    Same iteration as MLE_t_value(). Every row stops at the same
+    iteration as the scalar code would.
+    """
+    q = np.full(p.shape, 1 / p.shape[1])
+    active = np.ones(len(p), dtype=bool)
+    for i in range(10):
+        mu = (q * a).sum(axis=1)
+        sigma = ((q * (a - mu[:, None]) ** 2).sum(axis=1)) ** (1 / 2)
+        a1 = (
+            a
+            - ref
+            - (s * sigma)[:, None] * (1 + ((mu[:, None] - a) / sigma[:, None]) ** 2) / 2
+        )
+        x = secular_batch(a1, p)
+        q_ = p / (1 + x[:, None] * a1)
+        converged = np.abs(q_ - q).max(axis=1) < 1e-9
+        q = np.where(active[:, None], q_, q)
+        active &= ~converged
+        if not np.any(active):
+            break
+    return q
+
+
+def LLR_logistic_batch(elo0, elo1, results):
+    N, a, p = results_to_pdf_batch(results)
+    s0, s1 = [
+        np.broadcast_to(L_(np.asarray(elo, dtype=float)), N.shape)
+        for elo in (elo0, elo1)
+    ]
+    q0, q1 = [MLE_expected_batch(a, p, s) for s in (s0, s1)]
+    return N * (p * (np.log(q1) - np.log(q0))).sum(axis=1)
+
+
+def LLR_normalized_batch(nelo0, nelo1, results):
+    N, a, p = results_to_pdf_batch(results)
+    nt0, nt1 = [
+        np.broadcast_to(np.asarray(nelo, dtype=float) / nelo_divided_by_nt, N.shape)
+        for nelo in (nelo0, nelo1)
+    ]
+    if p.shape[1] == 5:
+        nt0, nt1 = nt0 * 2**0.5, nt1 * 2**0.5
+    else:
+        assert p.shape[1] == 3
+    q0, q1 = [MLE_t_value_batch(a, p, 1 / 2, t) for t in (nt0, nt1)]
+    return N * (p * (np.log(q1) - np.log(q0))).sum(axis=1)
@@ -1,6 +1,9 @@
 from __future__ import division
 
+import collections
+import copy
 import math
+import threading
 
 import scipy.stats
 from fishtest.stats import LLRcalc, sprt
@@ -115,7 +118,49 @@ def elo_to_bayeselo(elo, draw_ratio):
     return proba_to_bayeselo(P)
 
 
+# Bounded LRU cache for SPRT_elo(). The same unchanged runs are
+# requested over and over again.
+SPRT_elo_cache = collections.OrderedDict()
+SPRT_elo_cache_size = 2000
+SPRT_elo_cache_lock = threading.Lock()
+SPRT_elo_cache_stats = {"hits": 0, "misses": 0}
+
+
 def SPRT_elo(R, alpha=0.05, beta=0.05, p=0.05, elo0=None, elo1=None, elo_model=None):
+    """
+    Calculate an elo estimate from an SPRT test. The results are cached."""
+    key = (
+        tuple(R["pentanomial"]) if "pentanomial" in R else None,
+        R.get("wins", 0),
+        R.get("losses", 0),
+        R.get("draws", 0),
+        alpha,
+        beta,
+        p,
+        elo0,
+        elo1,
+        elo_model,
+    )
+    with SPRT_elo_cache_lock:
+        a = SPRT_elo_cache.get(key, None)
+        if a is not None:
+            SPRT_elo_cache.move_to_end(key)
+            SPRT_elo_cache_stats["hits"] += 1
+            return copy.deepcopy(a)
+        SPRT_elo_cache_stats["misses"] += 1
+    a = compute_SPRT_elo(
+        R, alpha=alpha, beta=beta, p=p, elo0=elo0, elo1=elo1, elo_model=elo_model
+    )
+    with SPRT_elo_cache_lock:
+        SPRT_elo_cache[key] = a
+        while len(SPRT_elo_cache) > SPRT_elo_cache_size:
+            SPRT_elo_cache.popitem(last=False)
+    return copy.deepcopy(a)
+
+
+def compute_SPRT_elo(
+    R, alpha=0.05, beta=0.05, p=0.05, elo0=None, elo1=None, elo_model=None
+):
     """
     Calculate an elo estimate from an SPRT test."""
     assert elo_model in ["BayesElo", "logistic", "normalized"]
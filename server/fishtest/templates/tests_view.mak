@@ -239,7 +239,10 @@ from fishtest.util import worker_name
   <pre id="diff-contents"><code class="diff"></code></pre>
 </section>
 
-<h3>Tasks ${totals}</h3>
+<h3>
+  Tasks ${totals}
+  <a class="btn btn-sm btn-light border" href=${f"/api/run_pgns/{run['_id']}.pgn"}>Download PGNs</a>
+</h3>
 <div id="tasks" class="overflow-auto">
   <table class='table table-striped table-sm'>
     <thead class="sticky-top">
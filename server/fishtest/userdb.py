@@ -1,8 +1,13 @@
+import hashlib
+import hmac
+import os
 import sys
 import threading
 import time
 from datetime import datetime
 
+from fishtest import metrics
+from fishtest.flagdb import FlagDb
 from pymongo import ASCENDING
 
 
@@ -12,10 +17,12 @@ class UserDb:
         self.users = self.db["users"]
         self.user_cache = self.db["user_cache"]
         self.top_month = self.db["top_month"]
+        self.user_stats = self.db["user_stats"]
         self.flag_cache = self.db["flag_cache"]
+        self.flagdb = FlagDb(self.db)
 
     # Cache user lookups for 60s
-    user_lock = threading.Lock()
+    user_lock = metrics.TimedLock("user_lock")
     cache = {}
 
     def find(self, name):
@@ -45,6 +52,86 @@ class UserDb:
 
         return {"username": username, "authenticated": True}
 
+    # Session tokens for the worker api, issued by /api/request_version.
+    # A token is "username:issue_time_ms:signature" where the signature is an
+    # HMAC of the first two parts and of the password with a secret that is
+    # private to this process. Tokens are checked against token_users, a
+    # snapshot mapping the users that are not blocked to their password,
+    # which is replaced as a whole every token_users_period seconds by a
+    # background thread. So the check needs no lock and no db access, and
+    # blocking a user or changing the password revokes the tokens on every
+    # instance within token_users_period seconds (at once in the instance
+    # that saved the user).
+    token_secret = os.urandom(32)
+    token_lifetime = 3600  # seconds
+    token_users = {}
+    token_users_time = 0
+    token_users_period = 60
+    token_users_lock = threading.Lock()
+
+    def refresh_token_users(self):
+        # The lock only serializes the refreshes, so that an older snapshot
+        # never replaces a newer one. Readers don't take it.
+        with self.token_users_lock:
+            UserDb.token_users = {
+                user["username"]: user["password"]
+                for user in self.users.find(
+                    {"blocked": {"$ne": True}}, {"username": 1, "password": 1}
+                )
+            }
+            UserDb.token_users_time = time.time()
+
+    def get_token_users(self):
+        # Returns the current snapshot, and starts a refresh if it is old.
+        now = time.time()
+        if now > self.token_users_time + self.token_users_period:
+            # Claim the refresh. Two threads doing it at once is harmless.
+            UserDb.token_users_time = now
+
+            def refresh():
+                try:
+                    self.refresh_token_users()
+                except Exception as e:
+                    print("Token users refresh: {}".format(str(e)), flush=True)
+
+            threading.Thread(target=refresh, daemon=True).start()
+        return self.token_users
+
+    def update_token_user(self, user):
+        if user.get("blocked", False):
+            self.token_users.pop(user["username"], None)
+        else:
+            self.token_users[user["username"]] = user["password"]
+
+    def token_signature(self, username, issued, password):
+        message = "{}:{}:{}".format(username, issued, password).encode()
+        return hmac.new(self.token_secret, message, hashlib.sha256).hexdigest()
+
+    def create_token(self, username):
+        # Called once the password has been checked.
+        user = self.find(username)
+        self.update_token_user(user)
+        issued = int(time.time() * 1000)
+        return "{}:{}:{}".format(
+            username, issued, self.token_signature(username, issued, user["password"])
+        )
+
+    def authenticate_token(self, username, token):
+        try:
+            username_, issued, signature = token.rsplit(":", 2)
+            issued = int(issued)
+        except ValueError:
+            return False
+        password = self.get_token_users().get(username)
+        return (
+            username_ == username
+            and password is not None
+            and issued + 1000 * self.token_lifetime > 1000 * time.time()
+            and hmac.compare_digest(
+                signature, self.token_signature(username, issued, password)
+            )
+        )
+
     def get_users(self):
         return self.users.find(sort=[("_id", ASCENDING)])
 
@@ -100,6 +187,7 @@ class UserDb:
     def save_user(self, user):
         self.users.replace_one({"_id": user["_id"]}, user)
         self.last_pending_time = 0
+        self.update_token_user(user)
 
     def get_machine_limit(self, username):
         user = self.find(username)
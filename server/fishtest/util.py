@@ -5,6 +5,7 @@ from email.mime.text import MIMEText
 import fishtest.stats.stat_util
 import numpy
 import scipy.stats
+from bson.objectid import ObjectId
 from zxcvbn import zxcvbn
 
 FISH_URL = "https://tests.stockfishchess.org/tests/view/"
@@ -21,8 +22,92 @@ def worker_name(worker_info):
     return name
 
 
+def chi2_row(stats, has_pentanomial):
+    """The contribution of the stats of a task to the chi^2 table"""
+    if not has_pentanomial:
+        return [
+            float(stats.get("wins", 0)),
+            float(stats.get("losses", 0)),
+            float(stats.get("draws", 0)),
+        ]
+    p = stats.get("pentanomial", 5 * [0])  # there was a small window
+    # in time where we could have both trinomial and pentanomial
+    # workers
+
+    # The ww and ll frequencies will typically be too small for
+    # the full pentanomial chi2 test to be valid. See e.g. the last page of
+    # https://www.open.ac.uk/socialsciences/spsstutorial/files/tutorials/chi-square.pdf.
+    # So we combine the ww and ll frequencies with the wd and ld frequencies.
+    return [float(p[4] + p[3]), float(p[0] + p[1]), float(p[2])]
+
+
+def get_chi2_counts(tasks):
+    """Aggregate the stats of the tasks by worker.
+
+    Returns a dict with the unique keys of the workers ("keys"), their
+    row in the table ("rows") and the table itself ("observed"), a
+    numpy array with one row per worker. It can be kept up to date
+    incrementally, see RunDb.update_task_stats().
+    """
+    counts = {"has_pentanomial": None, "keys": [], "rows": {}}
+    observed = []
+    for task in tasks:
+        if "worker_info" not in task:
+            continue
+        key = task["worker_info"]["unique_key"]
+        stats = task.get("stats", {})
+        if counts["has_pentanomial"] is None:
+            counts["has_pentanomial"] = "pentanomial" in stats
+        wld = chi2_row(stats, counts["has_pentanomial"])
+        if key in counts["rows"]:
+            row = observed[counts["rows"][key]]
+            for idx in range(len(wld)):
+                row[idx] += wld[idx]
+        else:
+            counts["rows"][key] = len(observed)
+            counts["keys"].append(key)
+            observed.append(wld)
+    counts["observed"] = numpy.array(observed).reshape(-1, 3)
+    return counts
+
+
+def update_chi2_counts(counts, key, old_stats, new_stats):
+    """Replace the contribution old_stats of a task of the worker key
+    in the table returned by get_chi2_counts() by new_stats"""
+    row = counts["rows"].get(key)
+    if row is None:
+        row = len(counts["keys"])
+        counts["rows"][key] = row
+        counts["keys"].append(key)
+        counts["observed"] = numpy.vstack([counts["observed"], numpy.zeros(3)])
+    has_pentanomial = counts["has_pentanomial"]
+    counts["observed"][row] += numpy.subtract(
+        chi2_row(new_stats, has_pentanomial), chi2_row(old_stats, has_pentanomial)
+    )
+
+
 def get_chi2(tasks, exclude_workers=set()):
     """Perform chi^2 test on the stats from each worker"""
+    counts = get_chi2_counts(tasks)
+    return get_chi2_from_counts(counts["keys"], counts["observed"], exclude_workers)
+
+
+def get_chi2_from_counts(keys, observed, exclude_workers=set()):
+    """Perform chi^2 test on the table returned by get_chi2_counts()"""
+    keep = numpy.array([key not in exclude_workers for key in keys], dtype=bool)
+    return chi2_test(
+        keys,
+        observed,
+        numpy.sum(observed, axis=1),
+        numpy.sum(observed[keep], axis=0),
+        keep,
+    )
+
+
+def chi2_test(keys, observed, row_sums, column_sums, keep):
+    """Perform chi^2 test on the rows of the table selected by the boolean
+    mask keep, given the row sums of the table and the column sums of
+    the selected rows"""
 
     default_results = {
         "chi2": float("nan"),
@@ -33,64 +118,34 @@ def get_chi2(tasks, exclude_workers=set()):
         "z_99": float("nan"),
     }
 
-    # Aggregate results by worker
-    users = {}
-    has_pentanomial = None
-    for task in tasks:
-        if "worker_info" not in task:
-            continue
-        key = task["worker_info"]["unique_key"]
-        if key in exclude_workers:
-            continue
-        stats = task.get("stats", {})
-        if has_pentanomial is None:
-            has_pentanomial = "pentanomial" in stats
-        if not has_pentanomial:
-            wld = [
-                float(stats.get("wins", 0)),
-                float(stats.get("losses", 0)),
-                float(stats.get("draws", 0)),
-            ]
-        else:
-            p = stats.get("pentanomial", 5 * [0])  # there was a small window
-            # in time where we could have both trinomial and pentanomial
-            # workers
-
-            # The ww and ll frequencies will typically be too small for
-            # the full pentanomial chi2 test to be valid. See e.g. the last page of
-            # https://www.open.ac.uk/socialsciences/spsstutorial/files/tutorials/chi-square.pdf.
-            # So we combine the ww and ll frequencies with the wd and ld frequencies.
-            wld = [float(p[4] + p[3]), float(p[0] + p[1]), float(p[2])]
-        if key in users:
-            for idx in range(len(wld)):
-                users[key][idx] += wld[idx]
-        else:
-            users[key] = wld
-
     # We filter out the workers whose expected frequences are <= 5 as
     # they break the chi2 test.
-    filtering_done = False
-    while not filtering_done:
+    keep = keep.copy()
+    while True:
         # Whenever less than two qualifying workers are left,
         # we bail out and just return "something".
-        if len(users) <= 1:
+        if numpy.count_nonzero(keep) <= 1:
             return default_results
         # Now do the matrix computations with numpy.
-        observed = numpy.array(list(users.values()))
-        rows, columns = observed.shape
-        column_sums = numpy.sum(observed, axis=0)
-        row_sums = numpy.sum(observed, axis=1)
         grand_total = numpy.sum(column_sums)
         # if no games have been received, we cannot continue
         if grand_total == 0:
             return default_results
-        expected = numpy.outer(row_sums, column_sums) / grand_total
-        keys = list(users)
-        filtering_done = True
-        for idx in range(len(keys)):
-            if min(expected[idx]) <= 5:
-                del users[keys[idx]]
-                filtering_done = False
+        expected = numpy.outer(row_sums[keep], column_sums) / grand_total
+        qualifying = numpy.min(expected, axis=1) > 5
+        if qualifying.all():
+            break
+        # The counts are integers so subtracting the filtered rows from
+        # the column sums is exact.
+        dropped = keep.copy()
+        dropped[keep] = ~qualifying
+        column_sums = column_sums - numpy.sum(observed[dropped], axis=0)
+        keep[keep] = qualifying
+
+    observed = observed[keep]
+    row_sums = row_sums[keep]
+    rows, columns = observed.shape
+    keys = [keys[idx] for idx in numpy.flatnonzero(keep)]
 
     # Now we do the basic chi2 computation.
     df = (rows - 1) * (columns - 1)
@@ -118,11 +173,10 @@ def get_chi2(tasks, exclude_workers=set()):
     # in order to be able to deal accurately with very low p-values.
     res_z = scipy.stats.norm.isf(scipy.stats.chi2.sf(adj_row_chi2, columns - 1))
 
-    for idx in range(len(keys)):
-        # We cap the standard normal "residuals" at zero since negative values
-        # do not look very nice and moreover they do not convey any
-        # information.
-        users[keys[idx]] = max(0, res_z[idx])
+    # We cap the standard normal "residuals" at zero since negative values
+    # do not look very nice and moreover they do not convey any
+    # information.
+    users = {key: max(0, z) for key, z in zip(keys, res_z)}
 
     # We compute 95% and 99% thresholds using the Bonferroni correction.
     # Under the null hypothesis, yellow and red residuals should appear
@@ -147,13 +201,30 @@ def crash_or_time(task):
     return crashes > 3 or (total > 20 and time_losses / total > 0.1)
 
 
-def get_bad_workers(tasks, cached_chi2=None, p=0.001, res=7.0, iters=1):
+def get_bad_workers(
+    tasks, cached_chi2=None, p=0.001, res=7.0, iters=1, cached_counts=None
+):
     # If we have an up-to-date result of get_chi2() we can pass
-    # it as cached_chi2 to avoid needless recomputation.
+    # it as cached_chi2 to avoid needless recomputation. Likewise
+    # cached_counts is an up-to-date result of get_chi2_counts().
+    # The table is aggregated once. Excluding a worker then only
+    # removes its row from the mask and subtracts it from the column
+    # sums, a rank one update, before the chi2 test is repeated.
     bad_workers = set()
+    counts = cached_counts
+    keep = None
     for _ in range(iters):
         if cached_chi2 is None:
-            chi2 = get_chi2(tasks, exclude_workers=bad_workers)
+            if keep is None:
+                if counts is None:
+                    counts = get_chi2_counts(tasks)
+                observed = counts["observed"]
+                row_sums = numpy.sum(observed, axis=1)
+                keep = numpy.array(
+                    [key not in bad_workers for key in counts["keys"]], dtype=bool
+                )
+                column_sums = numpy.sum(observed[keep], axis=0)
+            chi2 = chi2_test(counts["keys"], observed, row_sums, column_sums, keep)
         else:
             chi2 = cached_chi2
             cached_chi2 = None
@@ -169,6 +240,10 @@ def get_bad_workers(tasks, cached_chi2=None, p=0.001, res=7.0, iters=1):
         if worst_user == {}:
             break
         bad_workers.add(worst_user["unique_key"])
+        if keep is not None:
+            row = counts["rows"][worst_user["unique_key"]]
+            keep[row] = False
+            column_sums = column_sums - observed[row]
 
     return bad_workers
 
@@ -475,3 +550,21 @@ def get_cookie(request, name):
         k, v = cookie.split("=")
         if k.strip() == name:
             return v.strip()
+
+
+# Cursors for keyset pagination of the finished runs, which are sorted on
+# (last_updated, _id). The db stores dates with millisecond precision.
+cursor_epoch = datetime(1970, 1, 1)
+
+
+def format_cursor(run):
+    ms = (run["last_updated"] - cursor_epoch) // timedelta(milliseconds=1)
+    return "{}_{}".format(ms, run["_id"])
+
+
+def parse_cursor(cursor):
+    try:
+        ms, run_id = cursor.split("_")
+        return cursor_epoch + timedelta(milliseconds=int(ms)), ObjectId(run_id)
+    except Exception:
+        return None
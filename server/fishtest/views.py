@@ -9,12 +9,13 @@ import time
 
 import fishtest.stats.stat_util
 import requests
+from fishtest import github
 from fishtest.util import (
     delta_date,
     diff_date,
-    estimate_game_duration,
+    format_cursor,
     format_results,
-    get_chi2,
+    parse_cursor,
     password_strength,
     update_residuals,
 )
@@ -447,25 +448,33 @@ def user(request):
     }
 
 
+def format_users(users_list):
+    # The users tables store the time a user was last active, the
+    # elapsed time is computed here so that it stays current.
+    for user in users_list:
+        if isinstance(user["last_updated"], datetime.datetime):
+            diff = diff_date(user["last_updated"])
+            user["diff"] = diff.total_seconds()
+            user["last_updated"] = delta_date(diff)
+    users_list.sort(key=lambda k: k["cpu_hours"], reverse=True)
+    return users_list
+
+
 @view_config(route_name="users", renderer="users.mak")
 def users(request):
     users_list = list(request.userdb.user_cache.find())
-    users_list.sort(key=lambda k: k["cpu_hours"], reverse=True)
-    return {"users": users_list}
+    return {"users": format_users(users_list)}
 
 
 @view_config(route_name="users_monthly", renderer="users.mak")
 def users_monthly(request):
     users_list = list(request.userdb.top_month.find())
-    users_list.sort(key=lambda k: k["cpu_hours"], reverse=True)
-    return {"users": users_list}
+    return {"users": format_users(users_list)}
 
 
 def get_master_bench():
     bs = re.compile(r"(^|\s)[Bb]ench[ :]+([0-9]+)", re.MULTILINE)
-    for c in requests.get(
-        "https://api.github.com/repos/official-stockfish/Stockfish/commits"
-    ).json():
+    for c in github.get_commits(github.OFFICIAL_REPO):
         if "commit" not in c:
             return None
         m = bs.search(c["commit"]["message"])
@@ -474,29 +483,28 @@ def get_master_bench():
     return None
 
 
+def commit_sha(commit):
+    if "sha" in commit:
+        return commit["sha"], commit["commit"]["message"].split("\n")[0]
+    else:
+        return "", ""
+
+
 def get_sha(branch, repo_url):
     """Resolves the git branch to sha commit"""
-    api_url = repo_url.replace("https://github.com", "https://api.github.com/repos")
     try:
-        commit = requests.get(api_url + "/commits/" + branch).json()
+        commit = github.get_commit(repo_url, branch)
     except:
         raise Exception("Unable to access developer repository")
-    if "sha" in commit:
-        return commit["sha"], commit["commit"]["message"].split("\n")[0]
-    else:
-        return "", ""
+    return commit_sha(commit)
 
 
 def get_net(commit_sha, repo_url):
     """Get the net from evaluate.h or ucioption.cpp in the repo"""
-    api_url = repo_url.replace(
-        "https://github.com", "https://raw.githubusercontent.com"
-    )
     try:
         net = None
 
-        url1 = api_url + "/" + commit_sha + "/src/evaluate.h"
-        options = requests.get(url1).content.decode("utf-8")
+        options = github.get_file(repo_url, commit_sha, "src/evaluate.h")
         for line in options.splitlines():
             if "EvalFileDefaultName" in line and "define" in line:
                 p = re.compile("nn-[a-z0-9]{12}.nnue")
@@ -507,8 +515,7 @@ def get_net(commit_sha, repo_url):
         if net:
             return net
 
-        url2 = api_url + "/" + commit_sha + "/src/ucioption.cpp"
-        options = requests.get(url2).content.decode("utf-8")
+        options = github.get_file(repo_url, commit_sha, "src/ucioption.cpp")
         for line in options.splitlines():
             if "EvalFile" in line and "Option" in line:
                 p = re.compile("nn-[a-z0-9]{12}.nnue")
@@ -517,7 +524,9 @@ def get_net(commit_sha, repo_url):
                     net = m.group(0)
         return net
     except:
-        raise Exception("Unable to access developer repository: " + api_url)
+        raise Exception(
+            "Unable to access developer repository: " + github.raw_url(repo_url)
+        )
 
 
 def parse_spsa_params(raw, spsa):
@@ -579,16 +588,25 @@ def validate_form(request):
         s = re.sub(r"\n+", r"\n", s)
         return s.rstrip()
 
-    # Fill new_signature/info from commit info if left blank
-    if len(data["new_signature"]) == 0 or len(data["info"]) == 0:
-        api_url = data["tests_repo"].replace(
-            "https://github.com", "https://api.github.com/repos"
-        )
-        api_url += "/commits" + "/" + data["new_tag"]
+    def developer_repo(future):
         try:
-            c = requests.get(api_url).json()
+            return future.result()
         except:
             raise Exception("Unable to access developer repository")
+
+    # The independent GitHub lookups are done concurrently.
+    tests_repo = data["tests_repo"]
+    new_commit = github.submit(github.get_commit, tests_repo, data["new_tag"])
+    if "resolved_base" not in request.POST:
+        base_commit = github.submit(github.get_commit, tests_repo, data["base_tag"])
+    if len(data["book"]) > 0:
+        books = github.submit(github.get_books)
+    if data["base_tag"] == "master":
+        master_commits = github.submit(github.get_commits, tests_repo)
+
+    # Fill new_signature/info from commit info if left blank
+    if len(data["new_signature"]) == 0 or len(data["info"]) == 0:
+        c = developer_repo(new_commit)
         if "commit" not in c:
             raise Exception("Cannot find branch in developer repository")
         if len(data["new_signature"]) == 0:
@@ -607,8 +625,7 @@ def validate_form(request):
 
     # Check that the book exists in the official books repo
     if len(data["book"]) > 0:
-        api_url = "https://api.github.com/repos/official-stockfish/books/contents"
-        c = requests.get(api_url).json()
+        c = books.result()
         matcher = re.compile(r"\.(epd|pgn)\.zip$")
         valid_book_filenames = [
             file["name"] for file in c if matcher.search(file["name"])
@@ -636,12 +653,10 @@ def validate_form(request):
         data["msg_base"] = request.POST["msg_base"]
         data["msg_new"] = request.POST["msg_new"]
     else:
-        data["resolved_base"], data["msg_base"] = get_sha(
-            data["base_tag"], data["tests_repo"]
-        )
-        data["resolved_new"], data["msg_new"] = get_sha(
-            data["new_tag"], data["tests_repo"]
+        data["resolved_base"], data["msg_base"] = commit_sha(
+            developer_repo(base_commit)
         )
+        data["resolved_new"], data["msg_new"] = commit_sha(developer_repo(new_commit))
         u = request.userdb.get_user(data["username"])
         if u.get("tests_repo", "") != data["tests_repo"]:
             u["tests_repo"] = data["tests_repo"]
@@ -650,15 +665,16 @@ def validate_form(request):
     if len(data["resolved_base"]) == 0 or len(data["resolved_new"]) == 0:
         raise Exception("Unable to find branch!")
 
+    # The lookups which need the resolved commits.
+    master_diff = github.submit(github.get_master_diff, data["resolved_base"][:10])
+    new_net = github.submit(get_net, data["resolved_new"], tests_repo)
+    base_net = github.submit(get_net, data["resolved_base"], tests_repo)
+
     # Check entered bench
     if data["base_tag"] == "master":
         found = False
-        api_url = data["tests_repo"].replace(
-            "https://github.com", "https://api.github.com/repos"
-        )
-        api_url += "/commits"
         bs = re.compile(r"(^|\s)[Bb]ench[ :]+([0-9]+)", re.MULTILINE)
-        for c in requests.get(api_url).json():
+        for c in master_commits.result():
             m = bs.search(c["commit"]["message"])
             if m:
                 found = True
@@ -672,15 +688,10 @@ def validate_form(request):
     stop_rule = request.POST["stop_rule"]
 
     # Check if the base branch of the test repo matches official master
-    api_url = "https://api.github.com/repos/official-stockfish/Stockfish"
-    api_url += "/compare/master..." + data["resolved_base"][:10]
-    master_diff = requests.get(
-        api_url, headers={"Accept": "application/vnd.github.v3.diff"}
-    )
-    data["base_same_as_master"] = master_diff.text == ""
+    data["base_same_as_master"] = master_diff.result() == ""
 
     # Test existence of net
-    new_net = get_net(data["resolved_new"], data["tests_repo"])
+    new_net = new_net.result()
     if new_net:
         if not request.rundb.get_nn(new_net):
             raise Exception(
@@ -691,7 +702,7 @@ def validate_form(request):
 
     # Store net info
     data["new_net"] = new_net
-    data["base_net"] = get_net(data["resolved_base"], data["tests_repo"])
+    data["base_net"] = base_net.result()
 
     # Integer parameters
 
@@ -965,8 +976,8 @@ def tests_delete(request):
 
         run["deleted"] = True
         run["finished"] = True
-        for task in run["tasks"]:
-            task["active"] = False
+        for task_id in range(len(run["tasks"])):
+            request.rundb.set_inactive_task(task_id, run)
         request.rundb.buffer(run, True)
         request.rundb.task_time = 0
 
@@ -1135,7 +1146,7 @@ def tests_view(request):
         page_title = "{} games - {} vs {}".format(
             run["args"]["num_games"], run["args"]["new_tag"], run["args"]["base_tag"]
         )
-    chi2 = get_chi2(run["tasks"])
+    chi2 = request.rundb.get_chi2(run)
     update_residuals(run["tasks"], cached_chi2=chi2)
     return {
         "run": run,
@@ -1157,6 +1168,9 @@ def get_paginated_finished_runs(request):
 
     page_idx = max(0, int(request.params.get("page", 1)) - 1)
     page_size = 25
+    # The "Next" links carry the position of the last run on the page,
+    # so that browsing forward does not use skip.
+    after = parse_cursor(request.params.get("after", ""))
     finished_runs, num_finished_runs = request.rundb.get_finished_runs(
         username=username,
         success_only=success_only,
@@ -1164,6 +1178,7 @@ def get_paginated_finished_runs(request):
         ltc_only=ltc_only,
         skip=page_idx * page_size,
         limit=page_size,
+        after=after,
     )
 
     pages = [
@@ -1188,10 +1203,13 @@ def get_paginated_finished_runs(request):
             )
         elif pages[-1]["idx"] != "...":
             pages.append({"idx": "...", "url": "", "state": "disabled"})
+    next_url = "?page={}".format(page_idx + 2)
+    if finished_runs:
+        next_url += "&after={}".format(format_cursor(finished_runs[-1]))
     pages.append(
         {
             "idx": "Next",
-            "url": "?page={}".format(page_idx + 2),
+            "url": next_url,
             "state": "disabled"
             if page_idx >= (num_finished_runs - 1) // page_size
             else "",
@@ -1208,8 +1226,12 @@ def get_paginated_finished_runs(request):
 
     failed_runs = []
     for run in finished_runs:
-        # Ensure finished runs have results_info
-        results = request.rundb.get_results(run)
+        # Ensure finished runs have results_info. The runs are fetched
+        # without their tasks, so stale results need the full run.
+        if run["results_stale"]:
+            results = request.rundb.get_results(request.rundb.get_run(run["_id"]))
+        else:
+            results = run["results"]
         if "results_info" not in run:
             run["results_info"] = format_results(results, run)
 
@@ -1243,20 +1265,11 @@ def tests_user(request):
 
 def homepage_results(request):
     # Calculate games_per_minute from current machines
-    games_per_minute = 0.0
     machines = request.rundb.get_machines()
+    games_per_minute = request.rundb.machines_totals(machines)["games_per_minute"]
     for machine in machines:
         diff = diff_date(machine["last_updated"])
         machine["last_updated"] = delta_date(diff)
-        if machine["nps"] != 0:
-            games_per_minute += (
-                (machine["nps"] / 1280000.0)
-                * (60.0 / estimate_game_duration(machine["run"]["args"]["tc"]))
-                * (
-                    int(machine["concurrency"])
-                    // machine["run"]["args"].get("threads", 1)
-                )
-            )
     machines.reverse()
     # Get updated results for unfinished runs + finished runs
     (runs, pending_hours, cores, nps) = request.rundb.aggregate_unfinished_runs()
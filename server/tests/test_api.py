@@ -4,8 +4,9 @@ import sys
 import unittest
 import zlib
 
+from bson.objectid import ObjectId
 from fishtest.api import WORKER_VERSION, ApiView
-from pyramid.httpexceptions import HTTPUnauthorized
+from pyramid.httpexceptions import HTTPBadRequest, HTTPUnauthorized
 from pyramid.testing import DummyRequest
 from util import get_rundb
 
@@ -144,9 +145,16 @@ class TestApi(unittest.TestCase):
 
     def test_get_active_runs(self):
         run_id = new_run(self)
+        run = self.rundb.get_run(run_id)
+        run["bad_tasks"] = []
+        self.rundb.buffer(run, True)
         request = DummyRequest(rundb=self.rundb)
         response = ApiView(request).active_runs()
         self.assertTrue(run_id in response)
+        # Served from the run summaries, but with the keys of the run.
+        self.assertEqual(response[run_id]["tasks"], [])
+        self.assertEqual(response[run_id]["bad_tasks"], [])
+        self.assertEqual(set(response[run_id]), set(run))
 
     def test_get_run(self):
         run_id = new_run(self)
@@ -161,6 +169,26 @@ class TestApi(unittest.TestCase):
         # /api/get_elo only works for SPRT
         self.assertFalse(response)
 
+    def test_get_metrics(self):
+        run_id = new_run(self)
+        self.rundb.get_run(run_id)
+        request = DummyRequest(rundb=self.rundb)
+        response = ApiView(request).get_metrics()
+        self.assertEqual(response.content_type, "text/plain")
+        lines = response.text.splitlines()
+        self.assertIn("# TYPE fishtest_lock_wait_seconds histogram", lines)
+        self.assertIn(
+            'fishtest_lock_wait_seconds_bucket{lock="run_cache_lock",le="+Inf"}',
+            response.text,
+        )
+        self.assertIn("# TYPE fishtest_run_cache_hits_total counter", lines)
+        hits = [l for l in lines if l.startswith("fishtest_run_cache_hits_total ")]
+        self.assertEqual(len(hits), 1)
+        self.assertGreater(int(hits[0].split()[1]), 0)
+        self.assertTrue(
+            any(l.startswith("fishtest_flush_backlog_runs ") for l in lines)
+        )
+
     def test_request_task(self):
         stop_all_runs(self)
 
@@ -187,6 +215,42 @@ class TestApi(unittest.TestCase):
         task = run["tasks"][task_id]
         self.assertTrue(task["active"])
 
+        # The incrementally updated scheduler index should agree
+        # with a full rebuild.
+        connections_counter = dict(self.rundb.connections_counter)
+        task_counters = {
+            k: dict(v) for k, v in self.rundb.task_counters.items() if k in runs
+        }
+        self.rundb.rebuild_scheduler_index()
+        self.assertEqual(connections_counter, self.rundb.connections_counter)
+        for k, v in task_counters.items():
+            self.assertEqual(v, self.rundb.task_counters[k])
+        self.assertEqual(run["cores"], self.concurrency)
+
+        # The task shows up in the machines registry.
+        machines = ApiView(DummyRequest(rundb=self.rundb)).machines()
+        machines = [m for m in machines["machines"] if m["run"] == run_id]
+        self.assertEqual(len(machines), 1)
+        self.assertEqual(machines[0]["username"], self.username)
+        self.assertEqual(machines[0]["task_id"], task_id)
+
+        # The other instances read the machines from the db.
+        self.rundb.flush_all()
+        self.rundb.is_primary_instance = False
+        try:
+            machines = ApiView(DummyRequest(rundb=self.rundb)).machines()
+        finally:
+            self.rundb.is_primary_instance = True
+        machines = [m for m in machines["machines"] if m["run"] == run_id]
+        self.assertEqual(len(machines), 1)
+        self.assertEqual(machines[0]["task_id"], task_id)
+
+        self.rundb.set_inactive_task(task_id, run)
+        self.assertEqual(run["cores"], 0)
+        self.assertEqual(self.rundb.task_counters[run_id]["committed_games"], 0)
+        machines = self.rundb.get_machines()
+        self.assertFalse(any(str(m["run"]["_id"]) == run_id for m in machines))
+
     def test_update_task(self):
         run_id = new_run(self, add_tasks=1)
         run = self.rundb.get_run(run_id)
@@ -307,6 +371,88 @@ class TestApi(unittest.TestCase):
         task = run["tasks"][0]
         self.assertFalse(task["active"])
 
+    def test_update_tasks(self):
+        run_id = new_run(self, add_tasks=2)
+        stats = {
+            "wins": 2,
+            "draws": 0,
+            "losses": 0,
+            "crashes": 0,
+            "time_losses": 0,
+            "pentanomial": [0, 0, 0, 0, 1],
+        }
+        request = self.correct_password_request(
+            {
+                "updates": [
+                    {"run_id": run_id, "task_id": 0, "stats": stats},
+                    {"run_id": run_id, "task_id": 1, "stats": stats},
+                    {"run_id": run_id, "task_id": 2, "stats": stats},
+                ]
+            }
+        )
+        response = ApiView(request).update_tasks()
+        results = response["results"]
+        self.assertEqual(len(results), 3)
+        self.assertTrue(results[0]["task_alive"])
+        self.assertTrue(results[1]["task_alive"])
+        self.assertFalse(results[2]["task_alive"])
+        self.assertTrue("error" in results[2])
+        run = self.rundb.get_run(run_id)
+        self.assertEqual(run["results"]["wins"], 4)
+        self.assertEqual(run["results"]["pentanomial"], [0, 0, 0, 0, 2])
+
+        # Malformed updates are rejected as a whole.
+        request.json_body["updates"].append({"run_id": run_id, "task_id": 0})
+        with self.assertRaises(HTTPBadRequest):
+            ApiView(request).update_tasks()
+
+    def test_update_tasks_next_task(self):
+        stop_all_runs(self)
+        run_id = new_run(self, add_tasks=1)
+        stats = {
+            "wins": 0,
+            "draws": 100,
+            "losses": 0,
+            "crashes": 0,
+            "time_losses": 0,
+            "pentanomial": [0, 0, 50, 0, 0],
+        }
+        request = self.correct_password_request(
+            {"updates": [{"run_id": run_id, "task_id": 0, "stats": stats}]}
+        )
+        request.json_body["next_run"] = True
+        # The hint follows the order of the runs from the last task request.
+        self.rundb.task_time = 0
+        self.rundb.refresh_task_runs()
+        self.rundb.sort_task_runs(self.unique_key)
+        response = ApiView(request).update_tasks()
+        self.assertTrue(response["results"][0]["task_alive"])
+        # A hint only: no task is created.
+        self.assertEqual(response["next_run"]["_id"], run_id)
+        self.assertEqual(response["next_run"]["args"]["tests_repo"], "travis")
+        self.assertEqual(len(self.rundb.get_run(run_id)["tasks"]), 1)
+
+        stats = dict(stats, draws=self.chunk_size, pentanomial=[0, 0, 100, 0, 0])
+        request = self.correct_password_request(
+            {"updates": [{"run_id": run_id, "task_id": 0, "stats": stats}]}
+        )
+        request.json_body["next_task"] = True
+        response = ApiView(request).update_tasks()
+        self.assertFalse(response["results"][0]["task_alive"])
+        self.assertNotIn("next_run", response)
+        next_task = response["next_task"]
+        self.assertEqual(next_task["run"]["_id"], run_id)
+        self.assertEqual(next_task["task_id"], 1)
+        run = self.rundb.get_run(run_id)
+        self.assertTrue(run["tasks"][1]["active"])
+        self.assertEqual(run["tasks"][1]["worker_info"]["unique_key"], self.unique_key)
+
+        # The response was lost and the worker sends its final update
+        # again: it gets the same task.
+        response = ApiView(request).update_tasks()
+        self.assertEqual(response["next_task"]["task_id"], 1)
+        self.assertEqual(len(self.rundb.get_run(run_id)["tasks"]), 2)
+
     def test_failed_task(self):
         run_id = new_run(self, add_tasks=1)
         run = self.rundb.get_run(run_id)
@@ -394,7 +540,23 @@ class TestApi(unittest.TestCase):
         pgn_filename_prefix = "{}-{}".format(run_id, 0)
         pgn = self.rundb.get_pgn(pgn_filename_prefix)
         self.assertEqual(pgn, pgn_text)
-        self.rundb.pgndb.delete_one({"run_id": pgn_filename_prefix})
+
+        # The downloads are streamed.
+        self.rundb.upload_pgn(
+            "{}-{}".format(run_id, 1), zlib.compress(pgn_text.encode("utf-8"))
+        )
+        request = DummyRequest(
+            rundb=self.rundb, matchdict={"id": pgn_filename_prefix + ".pgn"}
+        )
+        response = ApiView(request).download_pgn()
+        self.assertEqual(response.content_type, "application/x-chess-pgn")
+        self.assertEqual(b"".join(response.app_iter).decode(), pgn_text)
+        request = DummyRequest(rundb=self.rundb, matchdict={"id": run_id})
+        response = ApiView(request).download_run_pgns()
+        self.assertEqual(b"".join(response.app_iter).decode(), 2 * pgn_text)
+
+        self.assertEqual(self.rundb.purge_pgns([run_id]), 2)
+        self.assertIsNone(self.rundb.get_pgn(pgn_filename_prefix))
 
     def test_request_spsa(self):
         run_id = new_run(self, add_tasks=1)
@@ -424,6 +586,43 @@ class TestApi(unittest.TestCase):
         response = ApiView(self.correct_password_request()).request_version()
         self.assertEqual(WORKER_VERSION, response["version"])
 
+        # The session token replaces the password check.
+        token = response["token"]
+        request = self.build_json_request(
+            {
+                "password": "wrong password",
+                "token": token,
+                "worker_info": self.worker_info,
+            }
+        )
+        ApiView(request).validate_username_password("/api/beat")
+
+        # But not for getting a new token.
+        with self.assertRaises(HTTPUnauthorized):
+            ApiView(request).request_version()
+
+        # Tampered tokens are rejected.
+        request.json_body["token"] = token[:-1] + ("0" if token[-1] != "0" else "1")
+        with self.assertRaises(HTTPUnauthorized):
+            ApiView(request).validate_username_password("/api/beat")
+
+        # Blocking the user on another instance revokes the token once the
+        # snapshot of the users is refreshed.
+        request.json_body["token"] = token
+        self.rundb.userdb.users.update_one(
+            {"username": self.username}, {"$set": {"blocked": True}}
+        )
+        self.rundb.userdb.refresh_token_users()
+        try:
+            with self.assertRaises(HTTPUnauthorized):
+                ApiView(request).validate_username_password("/api/beat")
+        finally:
+            self.rundb.userdb.users.update_one(
+                {"username": self.username}, {"$set": {"blocked": False}}
+            )
+            self.rundb.userdb.refresh_token_users()
+        ApiView(request).validate_username_password("/api/beat")
+
     def test_beat(self):
         run_id = new_run(self, add_tasks=1)
 
@@ -437,6 +636,46 @@ class TestApi(unittest.TestCase):
         response.pop("duration", None)
         self.assertEqual(response, {})
 
+        # A beat does not dirty the run, it goes to the liveness index.
+        cache, _, _ = self.rundb.run_cache_shard(run_id)
+        self.assertFalse(cache[run_id]["dirty"])
+        last_updated = self.rundb.get_run(run_id)["tasks"][0]["last_updated"]
+        self.assertEqual(list(self.rundb.liveness[run_id]), [0])
+        self.assertEqual(self.rundb.liveness[run_id][0]["last_updated"], last_updated)
+        self.rundb.flush_beats()
+        run = self.rundb.runs.find_one({"_id": ObjectId(run_id)})
+        self.assertAlmostEqual(
+            run["tasks"][0]["last_updated"],
+            last_updated,
+            delta=datetime.timedelta(milliseconds=1),
+        )
+        self.assertEqual(self.rundb.beats, {})
+
+        # An older beat does not overwrite a newer last_updated.
+        self.rundb.beats[(run_id, 0)] = last_updated - datetime.timedelta(minutes=1)
+        self.rundb.flush_beats()
+        run = self.rundb.runs.find_one({"_id": ObjectId(run_id)})
+        self.assertAlmostEqual(
+            run["tasks"][0]["last_updated"],
+            last_updated,
+            delta=datetime.timedelta(milliseconds=1),
+        )
+        # A beat of a task that is not in the db yet does not pad the tasks.
+        self.rundb.beats[(run_id, 3)] = last_updated
+        self.rundb.flush_beats()
+        run = self.rundb.runs.find_one({"_id": ObjectId(run_id)})
+        self.assertEqual(len(run["tasks"]), 1)
+
+        # Only the latest deadline of a task counts.
+        ApiView(request).beat()
+        last_updated = self.rundb.get_run(run_id)["tasks"][0]["last_updated"]
+        timeout = self.rundb.task_timeout
+        expired = self.rundb.expired_tasks(last_updated + timeout / 2)
+        self.assertNotIn(run_id, expired)
+        expired = self.rundb.expired_tasks(last_updated + 2 * timeout)
+        self.assertEqual(expired[run_id], [0])
+        self.assertEqual(self.rundb.expired_tasks(last_updated + 2 * timeout), {})
+
 
 class TestRunFinished(unittest.TestCase):
     @classmethod
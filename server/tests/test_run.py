@@ -1,7 +1,42 @@
+import json
 import re
+import threading
 import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
 
-from fishtest.views import get_master_bench
+from fishtest import github
+from fishtest.views import get_master_bench, get_net, get_sha
+
+SHA = "0123456789abcdef0123456789abcdef01234567"
+
+stub_responses = {
+    "/repos/official-stockfish/Stockfish/commits": [
+        {"sha": SHA, "commit": {"message": "Simplify eval\n\nBench: 1234567"}}
+    ],
+    "/repos/tester/Stockfish/commits/master": {
+        "sha": SHA,
+        "commit": {"message": "Simplify eval\n\nBench: 1234567"},
+    },
+    "/tester/Stockfish/{}/src/evaluate.h".format(SHA): (
+        '  #define EvalFileDefaultName   "nn-0123456789ab.nnue"\n'
+    ),
+}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(self.path)
+        response = stub_responses.get(self.path)
+        self.send_response(200 if response is not None else 404)
+        self.end_headers()
+        if not isinstance(response, str):
+            response = json.dumps(response if response is not None else {})
+        self.wfile.write(response.encode("utf-8"))
+
+    def log_message(self, *args):
+        pass
 
 
 class CreateRunTest(unittest.TestCase):
@@ -9,5 +44,35 @@ class CreateRunTest(unittest.TestCase):
         self.assertTrue(re.match("[0-9]{7}|None", str(get_master_bench())))
 
 
+class GitHubStubTest(unittest.TestCase):
+    def setUp(self):
+        self.server = HTTPServer(("127.0.0.1", 0), StubHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        url = "http://127.0.0.1:{}".format(self.server.server_port)
+        self.urls = github.GITHUB_API, github.GITHUB_RAW
+        github.GITHUB_API = github.GITHUB_RAW = url
+        github.clear_cache()
+        StubHandler.requests = []
+
+    def tearDown(self):
+        github.GITHUB_API, github.GITHUB_RAW = self.urls
+        github.clear_cache()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_cached_lookups(self):
+        repo = "https://github.com/tester/Stockfish"
+        for i in range(2):
+            self.assertEqual(get_master_bench(), "1234567")
+            self.assertEqual(get_sha("master", repo), (SHA, "Simplify eval"))
+            self.assertEqual(get_net(SHA, repo), "nn-0123456789ab.nnue")
+        # Each url is only requested once.
+        self.assertEqual(len(StubHandler.requests), 3)
+        # Failed lookups are not cached.
+        self.assertEqual(get_sha("unknown", repo), ("", ""))
+        self.assertEqual(get_sha("unknown", repo), ("", ""))
+        self.assertEqual(len(StubHandler.requests), 5)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -1,10 +1,14 @@
 import datetime
 import sys
+import threading
+import time
 import unittest
 
 import util
 from fishtest.api import WORKER_VERSION
+from fishtest.util import format_cursor, get_bad_workers, get_chi2, parse_cursor
 from pymongo import DESCENDING
+from pymongo.errors import PyMongoError
 
 run_id = None
 
@@ -115,6 +119,8 @@ class CreateRunDBTest(unittest.TestCase):
                 print(run["args"])
 
     def test_20_update_task(self):
+        user_stats = self.rundb.userdb.user_stats
+        stats = user_stats.find_one({"_id": "JoeUserWorker"}) or {"games": 0}
         run = self.rundb.get_run(run_id)
         run["tasks"][0]["active"] = True
         run["tasks"][0]["worker_info"] = self.worker_info
@@ -168,6 +174,10 @@ class CreateRunDBTest(unittest.TestCase):
             {},
         )
         self.assertEqual(run, {"task_alive": True})
+        # The running totals should agree with a full recomputation.
+        run_ = self.rundb.get_run(run_id)
+        self.assertFalse(run_["results_stale"])
+        self.assertEqual(run_["results"], self.rundb.compute_results(run_))
         run = self.rundb.update_task(
             self.worker_info,
             run_id,
@@ -182,6 +192,305 @@ class CreateRunDBTest(unittest.TestCase):
             {},
         )
         self.assertEqual(run, {"task_alive": False})
+        # The accepted games are added to the counters of the user.
+        self.rundb.flush_user_stats()
+        stats_ = user_stats.find_one({"_id": "JoeUserWorker"})
+        self.assertEqual(stats_["games"], stats["games"] + self.chunk_size)
+        day = stats_["days"][datetime.datetime.utcnow().strftime("%Y-%m-%d")]
+        self.assertGreaterEqual(day["games"], self.chunk_size)
+
+    def test_22_incremental_chi2(self):
+        run = {"_id": "chi2", "tasks": []}
+        for i in range(12):
+            run["tasks"].append(
+                {
+                    "worker_info": {"unique_key": "worker{}".format(i % 4)},
+                    "stats": {"pentanomial": [5, 20, 40, 20, 5]},
+                }
+            )
+        self.rundb.get_chi2(run)
+        stats = [
+            (0, [10, 40, 80, 40, 10]),
+            (5, [2, 10, 30, 40, 30]),
+            (11, [10, 40, 80, 40, 10]),
+        ]
+        for task_id, pentanomial in stats:
+            self.rundb.update_task_stats(
+                run, run["tasks"][task_id], {"pentanomial": pentanomial}
+            )
+        # A worker which was not in the table yet.
+        run["tasks"].append(
+            {"worker_info": {"unique_key": "worker4"}, "stats": {}},
+        )
+        self.rundb.update_task_stats(
+            run, run["tasks"][-1], {"pentanomial": [5, 20, 40, 20, 5]}
+        )
+        chi2, chi2_ = self.rundb.get_chi2(run), get_chi2(run["tasks"])
+        self.assertEqual(chi2["residual"].keys(), chi2_["residual"].keys())
+        for key in ("chi2", "dof", "p", "z_95", "z_99"):
+            self.assertAlmostEqual(chi2[key], chi2_[key])
+        for key, residual in chi2["residual"].items():
+            self.assertAlmostEqual(residual, chi2_["residual"][key])
+        self.assertIs(self.rundb.get_chi2(run), chi2)
+
+        # The tables of the other runs have their own locks.
+        with self.rundb.chi2_entry("chi2")["lock"]:
+            other = {"_id": "chi2_other", "tasks": run["tasks"]}
+            self.assertIsNotNone(self.rundb.get_chi2(other))
+
+    def test_23_bad_workers(self):
+        tasks = []
+        for i in range(40):
+            pentanomial = (
+                [50, 200, 500, 200, 50] if i >= 3 else [5, 90, 400, 350, 150 + i]
+            )
+            tasks.append(
+                {
+                    "worker_info": {"unique_key": "worker{}".format(i)},
+                    "stats": {"pentanomial": pentanomial},
+                }
+            )
+        # The workers excluded one at a time by full recomputations.
+        bad_workers = set()
+        for i in range(5):
+            chi2 = get_chi2(tasks, exclude_workers=bad_workers)
+            residuals = chi2["residual"]
+            worst = max(residuals, key=residuals.get)
+            if chi2["p"] >= 0.001 and residuals[worst] <= 7.0:
+                break
+            bad_workers.add(worst)
+        self.assertEqual(len(bad_workers), 3)
+        self.assertEqual(get_bad_workers(tasks, iters=5), bad_workers)
+        chi2 = get_chi2(tasks)
+        self.assertEqual(get_bad_workers(tasks, cached_chi2=chi2, iters=5), bad_workers)
+
+    def test_24_admission_control(self):
+        rundb = self.rundb
+        rundb.task_latency_ewma = 0.01
+        self.assertEqual(rundb.task_limit(), rundb.task_limit_max)
+        # A slow scheduler admits a single request at a time.
+        rundb.task_latency_ewma = rundb.task_max_wait
+        self.assertEqual(rundb.task_limit(), 1)
+        self.assertTrue(rundb.admit_task_request())
+        try:
+            # The other requests are rejected without waiting.
+            t0 = time.time()
+            self.assertFalse(rundb.admit_task_request())
+            self.assertLess(time.time() - t0, 0.1)
+            ret = rundb.request_task({"unique_key": "admission"})
+            self.assertFalse(ret["task_waiting"])
+            # The retry slots of the rejected requests are spread.
+            first = ret["retry_after"]
+            self.assertGreaterEqual(first, 1.0)
+            self.assertGreater(rundb.task_retry_after(), first)
+        finally:
+            rundb.release_task_request()
+            rundb.task_latency_ewma = 0.05
+        self.assertEqual(rundb.task_active, 0)
+
+        # The limit leaves threads of the server for the other requests.
+        self.assertEqual(rundb.task_limit_max, 2)
+
+        # The latency includes the time spent waiting for task_lock.
+        rundb.sync_request_task = lambda worker_info: {"task_waiting": False}
+        rundb.task_latency_ewma = 0.0
+        thread = threading.Thread(target=rundb.request_task, args=({},))
+        try:
+            with rundb.task_lock:
+                thread.start()
+                time.sleep(0.2)
+            thread.join()
+        finally:
+            del rundb.sync_request_task
+        self.assertGreaterEqual(rundb.task_latency_ewma, 0.02)
+        rundb.task_latency_ewma = 0.05
+
+    def test_25_partial_flush(self):
+        run_id_flush = self.rundb.new_run(
+            "master",
+            "master",
+            100000,
+            "10+0.01",
+            "10+0.01",
+            "book",
+            10,
+            1,
+            "",
+            "",
+            username="travis",
+            tests_repo="travis",
+            start_time=datetime.datetime.utcnow(),
+        )
+        run = self.rundb.get_run(run_id_flush)
+        task = {
+            "num_games": self.chunk_size,
+            "stats": {"wins": 0, "draws": 0, "losses": 0, "crashes": 0},
+            "active": True,
+        }
+        run["tasks"].append(task)
+        self.rundb.buffer(run, False, ["tasks.0"])
+        self.rundb.flush_all()
+        run["tasks"][0]["stats"]["wins"] = 2
+        run["results"]["wins"] = 2
+        run["approver"] = "not flushed"
+        self.rundb.buffer(run, False, ["tasks.0.stats", "results", "tasks.0"])
+        self.rundb.flush_all()
+        run_ = self.rundb.runs.find_one({"_id": run["_id"]})
+        self.assertEqual(run_["tasks"], run["tasks"])
+        self.assertEqual(run_["results"], run["results"])
+        self.assertEqual(run_["approver"], "")
+
+    def test_27_run_summaries(self):
+        run_id_homepage = self.rundb.new_run(
+            "master",
+            "master",
+            100000,
+            "10+0.01",
+            "10+0.01",
+            "book",
+            10,
+            1,
+            "",
+            "",
+            username="travis",
+            tests_repo="travis",
+            start_time=datetime.datetime.utcnow(),
+        )
+        rows = {str(row["_id"]): row for row in self.rundb.get_run_summaries()}
+        self.assertIn(str(run_id_homepage), rows)
+        self.assertNotIn("tasks", rows[str(run_id_homepage)])
+
+        # The summaries don't share anything with the cached run.
+        run = self.rundb.get_run(run_id_homepage)
+        summary = rows[str(run_id_homepage)]
+        summary["args"]["tc"] = "1+0"
+        summary["results"]["wins"] = 5
+        self.assertEqual(run["args"]["tc"], "10+0.01")
+        self.assertEqual(run["results"]["wins"], 0)
+
+        # The other instances don't see the changes made by the primary
+        # instance in their run cache, so they read the db.
+        self.rundb.runs.update_one(
+            {"_id": run_id_homepage}, {"$set": {"results.wins": 7}}
+        )
+        self.rundb.is_primary_instance = False
+        try:
+            rows = {str(row["_id"]): row for row in self.rundb.get_run_summaries()}
+        finally:
+            self.rundb.is_primary_instance = True
+        self.assertEqual(rows[str(run_id_homepage)]["results"]["wins"], 7)
+        self.assertEqual(rows[str(run_id_homepage)]["state"], "pending")
+        self.assertNotIn("tasks", rows[str(run_id_homepage)])
+
+        run = self.rundb.get_run(run_id_homepage)
+        run["finished"] = True
+        self.rundb.buffer(run, True)
+        rows = {str(row["_id"]): row for row in self.rundb.get_run_summaries()}
+        self.assertNotIn(str(run_id_homepage), rows)
+
+    def test_28_separate_tasks(self):
+        self.rundb.separate_tasks = True
+        run_id_tasks = str(
+            self.rundb.new_run(
+                "master",
+                "master",
+                100000,
+                "10+0.01",
+                "10+0.01",
+                "book",
+                10,
+                1,
+                "",
+                "",
+                username="travis",
+                tests_repo="travis",
+                start_time=datetime.datetime.utcnow(),
+            )
+        )
+        run = self.rundb.get_run(run_id_tasks)
+        for i in range(2):
+            task = {
+                "num_games": self.chunk_size,
+                "stats": {"wins": 0, "draws": 0, "losses": 0, "crashes": 0},
+                "active": True,
+            }
+            run["tasks"].append(task)
+        self.rundb.buffer(run, True)
+        run_ = self.rundb.runs.find_one({"_id": run["_id"]})
+        self.assertNotIn("tasks", run_)
+        self.assertEqual(self.rundb.tasks.count_documents({"run_id": run_id_tasks}), 2)
+
+        # A partial write only touches the document of the task.
+        run["tasks"][1]["stats"]["wins"] = 3
+        self.rundb.buffer(run, False, ["tasks.1.stats"])
+        self.rundb.flush_all()
+        task = self.rundb.tasks.find_one({"_id": run_id_tasks + "/1"})
+        self.assertEqual(task["task"], run["tasks"][1])
+
+        # Reload the run from the db.
+        cache, _, _ = self.rundb.run_cache_shard(run_id_tasks)
+        del cache[run_id_tasks]
+        run_ = self.rundb.get_run(run_id_tasks)
+        self.assertEqual(run_["tasks"], run["tasks"])
+        self.rundb.tasks.delete_many({"run_id": run_id_tasks})
+
+    def test_29_separate_tasks_write_order(self):
+        run_id_tasks = str(
+            self.rundb.new_run(
+                "master",
+                "master",
+                100000,
+                "10+0.01",
+                "10+0.01",
+                "book",
+                10,
+                1,
+                "",
+                "",
+                username="travis",
+                tests_repo="travis",
+                start_time=datetime.datetime.utcnow(),
+            )
+        )
+        # A run that still embeds its tasks.
+        self.rundb.separate_tasks = False
+        run = self.rundb.get_run(run_id_tasks)
+        for i in range(2):
+            task = {
+                "num_games": self.chunk_size,
+                "stats": {"wins": 0, "draws": 0, "losses": 0, "crashes": 0},
+                "active": True,
+            }
+            run["tasks"].append(task)
+        self.rundb.buffer(run, True)
+        cache, lock, write_lock = self.rundb.run_cache_shard(run_id_tasks)
+        del cache[run_id_tasks]
+
+        # Loading it marks it for migration. If the tasks cannot be
+        # written, the run document must still hold them.
+        self.rundb.separate_tasks = True
+        self.rundb.get_run(run_id_tasks)
+
+        class FailingTasks:
+            def bulk_write(self, *args, **kwargs):
+                raise PyMongoError("tasks write failed")
+
+        tasks = self.rundb.tasks
+        self.rundb.tasks = FailingTasks()
+        try:
+            with self.assertRaises(PyMongoError):
+                self.rundb.flush_shard(cache, lock, write_lock, time.time())
+        finally:
+            self.rundb.tasks = tasks
+        run_ = self.rundb.runs.find_one({"_id": run["_id"]})
+        self.assertEqual(len(run_["tasks"]), 2)
+
+        # The next flush migrates it.
+        self.rundb.flush_shard(cache, lock, write_lock, time.time())
+        run_ = self.rundb.runs.find_one({"_id": run["_id"]})
+        self.assertNotIn("tasks", run_)
+        self.assertEqual(self.rundb.tasks.count_documents({"run_id": run_id_tasks}), 2)
+        self.rundb.tasks.delete_many({"run_id": run_id_tasks})
 
     def test_30_finish(self):
         print("run_id: {}".format(run_id))
@@ -194,6 +503,125 @@ class CreateRunDBTest(unittest.TestCase):
         for run in finished_runs:
             print(run["args"]["tc"])
 
+    def test_45_finished_runs_pages(self):
+        run_ids = []
+        for i in range(3):
+            run_id_finished = self.rundb.new_run(
+                "master",
+                "master",
+                100000,
+                "10+0.01",
+                "10+0.01",
+                "book",
+                10,
+                1,
+                "",
+                "",
+                username="travis",
+                tests_repo="travis",
+                start_time=datetime.datetime.utcnow(),
+            )
+            run = self.rundb.get_run(run_id_finished)
+            run["finished"] = True
+            self.rundb.buffer(run, True)
+            run_ids.append(run_id_finished)
+        runs, count = self.rundb.get_finished_runs(username="travis", limit=2)
+        self.assertEqual(count, 3)
+        self.assertNotIn("tasks", runs[0])
+        after = parse_cursor(format_cursor(runs[-1]))
+        runs_, count = self.rundb.get_finished_runs(
+            username="travis", limit=2, after=after
+        )
+        self.assertEqual(len(runs_), 1)
+        self.assertEqual(sorted(run["_id"] for run in runs + runs_), sorted(run_ids))
+
+        # The cached count follows the runs that change status.
+        run = self.rundb.get_run(run_ids[0])
+        run["finished"] = False
+        self.rundb.buffer(run, True)
+        self.assertEqual(self.rundb.get_finished_runs(username="travis")[1], 2)
+
+        # The other instances count in the db.
+        self.rundb.runs.update_one({"_id": run_ids[1]}, {"$set": {"finished": False}})
+        self.rundb.is_primary_instance = False
+        try:
+            self.assertEqual(self.rundb.get_finished_runs(username="travis")[1], 1)
+        finally:
+            self.rundb.is_primary_instance = True
+
+        # The cached counts are bounded.
+        maxsize = self.rundb.finished_counts_maxsize
+        self.rundb.finished_counts_maxsize = 2
+        try:
+            for username in ("a", "b", "c"):
+                self.rundb.get_finished_runs(username=username)
+            self.assertEqual(len(self.rundb.finished_counts), 2)
+        finally:
+            self.rundb.finished_counts_maxsize = maxsize
+
+    def test_46_purge_run_user_stats(self):
+        run_id_purge = self.rundb.new_run(
+            "master",
+            "master",
+            100000,
+            "10+0.01",
+            "10+0.01",
+            "book",
+            10,
+            1,
+            "",
+            "",
+            username="travis",
+            tests_repo="travis",
+            start_time=datetime.datetime.utcnow(),
+        )
+        run = self.rundb.get_run(run_id_purge)
+        run["tasks"].append(
+            {
+                "num_games": 100,
+                "active": False,
+                "start": 0,
+                "last_updated": datetime.datetime.utcnow(),
+                "worker_info": self.worker_info,
+                "stats": {
+                    "wins": 40,
+                    "losses": 40,
+                    "draws": 20,
+                    "crashes": 5,
+                    "time_losses": 0,
+                    "pentanomial": [0, 20, 10, 20, 0],
+                },
+            }
+        )
+        run["results"] = self.rundb.compute_results(run)
+        run["finished"] = True
+        self.rundb.buffer(run, True)
+        self.rundb.flush_user_stats()
+
+        # The games of the bad task and the revived test are taken back.
+        self.assertEqual(self.rundb.purge_run(run), "")
+        self.assertFalse(run["finished"])
+        counters = self.rundb.user_stats
+        self.assertEqual(counters["JoeUserWorker"]["inc"]["games"], -100)
+        self.assertLess(counters["JoeUserWorker"]["inc"]["cpu_hours"], 0)
+        self.assertEqual(counters["travis"]["inc"]["tests"], -1)
+
+        # Counters that could not be written are kept for the next flush.
+        bulk_write = self.rundb.userdb.user_stats.bulk_write
+
+        def failing_bulk_write(*args, **kwargs):
+            raise Exception("write failed")
+
+        self.rundb.userdb.user_stats.bulk_write = failing_bulk_write
+        try:
+            with self.assertRaises(Exception):
+                self.rundb.flush_user_stats()
+        finally:
+            self.rundb.userdb.user_stats.bulk_write = bulk_write
+        self.assertEqual(counters["JoeUserWorker"]["inc"]["games"], -100)
+        self.rundb.flush_user_stats()
+        self.assertEqual(self.rundb.user_stats, {})
+
     def test_90_delete_runs(self):
         for run in self.rundb.runs.find():
             if run["args"]["username"] == "travis" and "deleted" not in run:
@@ -0,0 +1,114 @@
+import random
+import unittest
+
+import numpy as np
+import scipy.optimize
+from fishtest.stats import LLRcalc, stat_util
+
+
+def secular_brentq(pdf):
+    # The original implementation of LLRcalc.secular().
+    epsilon = 1e-9
+    values = [ai for ai, pi in pdf]
+    l = -1 / max(values)
+    u = -1 / min(values)
+
+    def f(x):
+        return sum([pi * ai / (1 + x * ai) for ai, pi in pdf])
+
+    return scipy.optimize.brentq(f, l + epsilon, u - epsilon)
+
+
+def random_results(rng):
+    n = rng.choice([3, 5])
+    N = rng.choice([2, 10, 100, 1000, 100000])
+    weights = [rng.random() ** 2 + 0.01 for i in range(n)]
+    probs = np.array(weights) / sum(weights)
+    return [
+        int(r)
+        for r in np.random.RandomState(rng.randrange(2**31)).multinomial(N, probs)
+    ]
+
+
+class LLRcalcTest(unittest.TestCase):
+    def setUp(self):
+        rng = random.Random(42)
+        self.cases = [
+            (rng.uniform(-3, 1), rng.uniform(1, 6), random_results(rng))
+            for i in range(200)
+        ]
+
+    def assertClose(self, a, b):
+        self.assertLessEqual(abs(a - b), 1e-9 * max(1, abs(a)))
+
+    def test_secular(self):
+        rng = random.Random(1)
+        for i in range(100):
+            a = [rng.uniform(-1, -0.01), rng.uniform(-1, 1), rng.uniform(0.01, 1)]
+            p = [rng.random() + 0.01 for ai in a]
+            pdf = [(ai, pi / sum(p)) for ai, pi in zip(a, p)]
+            x = LLRcalc.secular(pdf)
+            self.assertAlmostEqual(x, secular_brentq(pdf), delta=1e-8)
+            x_ = LLRcalc.secular_batch(
+                np.array([[ai for ai, pi in pdf]]), np.array([[pi for ai, pi in pdf]])
+            )[0]
+            self.assertAlmostEqual(x, x_, delta=1e-12)
+
+    def test_secular_fallback(self):
+        # Without enough iterations of Newton's method, the solvers fall
+        # back to Brent's method instead of returning the last iterate.
+        pdf = [(-0.5, 0.3), (0.1, 0.3), (0.7, 0.4)]
+        max_iter = LLRcalc.secular_max_iter
+        LLRcalc.secular_max_iter = 1
+        try:
+            x = LLRcalc.secular(pdf)
+            x_ = LLRcalc.secular_batch(
+                np.array([[ai for ai, pi in pdf]]), np.array([[pi for ai, pi in pdf]])
+            )[0]
+        finally:
+            LLRcalc.secular_max_iter = max_iter
+        self.assertAlmostEqual(x, secular_brentq(pdf), delta=1e-8)
+        self.assertAlmostEqual(x_, secular_brentq(pdf), delta=1e-8)
+
+    def test_LLR_batch(self):
+        elo0 = np.array([c[0] for c in self.cases])
+        elo1 = np.array([c[1] for c in self.cases])
+        for n in (3, 5):
+            idx = [i for i, c in enumerate(self.cases) if len(c[2]) == n]
+            results = np.array([self.cases[i][2] for i in idx])
+            logistic = LLRcalc.LLR_logistic_batch(elo0[idx], elo1[idx], results)
+            normalized = LLRcalc.LLR_normalized_batch(elo0[idx], elo1[idx], results)
+            for k, i in enumerate(idx):
+                elo0_, elo1_, results_ = self.cases[i]
+                self.assertClose(
+                    LLRcalc.LLR_logistic(elo0_, elo1_, results_), logistic[k]
+                )
+                self.assertClose(
+                    LLRcalc.LLR_normalized(elo0_, elo1_, results_), normalized[k]
+                )
+
+
+class SPRTeloCacheTest(unittest.TestCase):
+    def test_cache(self):
+        R = {
+            "wins": 65388,
+            "losses": 65804,
+            "draws": 56553,
+            "pentanomial": [10789, 19328, 33806, 19402, 10543],
+        }
+        kwargs = {"elo0": 0, "elo1": 2, "elo_model": "normalized"}
+        stats = stat_util.SPRT_elo_cache_stats
+        a = stat_util.SPRT_elo(R, **kwargs)
+        hits, misses = stats["hits"], stats["misses"]
+        a["ci"][0] = 1000
+        b = stat_util.SPRT_elo(R, **kwargs)
+        self.assertEqual(stats["hits"], hits + 1)
+        self.assertEqual(stats["misses"], misses)
+        self.assertEqual(b, stat_util.compute_SPRT_elo(R, **kwargs))
+        R["draws"] += 2
+        stat_util.SPRT_elo(R, **kwargs)
+        self.assertEqual(stats["misses"], misses + 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
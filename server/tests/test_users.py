@@ -1,8 +1,12 @@
 import datetime
+import os
+import tempfile
+import time
 import unittest
 
 import util
 from fishtest.api import ApiView
+from fishtest.flagdb import FlagDb
 from fishtest.views import login, signup
 from pyramid import testing
 
@@ -107,5 +111,37 @@ class Create90APITest(unittest.TestCase):
         testing.tearDown()
 
 
+class FlagDbTest(unittest.TestCase):
+    def setUp(self):
+        self.rundb = util.get_rundb()
+        f, self.table_path = tempfile.mkstemp(suffix=".csv")
+        with os.fdopen(f, "w") as table:
+            table.write("1.0.0.0,1.0.0.255,AU\n")
+            table.write("2001:db8::,2001:db8::ffff,NL\n")
+            table.write("5.0.0.0,5.255.255.255,DE\n")
+        self.flagdb = FlagDb(self.rundb.db, table_path=self.table_path, maxsize=2)
+
+    def tearDown(self):
+        self.flagdb.flag_cache.delete_many({"country_code": {"$in": ["AU", "DE"]}})
+        os.remove(self.table_path)
+        self.rundb.stop()
+
+    def test_get_flag(self):
+        # The flag is resolved in the background.
+        self.assertIsNone(self.flagdb.get_flag("1.0.0.7"))
+        for i in range(100):
+            if self.flagdb.get_flag("1.0.0.7") is not None:
+                break
+            time.sleep(0.05)
+        self.assertEqual(self.flagdb.get_flag("1.0.0.7"), "AU")
+        self.assertEqual(self.flagdb.lookup_table("2001:db8::7"), "NL")
+        self.assertEqual(self.flagdb.lookup_table("5.1.2.3"), "DE")
+        self.assertIsNone(self.flagdb.lookup_table("3.0.0.1"))
+        # The cache is bounded.
+        self.flagdb.set_flag("5.0.0.1", "DE")
+        self.flagdb.set_flag("5.0.0.2", "DE")
+        self.assertEqual(list(self.flagdb.cache), ["5.0.0.1", "5.0.0.2"])
+
+
 if __name__ == "__main__":
     unittest.main()
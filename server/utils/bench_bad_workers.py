@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+# bench_bad_workers.py - benchmark of the bad worker detection of purge_run()
+#
+# Compares get_bad_workers() with the previous algorithm, which called
+# get_chi2() on all the tasks again for every excluded worker, on a
+# synthetic run with 5000 workers some of which are biased.
+#
+
+from __future__ import print_function
+
+import random
+import sys
+import time
+
+from fishtest.util import get_bad_workers, get_chi2, get_chi2_counts
+
+
+def synthetic_tasks(workers=5000, tasks_per_worker=2, bad=20, seed=42):
+    rng = random.Random(seed)
+    probs = [0.05, 0.2, 0.5, 0.2, 0.05]
+    bad_probs = [0.01, 0.09, 0.4, 0.35, 0.15]
+    tasks = []
+    for w in range(workers):
+        p = bad_probs if w < bad else probs
+        for _ in range(tasks_per_worker):
+            pentanomial = 5 * [0]
+            for pair in rng.choices(range(5), weights=p, k=100):
+                pentanomial[pair] += 1
+            tasks.append(
+                {
+                    "worker_info": {"unique_key": "worker-{}".format(w)},
+                    "stats": {"pentanomial": pentanomial},
+                }
+            )
+    rng.shuffle(tasks)
+    return tasks
+
+
+def get_bad_workers_reference(tasks, p=0.001, res=7.0, iters=1):
+    # The previous implementation: a full get_chi2() per iteration.
+    bad_workers = []
+    for _ in range(iters):
+        chi2 = get_chi2(tasks, exclude_workers=set(bad_workers))
+        worst_user = {}
+        residuals = chi2["residual"]
+        for worker_key in residuals:
+            if chi2["p"] < p or residuals[worker_key] > res:
+                if worst_user == {} or residuals[worker_key] > worst_user["residual"]:
+                    worst_user["unique_key"] = worker_key
+                    worst_user["residual"] = residuals[worker_key]
+        if worst_user == {}:
+            break
+        bad_workers.append(worst_user["unique_key"])
+    return bad_workers
+
+
+def bench(label, f):
+    t = time.time()
+    result = f()
+    print("{:<40} {:>10.1f} ms".format(label, (time.time() - t) * 1e3))
+    sys.stdout.flush()
+    return result
+
+
+def main():
+    tasks = synthetic_tasks()
+    print("{} tasks".format(len(tasks)))
+    for iters in (1, 10, 30):
+        print("\niters: {}".format(iters))
+        reference = bench(
+            "get_chi2 per iteration",
+            lambda: get_bad_workers_reference(tasks, iters=iters),
+        )
+        bad_workers = bench(
+            "get_bad_workers",
+            lambda: get_bad_workers(tasks, iters=iters),
+        )
+        counts = get_chi2_counts(tasks)
+        bench(
+            "get_bad_workers with cached counts",
+            lambda: get_bad_workers(tasks, iters=iters, cached_counts=counts),
+        )
+        assert bad_workers == set(reference), "different bad workers"
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+
+# bench_llr.py - micro benchmark of the LLR calculations
+#
+# Shows the cost of the LLR calculation done by update_SPRT() on each
+# update_task, and the cost per run of the batch versions.
+#
+
+from __future__ import print_function
+
+import sys
+import timeit
+
+import numpy as np
+from fishtest.stats import LLRcalc, stat_util
+
+pentanomial = [411, 7924, 18231, 8120, 398]
+trinomial = [9035, 17214, 9117]
+
+
+def bench(label, stmt, number, runs=1):
+    # Prints the time per call (divided by the number of runs).
+    t = min(timeit.repeat(stmt, number=number, repeat=5)) / number / runs
+    print("{:<40} {:>10.1f} us".format(label, t * 1e6))
+    sys.stdout.flush()
+
+
+def main():
+    for results in (trinomial, pentanomial):
+        print("\nresults: {}".format(results))
+        bench("LLR_logistic", lambda: LLRcalc.LLR_logistic(0, 2, results), 1000)
+        bench("LLR_normalized", lambda: LLRcalc.LLR_normalized(0, 2, results), 200)
+        R = dict(zip(("losses", "draws", "wins"), trinomial))
+        if len(results) == 5:
+            R["pentanomial"] = results
+        sprt = stat_util.SPRT(elo0=0, elo1=2, elo_model="normalized")
+        bench("update_SPRT", lambda: stat_util.update_SPRT(R, sprt), 200)
+        for runs in (100, 1000):
+            B = np.array([results] * runs)
+            bench(
+                "LLR_logistic_batch per run ({})".format(runs),
+                lambda: LLRcalc.LLR_logistic_batch(0, 2, B),
+                10,
+                runs=runs,
+            )
+            bench(
+                "LLR_normalized_batch per run ({})".format(runs),
+                lambda: LLRcalc.LLR_normalized_batch(0, 2, B),
+                10,
+                runs=runs,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+
+# bench_scheduler.py - simulation and benchmark of the task scheduler
+#
+# Drives RunDb.request_task() and RunDb.update_task() with a population of
+# simulated workers with a realistic mix of concurrency, nps and os, on a
+# set of runs with a mix of time controls, threads and throughputs. It
+# reports
+#
+# - the number of requests per second and their p50/p99 latency,
+# - the time spent waiting for the main locks of RunDb,
+# - how well the cores are allocated to the runs compared to their
+#   internal throughput (itp).
+#
+# By default it uses a scratch database "fishtest_bench" on the local
+# mongod, which is dropped at the end. With --mongomock it uses an in
+# memory database instead (pip install mongomock).
+#
+# Example: python bench_scheduler.py --workers 5000 --threads 32
+#
+
+import argparse
+import random
+import sys
+import threading
+import time
+from datetime import datetime
+
+import fishtest.rundb
+from fishtest.api import WORKER_VERSION
+from fishtest.rundb import RunDb
+
+# (tc, threads, throughput, weight)
+run_mix = [
+    ("10+0.1", 1, 100, 6),
+    ("60+0.6", 1, 100, 3),
+    ("5+0.05", 8, 100, 1),
+    ("20+0.2", 8, 100, 1),
+    ("10+0.1", 1, 200, 1),
+]
+
+# (concurrency, weight)
+concurrency_mix = [(1, 2), (2, 3), (4, 5), (8, 5), (16, 3), (32, 1), (64, 1)]
+
+
+class TimedLock:
+    """A lock recording the time spent waiting to acquire it."""
+
+    def __init__(self, stats, lock=None):
+        self.lock = lock or threading.Lock()
+        self.stats = stats
+
+    def acquire(self, blocking=True, timeout=-1):
+        t0 = time.perf_counter()
+        ret = self.lock.acquire(blocking, timeout)
+        wait = time.perf_counter() - t0
+        with self.stats["lock"]:
+            self.stats["count"] += 1
+            self.stats["wait"] += wait
+            self.stats["max"] = max(self.stats["max"], wait)
+        return ret
+
+    def release(self):
+        self.lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+def lock_stats():
+    return {"lock": threading.Lock(), "count": 0, "wait": 0.0, "max": 0.0}
+
+
+def instrument(rundb):
+    # Replaces the main locks of rundb by timed locks.
+    stats = {}
+    for name in ("task_lock", "scheduler_lock", "liveness_lock"):
+        stats[name] = lock_stats()
+        setattr(rundb, name, TimedLock(stats[name], getattr(rundb, name)))
+    stats["run_cache_locks"] = lock_stats()
+    rundb.run_cache_locks = [
+        TimedLock(stats["run_cache_locks"], lock) for lock in rundb.run_cache_locks
+    ]
+    stats["active_run_lock"] = lock_stats()
+    active_run_lock = rundb.active_run_lock
+    run_locks = {}
+
+    def timed_active_run_lock(id):
+        lock = active_run_lock(id)
+        if id not in run_locks or run_locks[id].lock is not lock:
+            run_locks[id] = TimedLock(stats["active_run_lock"], lock)
+        return run_locks[id]
+
+    rundb.active_run_lock = timed_active_run_lock
+    return stats
+
+
+def create_runs(rundb, count, rng):
+    run_ids = []
+    for i in range(count):
+        tc, threads, throughput, _ = rng.choices(run_mix, [m[3] for m in run_mix])[0]
+        run_id = rundb.new_run(
+            "master",
+            "bench-{}".format(i),
+            10**9,
+            tc,
+            tc,
+            "UHO_XXL_+0.90_+1.19.epd",
+            8,
+            threads,
+            "Hash=16",
+            "Hash=16",
+            username="bench",
+            tests_repo="https://github.com/official-stockfish/Stockfish",
+            throughput=throughput,
+        )
+        run = rundb.get_run(run_id)
+        run["approved"] = True
+        rundb.buffer(run, True)
+        run_ids.append(run_id)
+    return run_ids
+
+
+def new_worker(i, rng):
+    concurrency = rng.choices(
+        [c for c, _ in concurrency_mix], [w for _, w in concurrency_mix]
+    )[0]
+    windows = rng.random() < 0.3
+    return {
+        "info": {
+            "uname": "Windows 10" if windows else "Linux 5.15.0-generic",
+            "architecture": ["64bit", "WindowsPE" if windows else "ELF"],
+            "concurrency": concurrency,
+            "max_memory": 1024 * concurrency,
+            "min_threads": 1,
+            "username": "bench",
+            "version": WORKER_VERSION,
+            "python_version": [3, 10, 4],
+            "gcc_version": [11, 2, 0],
+            "compiler": "g++",
+            "unique_key": "bench-{:06d}".format(i),
+            "modified": False,
+            "near_github_api_limit": False,
+            "ARCH": "x86-64-bmi2",
+            "nps": rng.lognormvariate(13.8, 0.4),
+            "remote_addr": "10.{}.{}.{}".format(i >> 16, (i >> 8) & 255, i & 255),
+            "country_code": "?",
+        },
+        "task": None,
+    }
+
+
+def random_stats(games, rng):
+    pentanomial = 5 * [0]
+    for pair in rng.choices(range(5), [5, 20, 50, 20, 5], k=games // 2):
+        pentanomial[pair] += 1
+    return {
+        "wins": 2 * pentanomial[4] + pentanomial[3],
+        "losses": 2 * pentanomial[0] + pentanomial[1],
+        "draws": pentanomial[1] + 2 * pentanomial[2] + pentanomial[3],
+        "crashes": 0,
+        "time_losses": 0,
+        "pentanomial": pentanomial,
+    }
+
+
+def add_stats(a, b):
+    s = {k: a[k] + b[k] for k in ("wins", "losses", "draws", "crashes", "time_losses")}
+    s["pentanomial"] = [x + y for x, y in zip(a["pentanomial"], b["pentanomial"])]
+    return s
+
+
+def simulate(rundb, workers, threads, duration, updates_per_task, seed):
+    # Each thread repeatedly takes a worker which either asks for a task
+    # or sends an update of its current task.
+    latencies = {"request_task": [], "update_task": []}
+    lock = threading.Lock()
+    deadline = time.time() + duration
+
+    def drive(k):
+        rng = random.Random(seed + k)
+        own = workers[k::threads]
+        while time.time() < deadline:
+            worker = rng.choice(own)
+            task = worker["task"]
+            t0 = time.perf_counter()
+            if task is None:
+                kind = "request_task"
+                ret = rundb.request_task(worker["info"])
+                if "task_id" in ret:
+                    run = ret["run"]
+                    worker["task"] = {
+                        "run_id": str(run["_id"]),
+                        "task_id": ret["task_id"],
+                        "num_games": run["tasks"][ret["task_id"]]["num_games"],
+                        "stats": random_stats(0, rng),
+                    }
+            else:
+                kind = "update_task"
+                played = sum(task["stats"][k] for k in ("wins", "losses", "draws"))
+                games = 2 * max(1, task["num_games"] // (2 * updates_per_task))
+                games = min(games, task["num_games"] - played)
+                task["stats"] = add_stats(task["stats"], random_stats(games, rng))
+                ret = rundb.update_task(
+                    worker["info"], task["run_id"], task["task_id"], task["stats"], {}
+                )
+                if not ret.get("task_alive", False):
+                    worker["task"] = None
+            t = time.perf_counter() - t0
+            with lock:
+                latencies[kind].append(t)
+
+    pool = [threading.Thread(target=drive, args=(k,)) for k in range(threads)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    return latencies
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return float("nan")
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+def report(latencies, stats, rundb, run_ids, duration):
+    print(
+        "\n{:<14} {:>8} {:>10} {:>10} {:>10}".format(
+            "", "count", "req/s", "p50 ms", "p99 ms"
+        )
+    )
+    for kind, values in latencies.items():
+        print(
+            "{:<14} {:>8} {:>10.1f} {:>10.2f} {:>10.2f}".format(
+                kind,
+                len(values),
+                len(values) / duration,
+                percentile(values, 50) * 1e3,
+                percentile(values, 99) * 1e3,
+            )
+        )
+
+    print(
+        "\n{:<16} {:>10} {:>12} {:>12}".format(
+            "lock", "acquired", "wait ms", "max wait ms"
+        )
+    )
+    for name, s in stats.items():
+        print(
+            "{:<16} {:>10} {:>12.1f} {:>12.2f}".format(
+                name, s["count"], s["wait"] * 1e3, s["max"] * 1e3
+            )
+        )
+
+    # Fairness: the scheduler aims at cores proportional to itp.
+    runs = [rundb.get_run(run_id) for run_id in run_ids]
+    total_cores = sum(run["cores"] for run in runs) or 1
+    total_itp = sum(run["args"]["itp"] for run in runs)
+    print(
+        "\n{:<8} {:>7} {:>8} {:>8} {:>8} {:>8}".format(
+            "tc", "threads", "itp", "cores", "%cores", "%itp"
+        )
+    )
+    distance = 0.0
+    for run in sorted(runs, key=lambda r: r["args"]["itp"]):
+        cores_share = run["cores"] / total_cores
+        itp_share = run["args"]["itp"] / total_itp
+        distance += abs(cores_share - itp_share) / 2
+        print(
+            "{:<8} {:>7} {:>8.1f} {:>8} {:>8.1f} {:>8.1f}".format(
+                run["args"]["tc"],
+                run["args"]["threads"],
+                run["args"]["itp"],
+                run["cores"],
+                100 * cores_share,
+                100 * itp_share,
+            )
+        )
+    print(
+        "Total variation distance of the core allocation to itp: {:.3f}".format(
+            distance
+        )
+    )
+    sys.stdout.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the task scheduler")
+    parser.add_argument("--workers", type=int, default=2000)
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=30.0)
+    parser.add_argument("--updates-per-task", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--mongomock", action="store_true")
+    args = parser.parse_args()
+
+    if args.mongomock:
+        import mongomock
+
+        fishtest.rundb.MongoClient = mongomock.MongoClient
+
+    rng = random.Random(args.seed)
+    rundb = RunDb(db_name="fishtest_bench")
+    try:
+        rundb.userdb.users.insert_one(
+            {
+                "username": "bench",
+                "registration_time": datetime.utcnow(),
+                "blocked": False,
+                "groups": [],
+                "machine_limit": 10**6,
+            }
+        )
+        run_ids = create_runs(rundb, args.runs, rng)
+        workers = [new_worker(i, rng) for i in range(args.workers)]
+        stats = instrument(rundb)
+        print(
+            "{} workers, {} runs, {} threads, {} s".format(
+                args.workers, args.runs, args.threads, args.duration
+            )
+        )
+        latencies = simulate(
+            rundb,
+            workers,
+            args.threads,
+            args.duration,
+            args.updates_per_task,
+            args.seed,
+        )
+        report(latencies, stats, rundb, run_ids, args.duration)
+    finally:
+        rundb.stop()
+        rundb.conn.drop_database("fishtest_bench")
+
+
+if __name__ == "__main__":
+    main()
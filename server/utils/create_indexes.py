@@ -25,7 +25,7 @@ def create_runs_indexes():
         partialFilterExpression={"finished": False},
     )
     db["runs"].create_index(
-        [("finished", ASCENDING), ("last_updated", DESCENDING)],
+        [("finished", ASCENDING), ("last_updated", DESCENDING), ("_id", DESCENDING)],
         name="finished_runs",
         partialFilterExpression={"finished": True},
     )
@@ -34,6 +34,7 @@ def create_runs_indexes():
             ("finished", ASCENDING),
             ("is_green", DESCENDING),
             ("last_updated", DESCENDING),
+            ("_id", DESCENDING),
         ],
         name="finished_green_runs",
         partialFilterExpression={"finished": True, "is_green": True},
@@ -43,6 +44,7 @@ def create_runs_indexes():
             ("finished", ASCENDING),
             ("is_yellow", DESCENDING),
             ("last_updated", DESCENDING),
+            ("_id", DESCENDING),
         ],
         name="finished_yellow_runs",
         partialFilterExpression={"finished": True, "is_yellow": True},
@@ -51,13 +53,31 @@ def create_runs_indexes():
         [
             ("finished", ASCENDING),
             ("last_updated", DESCENDING),
+            ("_id", DESCENDING),
             ("tc_base", DESCENDING),
         ],
         name="finished_ltc_runs",
         partialFilterExpression={"finished": True, "tc_base": {"$gte": 40}},
     )
     db["runs"].create_index(
-        [("args.username", DESCENDING), ("last_updated", DESCENDING)], name="user_runs"
+        [
+            ("args.username", DESCENDING),
+            ("last_updated", DESCENDING),
+            ("_id", DESCENDING),
+        ],
+        name="user_runs",
+    )
+
+
+def create_tasks_indexes():
+    print("Creating indexes on tasks collection")
+    db["tasks"].create_index(
+        [("run_id", ASCENDING), ("bad", ASCENDING), ("task_id", ASCENDING)]
+    )
+    db["tasks"].create_index(
+        [("task.active", ASCENDING)],
+        name="active_tasks",
+        partialFilterExpression={"task.active": True},
     )
 
 
@@ -126,6 +146,9 @@ if __name__ == "__main__":
             elif collection_name == "runs":
                 drop_indexes("runs")
                 create_runs_indexes()
+            elif collection_name == "tasks":
+                drop_indexes("tasks")
+                create_tasks_indexes()
             elif collection_name == "pgns":
                 drop_indexes("pgns")
                 create_pgns_indexes()
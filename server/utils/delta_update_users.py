@@ -1,69 +1,115 @@
 #!/usr/bin/env python
 
+# delta_update_users.py - update the user_cache and top_month collections
+#
+# The per-user counters (CPU hours, games, tests and the last time a
+# user was active) are maintained online by the server in the user_stats
+# collection, see RunDb.count_user(). This script builds the users tables
+# from these counters and only writes the users that changed.
+#
+# With --rescan the counters are first rebuilt from the full history of
+# the runs, e.g. to reconcile them after a failed write. This is also
+# done when the user_stats collection is empty, e.g. on the first run
+# after an upgrade. Increments made by the server during the rescan may
+# be lost.
+#
+# Empty counters never delete anything: the script then stops before
+# writing the users tables or deleting idle users.
+
 import os
 import sys
 from datetime import datetime, timedelta
 
-from pymongo import DESCENDING
+from pymongo import DeleteMany, ReplaceOne, UpdateOne
 
 # For tasks
 sys.path.append(os.path.expanduser("~/fishtest/fishtest"))
 from fishtest.rundb import RunDb
-from fishtest.util import delta_date, diff_date, estimate_game_duration
+from fishtest.util import estimate_game_duration
 
-new_deltas = {}
-skip = False
+month_days = 30
 
 
-def process_run(run, info, deltas=None):
-    global skip
-    if deltas and (skip or str(run["_id"]) in deltas):
-        skip = True
-        return
-    if deltas != None and str(run["_id"]) in new_deltas:
-        print("Warning: skipping repeated run!")
-        return
-    if "username" in run["args"]:
+def day_key(date):
+    return date.strftime("%Y-%m-%d")
+
+
+def new_stats(username):
+    return {
+        "_id": username,
+        "cpu_hours": 0.0,
+        "games": 0,
+        "tests": 0,
+        "last_updated": datetime.min,
+        "days": {},
+    }
+
+
+def count(stats, date, cpu_hours=0.0, games=0, tests=0):
+    day = stats["days"].setdefault(day_key(date), {})
+    for key, value in (("cpu_hours", cpu_hours), ("games", games), ("tests", tests)):
+        if value:
+            stats[key] += value
+            day[key] = day.get(key, 0) + value
+
+
+def process_run(run, info):
+    # Adds the run to the counters, in the same way as the server does
+    # in RunDb.sync_update_task() and RunDb.stop_run().
+    if run.get("finished", False) and "username" in run["args"]:
         username = run["args"]["username"]
         if username not in info:
             print("not in info: ", username)
-            return
         else:
-            info[username]["tests"] += 1
+            count(info[username], run["last_updated"], tests=1)
 
     tc = estimate_game_duration(run["args"]["tc"])
+    threads = int(run["args"].get("threads", 1))
     for task in run["tasks"]:
-        if "worker_info" not in task:
+        if "worker_info" not in task or "stats" not in task:
             continue
         username = task["worker_info"].get("username", None)
-        if username == None:
+        if username is None:
             continue
         if username not in info:
             print("not in info: ", username)
             continue
 
-        if "stats" in task:
-            stats = task["stats"]
-            num_games = stats["wins"] + stats["losses"] + stats["draws"]
-        else:
-            num_games = 0
+        stats = task["stats"]
+        num_games = stats["wins"] + stats["losses"] + stats["draws"]
+        if num_games == 0:
+            continue
+        last_updated = task.get("last_updated", run["last_updated"])
+        user = info[username]
+        user["last_updated"] = max(user["last_updated"], last_updated)
+        count(
+            user,
+            last_updated,
+            cpu_hours=num_games * threads * tc / (60 * 60),
+            games=num_games,
+        )
+
 
+def rescan(rundb, usernames):
+    # Rebuilds the user_stats collection from the runs.
+    info = {username: new_stats(username) for username in usernames}
+    for run in rundb.runs.find({}):
+        rundb.load_tasks(run)
         try:
-            info[username]["last_updated"] = max(
-                task["last_updated"], info[username]["last_updated"]
-            )
-            info[username]["task_last_updated"] = max(
-                task["last_updated"], info[username]["last_updated"]
-            )
+            process_run(run, info)
         except:
-            info[username]["last_updated"] = task["last_updated"]
+            print("Exception on run: ", run["_id"])
 
-        info[username]["cpu_hours"] += float(
-            num_games * int(run["args"].get("threads", 1)) * tc / (60 * 60)
-        )
-        info[username]["games"] += num_games
-    if deltas != None:
-        new_deltas.update({str(run["_id"]): None})
+    active = [u for u in info.values() if u["games"] > 0 or u["tests"] > 0]
+    if not active:
+        print("Rescan found no activity, user_stats left unchanged")
+        return
+    ops = [ReplaceOne({"_id": u["_id"]}, u, upsert=True) for u in active]
+    ops.append(DeleteMany({"_id": {"$nin": [u["_id"] for u in active]}}))
+    rundb.userdb.user_stats.bulk_write(ops)
+    # The "deltas" collection of the previous versions of this script is
+    # kept, so that they can still be used.
+    print("Rescanned the runs of %d users" % (len(active)))
 
 
 def build_users(machines, info):
@@ -75,112 +121,81 @@ def build_users(machines, info):
         )
         info[machine["username"]]["games_per_hour"] += games_per_hour
 
-    users = []
-    for u in info.keys():
-        user = info[u]
-        try:
-            if isinstance(user["last_updated"], str):
-                diff = diff_date(user["task_last_updated"])
-                user["diff"] = diff.total_seconds()
-                user["last_updated"] = delta_date(diff)
-            else:
-                diff = diff_date(user["last_updated"])
-                user["diff"] = diff.total_seconds()
-                user["last_updated"] = delta_date(diff)
-        except:
-            pass
-        users.append(user)
+    return [u for u in info.values() if u["games"] > 0 or u["tests"] > 0]
 
-    users = [u for u in users if u["games"] > 0 or u["tests"] > 0]
-    return users
+
+def write_changed(collection, users):
+    # Upserts the users that differ from their stored document and
+    # deletes the users that are no longer listed.
+    old = {u["username"]: u for u in collection.find({}, {"_id": 0})}
+    ops = [
+        ReplaceOne({"username": u["username"]}, u, upsert=True)
+        for u in users
+        if old.get(u["username"]) != u
+    ]
+    usernames = [u["username"] for u in users]
+    if usernames and set(old) - set(usernames):
+        ops.append(DeleteMany({"username": {"$nin": usernames}}))
+    if ops:
+        collection.bulk_write(ops)
+    return len(ops)
 
 
 def update_users():
     rundb = RunDb()
 
-    deltas = {}
-    info = {}
-    top_month = {}
+    registered = list(rundb.userdb.get_users())
+    if (
+        "--rescan" in sys.argv[1:]
+        or rundb.userdb.user_stats.find_one({}, {"_id": 1}) is None
+    ):
+        rescan(rundb, [u["username"] for u in registered])
 
-    clear_stats = True
-    if len(sys.argv) > 1:
-        print("scan all")
-    else:
-        deltas = rundb.deltas.find_one()
-        if deltas:
-            clear_stats = False
-        else:
-            deltas = {}
+    now = datetime.utcnow()
+    since = day_key(now - timedelta(days=month_days - 1))
+    stale = day_key(now - timedelta(days=month_days + 1))
+    user_stats = {s["_id"]: s for s in rundb.userdb.user_stats.find()}
+    if not user_stats:
+        print("No user stats, nothing updated")
+        return
 
-    for u in rundb.userdb.get_users():
+    info = {}
+    top_month = {}
+    prune = []
+    for u in registered:
         username = u["username"]
-        top_month[username] = {
+        stats = user_stats.get(username, {})
+        user = {
             "username": username,
-            "cpu_hours": 0,
+            "cpu_hours": 0.0,
             "games": 0,
             "tests": 0,
             "tests_repo": u.get("tests_repo", ""),
-            "last_updated": datetime.min,
+            "last_updated": stats.get("last_updated", datetime.min),
             "games_per_hour": 0.0,
         }
-        if clear_stats:
-            info[username] = top_month[username].copy()
-        else:
-            info[username] = rundb.userdb.user_cache.find_one({"username": username})
-            if not info[username]:
-                info[username] = top_month[username].copy()
-            else:
-                info[username]["games_per_hour"] = 0.0
-
-    for run in rundb.get_unfinished_runs():
-        try:
-            process_run(run, top_month)
-        except:
-            print("Exception on run: ", run)
-
-    # Step through these in small batches (step size 100) to save RAM
-    step_size = 100
-
-    now = datetime.utcnow()
-    more_days = True
-    last_updated = None
-    while more_days:
-        q = {"finished": True}
-        if last_updated:
-            q["last_updated"] = {"$lt": last_updated}
-        runs = list(
-            rundb.runs.find(q, sort=[("last_updated", DESCENDING)], limit=step_size)
-        )
-        if len(runs) == 0:
-            break
-        for run in runs:
-            try:
-                process_run(run, info, deltas)
-            except:
-                print("Exception on run: ", run["_id"])
-            if (now - run["start_time"]).days < 30:
-                try:
-                    process_run(run, top_month)
-                except:
-                    print("Exception on run: ", run["_id"])
-            elif not clear_stats:
-                more_days = False
-        last_updated = runs[-1]["last_updated"]
-
-    if new_deltas:
-        new_deltas.update(deltas)
-        rundb.deltas.remove()
-        rundb.deltas.save(new_deltas)
-
-    machines = rundb.get_machines()
+        info[username] = dict(user)
+        top_month[username] = user
+        for key in ("cpu_hours", "games", "tests"):
+            info[username][key] = stats.get(key, 0)
+        days = stats.get("days", {})
+        for day, counters in days.items():
+            if day >= since:
+                for key in ("cpu_hours", "games", "tests"):
+                    user[key] += counters.get(key, 0)
+        old_days = ["days." + day for day in days if day < stale]
+        if old_days:
+            prune.append(
+                UpdateOne({"_id": username}, {"$unset": {day: "" for day in old_days}})
+            )
+    if prune:
+        rundb.userdb.user_stats.bulk_write(prune)
 
+    machines = rundb.scan_machines()
     users = build_users(machines, info)
-    rundb.userdb.user_cache.remove()
-    rundb.userdb.user_cache.insert(users)
+    updated = write_changed(rundb.userdb.user_cache, users)
     rundb.userdb.user_cache.create_index("username", unique=True)
-
-    rundb.userdb.top_month.remove()
-    rundb.userdb.top_month.insert(build_users(machines, top_month))
+    updated += write_changed(rundb.userdb.top_month, build_users(machines, top_month))
 
     # Delete users that have never been active and old admins group
     idle = {}
@@ -208,7 +223,7 @@ def update_users():
             print("Delete: " + str(u["_id"]))
             rundb.userdb.users.remove({"_id": u["_id"]})
 
-    print("Successfully updated %d users" % (len(users)))
+    print("Successfully updated %d users (%d writes)" % (len(users), updated))
 
     # record this update run
     rundb.actiondb.update_stats()
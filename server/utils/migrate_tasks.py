@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+# migrate_tasks.py - move the tasks of the runs to the tasks collection
+#
+# For use with FISHTEST_SEPARATE_TASKS, see RunDb.separate_tasks. The
+# server also migrates a run when it loads it, so running this script is
+# only needed to convert the old runs. Stop the server first.
+#
+# With --reverse the tasks are moved back into the run documents, e.g.
+# before running the server without FISHTEST_SEPARATE_TASKS again.
+
+import sys
+
+from fishtest.rundb import RunDb
+
+rundb = RunDb()
+
+
+def migrate():
+    count = 0
+    for run in rundb.runs.find({"tasks": {"$exists": True}}):
+        r_id = str(run["_id"])
+        rundb.tasks.bulk_write(rundb.all_task_ops(r_id, run), ordered=False)
+        rundb.runs.update_one(
+            {"_id": run["_id"]}, {"$unset": {"tasks": "", "bad_tasks": ""}}
+        )
+        count += 1
+        if count % 100 == 0:
+            print("Runs: {:7d}".format(count), end="\r", flush=True)
+    print("Migrated {} runs".format(count))
+
+
+def reverse():
+    count = 0
+    for r in rundb.runs.find({"tasks": {"$exists": False}}, {"_id": 1}):
+        run = rundb.runs.find_one({"_id": r["_id"]})
+        rundb.load_tasks(run)
+        rundb.runs.replace_one({"_id": run["_id"]}, run)
+        rundb.tasks.delete_many({"run_id": str(run["_id"])})
+        count += 1
+        if count % 100 == 0:
+            print("Runs: {:7d}".format(count), end="\r", flush=True)
+    print("Moved back the tasks of {} runs".format(count))
+
+
+def main():
+    if "--reverse" in sys.argv[1:]:
+        reverse()
+    else:
+        migrate()
+
+
+if __name__ == "__main__":
+    main()
@@ -12,6 +12,9 @@ from pymongo import DESCENDING
 
 rundb = RunDb()
 
+# The number of runs whose PGNs are deleted by one delete_many.
+batch_size = 100
+
 
 def purge_pgn(days):
     """Purge old PGNs except LTC (>= 20s) runs"""
@@ -22,9 +25,11 @@ def purge_pgn(days):
     saved_tasks = 0
     now = datetime.utcnow()
 
+    purge = []
     run_count = 0
     for run in rundb.runs.find(
         {"finished": True, "deleted": False},
+        {"args.tc": 1, "start_time": 1, "last_updated": 1},
         sort=[("last_updated", DESCENDING)],
     ):
 
@@ -35,26 +40,19 @@ def purge_pgn(days):
         if run_count % 10 == 0:
             print("Run: %05d" % (run_count), end="\r")
 
-        skip = False
         if (
             re.match("^([2-9][0-9])|(1[0-9][0-9])", run["args"]["tc"])
             and run["last_updated"] > datetime.utcnow() - timedelta(days=5 * days)
         ) or run["last_updated"] > datetime.utcnow() - timedelta(days=days):
             saved_runs += 1
-            skip = True
+            saved_tasks += rundb.pgndb.count_documents(rundb.pgn_query([run["_id"]]))
         else:
             deleted_runs += 1
-
-        for idx, task in enumerate(run["tasks"]):
-            key = str(run["_id"]) + "-" + str(idx)
-            for pgn in rundb.pgndb.find(
-                {"run_id": key}
-            ):  # We can have multiple PGNs per task
-                if skip:
-                    saved_tasks += 1
-                else:
-                    rundb.pgndb.delete_one({"_id": pgn["_id"]})
-                    deleted_tasks += 1
+            purge.append(run["_id"])
+            if len(purge) == batch_size:
+                deleted_tasks += rundb.purge_pgns(purge)
+                purge = []
+    deleted_tasks += rundb.purge_pgns(purge)
 
     print("PGN runs/tasks saved:  %5d/%7d" % (saved_runs, saved_tasks))
     print("PGN runs/tasks purged: %5d/%7d" % (deleted_runs, deleted_tasks))
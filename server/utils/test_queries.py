@@ -46,7 +46,7 @@ end = time.time()
 
 print("{} rows {:1.4f}".format(qlen(c), end - start) + "s\nFetching machines ...")
 start = time.time()
-c = rundb.get_machines()
+c = rundb.scan_machines()
 end = time.time()
 
 print("{} rows {:1.4f}".format(qlen(c), end - start) + "s\nFetching finished runs ...")
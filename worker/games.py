@@ -68,6 +68,8 @@ def is_64bit():
 HTTP_TIMEOUT = 30.0
 CUTECHESS_KILL_TIMEOUT = 15.0
 UPDATE_RETRY_TIME = 15.0
+COALESCE_TIME = 60.0  # skip intermediate updates if the server is busy
+PREFETCH_FRACTION = 0.25  # prepare the next run for the last part of a task
 
 REPO_URL = "https://github.com/official-stockfish/books"
 EXE_SUFFIX = ".exe" if IS_WINDOWS else ""
@@ -171,8 +173,30 @@ def requests_post(remote, *args, **kw):
     return result
 
 
+# The session token issued by /api/request_version. While it is valid the
+# server does not need to check our password.
+session_token = {"token": None, "expires": 0}
+
+
+def set_session_token(token, lifetime):
+    # Renew the token well before the server considers it expired.
+    session_token["token"] = token
+    session_token["expires"] = time.time() + 0.9 * lifetime
+
+
+def session_token_lifetime():
+    # The number of seconds during which the token is still used.
+    return session_token["expires"] - time.time()
+
+
 def send_api_post_request(api_url, payload, quiet=False):
     t0 = datetime.datetime.utcnow()
+    if (
+        "password" in payload
+        and session_token["token"] is not None
+        and time.time() < session_token["expires"]
+    ):
+        payload = {**payload, "token": session_token["token"]}
     response = requests_post(
         api_url,
         data=json.dumps(payload),
@@ -229,6 +253,20 @@ def github_api(repo):
     return repo.replace("https://github.com", "https://api.github.com/repos")
 
 
+def get_rate():
+    try:
+        rate = requests.get(
+            "https://api.github.com/rate_limit", timeout=HTTP_TIMEOUT
+        ).json()["resources"]["core"]
+    except Exception as e:
+        print("Exception fetching rate_limit:\n", e, sep="", file=sys.stderr)
+        rate = {"remaining": 0, "limit": 5000}
+        return rate, False
+    remaining = rate["remaining"]
+    print("API call rate limits:", rate)
+    return rate, remaining < math.sqrt(rate["limit"])
+
+
 def required_net(engine):
     net = None
     print("Obtaining EvalFile of {} ...".format(os.path.basename(engine)))
@@ -294,39 +332,62 @@ def verify_required_cutechess(testing_dir, cutechess):
         )
 
 
-def required_net_from_source():
-    """Parse evaluate.h and ucioption.cpp to find default net"""
+def default_net(read_source):
+    """Parse evaluate.h and ucioption.cpp to find default net,
+    read_source(name) returns the lines of a source file"""
     net = None
 
     # NNUE code after binary embedding (Aug 2020)
-    with open("evaluate.h", "r") as srcfile:
-        for line in srcfile:
-            if "EvalFileDefaultName" in line and "define" in line:
-                p = re.compile("nn-[a-z0-9]{12}.nnue")
-                m = p.search(line)
-                if m:
-                    net = m.group(0)
+    for line in read_source("evaluate.h"):
+        if "EvalFileDefaultName" in line and "define" in line:
+            p = re.compile("nn-[a-z0-9]{12}.nnue")
+            m = p.search(line)
+            if m:
+                net = m.group(0)
     if net:
         return net
 
     # NNUE code before binary embedding (Aug 2020)
-    with open("ucioption.cpp", "r") as srcfile:
-        for line in srcfile:
-            if "EvalFile" in line and "Option" in line:
-                p = re.compile("nn-[a-z0-9]{12}.nnue")
-                m = p.search(line)
-                if m:
-                    net = m.group(0)
+    for line in read_source("ucioption.cpp"):
+        if "EvalFile" in line and "Option" in line:
+            p = re.compile("nn-[a-z0-9]{12}.nnue")
+            m = p.search(line)
+            if m:
+                net = m.group(0)
 
     return net
 
 
+def required_net_from_source():
+    """Find the default net of the sources in the current directory"""
+
+    def read_source(name):
+        with open(name, "r") as srcfile:
+            return srcfile.readlines()
+
+    return default_net(read_source)
+
+
+def required_net_from_zip(zip_file):
+    """Find the default net of the sources in a zipball from github"""
+    # The sources are in a single top directory.
+    prefix = zip_file.namelist()[0].split("/")[0] + "/"
+
+    def read_source(name):
+        return zip_file.read(prefix + "src/" + name).decode("utf-8").splitlines()
+
+    return default_net(read_source)
+
+
 def download_net(remote, testing_dir, net):
     url = remote + "/api/nn/" + net
     print("Downloading {}".format(net))
     r = requests_get(url, allow_redirects=True, timeout=HTTP_TIMEOUT)
-    with open(os.path.join(testing_dir, net), "wb") as f:
+    # Written atomically, the net may be downloaded by prefetch_run() too.
+    tmp_net = os.path.join(testing_dir, "{}.{}.tmp".format(net, threading.get_ident()))
+    with open(tmp_net, "wb") as f:
         f.write(r.content)
+    os.replace(tmp_net, os.path.join(testing_dir, net))
 
 
 def validate_net(testing_dir, net):
@@ -612,6 +673,52 @@ def find_arch(compiler):
     return arch
 
 
+def sources_zip(testing_dir, sha):
+    return os.path.join(testing_dir, "sf_{}.zip".format(sha))
+
+
+def prefetch_run(remote, testing_dir, run):
+    """Download the sources of the engines of run that are not built yet and
+    their default nets, while the games of the current task are played.
+    The engines are only built by setup_engine(), when the cores are free."""
+    repo_url = run["args"].get("tests_repo", REPO_URL)
+    rate_checked = False
+    for sha in {run["args"]["resolved_new"], run["args"]["resolved_base"]}:
+        engine = os.path.join(testing_dir, "stockfish_" + sha + EXE_SUFFIX)
+        zip_path = sources_zip(testing_dir, sha)
+        if os.path.exists(engine) or os.path.exists(zip_path):
+            continue
+        if not rate_checked:
+            # Keep the API calls for the tasks themselves.
+            rate_checked = True
+            if get_rate()[1]:
+                print("Near API limit, not prefetching")
+                return
+        try:
+            print("Prefetching the sources of {}".format(sha))
+            content = requests_get(
+                github_api(repo_url) + "/zipball/" + sha, timeout=HTTP_TIMEOUT
+            ).content
+            tmp_path = zip_path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(content)
+            with ZipFile(tmp_path) as zip_file:
+                net = required_net_from_zip(zip_file)
+            if net and (
+                not os.path.exists(os.path.join(testing_dir, net))
+                or not validate_net(testing_dir, net)
+            ):
+                download_net(remote, testing_dir, net)
+            os.replace(tmp_path, zip_path)
+        except Exception as e:
+            print(
+                "Exception prefetching the sources of {}:\n".format(sha),
+                e,
+                sep="",
+                file=sys.stderr,
+            )
+
+
 def setup_engine(
     destination, worker_dir, testing_dir, remote, sha, repo_url, concurrency, compiler
 ):
@@ -620,12 +727,17 @@ def setup_engine(
 
     try:
         os.chdir(tmp_dir)
-        with open("sf.gz", "wb+") as f:
-            f.write(
-                requests_get(
-                    github_api(repo_url) + "/zipball/" + sha, timeout=HTTP_TIMEOUT
-                ).content
-            )
+        zip_path = sources_zip(testing_dir, sha)
+        if os.path.exists(zip_path):
+            # Downloaded by prefetch_run().
+            shutil.move(zip_path, "sf.gz")
+        else:
+            with open("sf.gz", "wb+") as f:
+                f.write(
+                    requests_get(
+                        github_api(repo_url) + "/zipball/" + sha, timeout=HTTP_TIMEOUT
+                    ).content
+                )
         zip_file = ZipFile("sf.gz")
         zip_file.extractall()
         zip_file.close()
@@ -822,9 +934,33 @@ def validate_pentanomial(wld, rounds):
     assert abs(s5 - s3) < epsilon
 
 
+def update_tasks_payload(result, next_run=False, next_task=False):
+    # /api/update_tasks accepts a list of updates. We only have one.
+    update = {"run_id": result["run_id"], "task_id": result["task_id"]}
+    update["stats"] = result["stats"]
+    if "spsa" in result:
+        update["spsa"] = result["spsa"]
+    payload = {
+        "password": result["password"],
+        "worker_info": result["worker_info"],
+        "updates": [update],
+    }
+    # Ask for the run of the next task, or with the final update for
+    # the next task itself.
+    if next_run:
+        payload["next_run"] = True
+    if next_task:
+        payload["next_task"] = True
+    return payload
+
+
+coalesce_until = 0
+
+
 def parse_cutechess_output(
-    p, remote, result, spsa_tuning, games_to_play, batch_size, tc_limit
+    p, remote, result, spsa_tuning, games_to_play, batch_size, tc_limit, prefetch
 ):
+    global coalesce_until
     saved_stats = copy.deepcopy(result["stats"])
     rounds = {}
 
@@ -925,18 +1061,60 @@ def parse_cutechess_output(
             assert num_games_finished <= games_to_play
 
             # Send an update_task request after a batch is full or if we have played all games.
-            if (num_games_finished == num_games_updated + batch_size) or (
-                num_games_finished == games_to_play
+            final_update = num_games_finished == games_to_play
+            # The task ends with the final update of its last match.
+            # A worker about to quit does not ask for the next task.
+            next_task = (
+                final_update
+                and prefetch["remaining"] == 0
+                and not os.path.isfile(prefetch["exit_file"])
+            )
+            games_left = prefetch["remaining"] + games_to_play - num_games_finished
+            next_run = (
+                not prefetch["hinted"]
+                and not next_task
+                and games_left <= prefetch["ahead"]
+            )
+            if (
+                num_games_finished == num_games_updated + batch_size
+                and not final_update
+                and time.time() < coalesce_until
             ):
+                # The server asked us to send fewer updates. The stats are
+                # cumulative so the next update also covers this batch.
+                num_games_updated = num_games_finished
+            elif (num_games_finished == num_games_updated + batch_size) or final_update:
                 # Attempt to send game results to the server. Retry a few times upon error.
                 update_succeeded = False
                 for _ in range(5):
                     try:
                         response = send_api_post_request(
-                            remote + "/api/update_task", result
+                            remote + "/api/update_tasks",
+                            update_tasks_payload(result, next_run, next_task),
                         )
                         if "error" in response:
                             break
+                        if response.get("coalesce", False):
+                            print("Server is busy, coalescing updates")
+                            coalesce_until = time.time() + COALESCE_TIME
+                        if next_run:
+                            prefetch["hinted"] = True
+                        if "next_run" in response:
+                            threading.Thread(
+                                target=prefetch_run,
+                                args=(
+                                    remote,
+                                    prefetch["testing_dir"],
+                                    response["next_run"],
+                                ),
+                                daemon=True,
+                            ).start()
+                        if "next_task" in response:
+                            prefetch["next_task"][0] = response["next_task"]
+                        response = response["results"][0]
+                        if "error" in response:
+                            print("Error from remote: {}".format(response["error"]))
+                            break
                     except Exception as e:
                         print(
                             "Exception calling update_task:\n",
@@ -971,7 +1149,7 @@ def parse_cutechess_output(
 
 
 def launch_cutechess(
-    cmd, remote, result, spsa_tuning, games_to_play, batch_size, tc_limit
+    cmd, remote, result, spsa_tuning, games_to_play, batch_size, tc_limit, prefetch
 ):
 
     if spsa_tuning:
@@ -1035,6 +1213,7 @@ def launch_cutechess(
                 games_to_play,
                 batch_size,
                 tc_limit,
+                prefetch,
             )
         finally:
             try:
@@ -1055,7 +1234,7 @@ def launch_cutechess(
     return task_alive
 
 
-def run_games(worker_info, password, remote, run, task_id, pgn_file):
+def run_games(worker_info, password, remote, run, task_id, pgn_file, next_task):
     # This is the main cutechess-cli driver.
     # It is ok, and even expected, for this function to
     # raise exceptions, implicitly or explicitly, if a
@@ -1166,6 +1345,19 @@ def run_games(worker_info, password, remote, run, task_id, pgn_file):
     # Verify that cutechess is working and has the required minimum version.
     verify_required_cutechess(testing_dir, cutechess)
 
+    # Clean up the sources downloaded for runs that were not played.
+    for old_zip in glob.glob(os.path.join(testing_dir, "sf_*.zip*")):
+        try:
+            if os.path.getmtime(old_zip) < time.time() - 24 * 3600:
+                os.remove(old_zip)
+        except Exception as e:
+            print(
+                "Failed to remove old sources {}:\n".format(old_zip),
+                e,
+                sep="",
+                file=sys.stderr,
+            )
+
     # Clean up old engines (keeping the num_bkps most recent).
     engines = glob.glob(os.path.join(testing_dir, "stockfish_*" + EXE_SUFFIX))
     num_bkps = 50
@@ -1320,6 +1512,18 @@ def run_games(worker_info, password, remote, run, task_id, pgn_file):
     if spsa_tuning:
         tc_limit *= 2
 
+    # The next task, or the run that the server would give us next, can
+    # be asked for when the task is about to end, see update_tasks_payload().
+    # The next task is returned in next_task[0].
+    prefetch = {
+        "remaining": 0,
+        "ahead": task["num_games"] * PREFETCH_FRACTION,
+        "hinted": False,
+        "testing_dir": testing_dir,
+        "exit_file": os.path.join(worker_dir, "fish.exit"),
+        "next_task": next_task,
+    }
+
     while games_remaining > 0:
 
         batch_size = games_concurrency * 4  # update frequency
@@ -1424,6 +1628,7 @@ def run_games(worker_info, password, remote, run, task_id, pgn_file):
             + book_cmd
         )
 
+        prefetch["remaining"] = games_remaining - games_to_play
         task_alive = launch_cutechess(
             cmd,
             remote,
@@ -1432,6 +1637,7 @@ def run_games(worker_info, password, remote, run, task_id, pgn_file):
             games_to_play,
             batch_size,
             tc_limit * max(8, games_to_play / games_concurrency),
+            prefetch,
         )
 
         games_remaining -= games_to_play
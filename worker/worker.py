@@ -3,7 +3,6 @@ import atexit
 import base64
 import datetime
 import getpass
-import math
 import multiprocessing
 import os
 import platform
@@ -39,18 +38,23 @@ from games import (
     RunException,
     WorkerException,
     backup_log,
+    get_rate,
     log,
     run_games,
     send_api_post_request,
+    session_token_lifetime,
+    set_session_token,
     str_signal,
 )
 from updater import update
 
-WORKER_VERSION = 160
+WORKER_VERSION = 161
 HTTP_TIMEOUT = 30.0
 INITIAL_RETRY_TIME = 15.0
 THREAD_JOIN_TIMEOUT = 15.0
 MAX_RETRY_TIME = 900.0  # 15 minutes
+MAX_CHAINED_TASKS = 4  # tasks received with a final update, see verify_worker()
+TOKEN_RENEW_TIME = 1200.0  # seconds
 IS_WINDOWS = "windows" in platform.system().lower()
 CONFIGFILE = "fishtest.cfg"
 
@@ -94,7 +98,7 @@ Setup task          <github>/rate_limit
                     <github-books>/git/trees/master/blobs/<sha-book>            GET
                     <github>/repos/<user-repo>/zipball/<sha>                    GET
 
-Main loop           <fishtest>/api/update_task                                  POST
+Main loop           <fishtest>/api/update_tasks                                 POST
                     <fishtest>/api/request_spsa                                 POST
 
 Finish task         <fishtest>/api/failed_task                                  POST
@@ -587,20 +591,6 @@ def on_sigint(current_state, signal, frame):
     raise FatalException("Terminated by signal {}".format(str_signal(signal)))
 
 
-def get_rate():
-    try:
-        rate = requests.get(
-            "https://api.github.com/rate_limit", timeout=HTTP_TIMEOUT
-        ).json()["resources"]["core"]
-    except Exception as e:
-        print("Exception fetching rate_limit:\n", e, sep="", file=sys.stderr)
-        rate = {"remaining": 0, "limit": 5000}
-        return rate, False
-    remaining = rate["remaining"]
-    print("API call rate limits:", rate)
-    return rate, remaining < math.sqrt(rate["limit"])
-
-
 def gcc_version():
     """Parse the output of g++ -E -dM -"""
     try:
@@ -846,6 +836,67 @@ def utcoffset():
     return "{}{:02d}:{:02d}".format("+" if utcoffset >= 0 else "-", hh, mm)
 
 
+def give_back_task(worker_info, password, remote, task):
+    # Releases a task that the server gave us with the final update of
+    # the previous one, but that we will not play.
+    print("Giving back the next task...")
+    payload = {
+        "password": password,
+        "run_id": str(task["run"]["_id"]),
+        "task_id": task["task_id"],
+        "message": "The worker did not start the task",
+        "worker_info": worker_info,
+    }
+    try:
+        send_api_post_request(remote + "/api/failed_task", payload)
+    except Exception as e:
+        print("Exception posting failed_task:\n", e, sep="", file=sys.stderr)
+
+
+def verify_worker(worker_info, password, remote, current_state, next_task=None):
+    # Checks the API rate and the version of the worker, and renews the
+    # session token. Returns False if no task should be played now. In
+    # that case next_task, the task given with the final update of the
+    # previous one if any, is given back to the server.
+    current_state["chained_tasks"] = 0
+    try:
+        rate, near_api_limit = get_rate()
+        worker_info["rate"] = rate
+        if near_api_limit:
+            print("Near API limit")
+            req = None
+        else:
+            print("Verify worker version...")
+            req = send_api_post_request(
+                remote + "/api/request_version",
+                {"worker_info": worker_info, "password": password},
+            )
+    except Exception as e:
+        if next_task is None:
+            raise
+        # Play the next task anyway, the server has it.
+        print("Exception verifying the worker:\n", e, sep="", file=sys.stderr)
+        return True
+
+    if req is not None and "error" in req:
+        current_state["alive"] = False
+        req = None
+    if req is not None and "token" in req:
+        set_session_token(req["token"], req["token_lifetime"])
+    update_required = req is not None and req["version"] > WORKER_VERSION
+    if next_task is not None and (req is None or update_required):
+        give_back_task(worker_info, password, remote, next_task)
+    if req is None:
+        return False
+    if update_required:
+        print("Updating worker version to {}".format(req["version"]))
+        backup_log()
+        update()
+        # Only reached if the worker was not restarted.
+        return next_task is None
+    return True
+
+
 def fetch_and_handle_task(worker_info, password, remote, lock_file, current_state):
     # This function should normally not raise exceptions.
     # Unusual conditions are handled by returning False.
@@ -860,41 +911,48 @@ def fetch_and_handle_task(worker_info, password, remote, lock_file, current_stat
 
     payload = {"worker_info": worker_info, "password": password}
 
-    try:
-        rate, near_api_limit = get_rate()
-        if near_api_limit:
-            print("Near API limit")
+    req, current_state["next_task"] = current_state["next_task"], None
+    if req is not None:
+        # The server gave us this task with the final update of the
+        # previous one. Once in a while we still check the version,
+        # the API rate and renew the token.
+        print("Starting the next task...")
+        current_state["chained_tasks"] += 1
+        if (
+            current_state["chained_tasks"] >= MAX_CHAINED_TASKS
+            or session_token_lifetime() < TOKEN_RENEW_TIME
+        ) and not verify_worker(worker_info, password, remote, current_state, req):
             return False
-
-        worker_info["rate"] = rate
-
-        print("Verify worker version...")
-        req = send_api_post_request(remote + "/api/request_version", payload)
-
-        if "error" in req:
-            current_state["alive"] = False
-            return False
-
-        if req["version"] > WORKER_VERSION:
-            print("Updating worker version to {}".format(req["version"]))
-            backup_log()
-            update()
-        print(
-            "Current time is {} UTC (offset: {}) ".format(
-                datetime.datetime.utcnow(), utcoffset()
+    else:
+        try:
+            if not verify_worker(worker_info, password, remote, current_state):
+                return False
+            print(
+                "Current time is {} UTC (offset: {}) ".format(
+                    datetime.datetime.utcnow(), utcoffset()
+                )
             )
-        )
-        print("Fetching task...")
-        req = send_api_post_request(remote + "/api/request_task", payload)
-    except Exception as e:
-        print("Exception accessing host:\n", e, sep="", file=sys.stderr)
-        return False
+            print("Fetching task...")
+            req = send_api_post_request(remote + "/api/request_task", payload)
+        except Exception as e:
+            print("Exception accessing host:\n", e, sep="", file=sys.stderr)
+            return False
 
     if "error" in req:
         return False
 
     # No tasks ready for us yet, just wait...
     if "task_waiting" in req:
+        if "retry_after" in req:
+            # The server is too busy and tells us when to come back.
+            try:
+                current_state["retry_after"] = min(
+                    MAX_RETRY_TIME, max(1.0, float(req["retry_after"]))
+                )
+                print("The server is busy, waiting...")
+                return False
+            except (TypeError, ValueError):
+                pass
         print("No tasks available at this time, waiting...")
         return False
 
@@ -930,8 +988,9 @@ def fetch_and_handle_task(worker_info, password, remote, lock_file, current_stat
     server_message = ""
     api = remote + "/api/failed_task"
     pgn_file = [None]
+    next_task = [None]
     try:
-        run_games(worker_info, password, remote, run, task_id, pgn_file)
+        run_games(worker_info, password, remote, run, task_id, pgn_file, next_task)
         success = True
     except FatalException as e:
         message = str(e)
@@ -951,6 +1010,7 @@ def fetch_and_handle_task(worker_info, password, remote, lock_file, current_stat
 
     current_state["task_id"] = None
     current_state["run"] = None
+    current_state["next_task"] = next_task[0]
 
     payload = {
         "password": password,
@@ -1032,6 +1092,9 @@ def worker():
         "task_id": None,  # the id of the current task
         "alive": True,  # controls the main loop and
         # the heartbeat loop
+        "retry_after": None,  # the delay asked for by a busy server
+        "next_task": None,  # given with the final update of the previous task
+        "chained_tasks": 0,  # next tasks played since the last version check
     }
 
     # Install signal handlers.
@@ -1122,13 +1185,22 @@ def worker():
         success = fetch_and_handle_task(
             worker_info, options.password, remote, lock_file, current_state
         )
+        retry_after, current_state["retry_after"] = current_state["retry_after"], None
         if not current_state["alive"]:  # the user may have pressed Ctrl-C...
             break
+        elif retry_after is not None:
+            # Not an error: retry when the server asked us to, without
+            # increasing the delay.
+            print("Waiting {} seconds before retrying".format(retry_after))
+            safe_sleep(retry_after)
         elif not success:
             if options.fleet:
                 current_state["alive"] = False
                 print("Exiting the worker since fleet==True and an error occurred")
                 break
+            elif current_state["next_task"] is not None:
+                # Don't let the next task expire on the server.
+                pass
             else:
                 print("Waiting {} seconds before retrying".format(delay))
                 safe_sleep(delay)
@@ -1136,6 +1208,12 @@ def worker():
         else:
             delay = INITIAL_RETRY_TIME
 
+    if current_state["next_task"] is not None:
+        # Don't let the server wait for the task to expire.
+        give_back_task(
+            worker_info, options.password, remote, current_state["next_task"]
+        )
+
     print("Waiting for the heartbeat thread to finish...")
     heartbeat_thread.join(THREAD_JOIN_TIMEOUT)
 